@@ -0,0 +1,26 @@
+"""
+Checks on the values in api messages.
+
+The api messages are json, so a value can be any json type. These checks accept only the values that make sense for
+the command and raise ValueError for the rest (which the api reports as an incorrect json message), so a bad value is
+refused before anything is queued or moved. true and false are not numbers here, although Python treats them as 1
+and 0.
+
+Usage:
+    steps = wholenumber(command['steps'])
+    timeout = seconds(command['timeout'])
+"""
+
+
+def wholenumber(value):
+    """Return **value** if it is a whole number of steps or a position, raises ValueError if not"""
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError('%r is not a whole number' % (value,))
+    return value
+
+
+def seconds(value):
+    """Return **value** if it is a time of 0 seconds or more, raises ValueError if not"""
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or not value >= 0:
+        raise ValueError('%r is not a number of seconds' % (value,))
+    return value
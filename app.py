@@ -6,40 +6,101 @@ a Raspberry Pi system. It includes features for:
 - System status monitoring (CPU temperature, running threads)
 - Log viewing (Application, Gunicorn, System logs)
 - RESTful API endpoints with authentication
-- Real-time status updates via JavaScript
+- Real-time status updates pushed to the browser with Server-Sent Events
 
 The application runs on Gunicorn when deployed on Raspberry Pi and includes
 various endpoints for both web interface and programmatic access.
 
 Routes:
     / : Main status page
-    /statusdata : JSON endpoint for live status updates
-    /api : Protected API endpoint for system control
+    /statusdata : JSON endpoint for live status updates, supports ETag/If-None-Match and ?since=version long-poll
+    /statusstream : Server-Sent Events stream of status changes used by the main status page
+    /api : Protected API endpoint for system control, accepts one {item, command} message or a list of them
     /pylog : Application log viewer
+    /motionlog : Motion daemon log viewer
     /guaccesslog : Gunicorn access log viewer
     /guerrorlog : Gunicorn error log viewer
-    /syslog : System log viewer
+    The file log viewers accept ?offset=n&limit=n&search=text&level=LEVEL to page through and filter the log
+    /syslog : System log viewer, accepts the same arguments plus ?unit=name&since=time&until=time
+    /metrics : Prometheus metrics for the motion code, the request latencies, CPU temperature and threads
+    /syslogdata : JSON system log entries, ?after=cursor returns only the entries newer than the cursor
+    /historydata : JSON stage position history, ?start=time&end=time&points=n downsampled on the server
 
 Authentication:
     API endpoints require a valid API key passed in the 'Api-Key' header.
+
+When the motion-daemon setting is on the stepper controller runs in the motion daemon process (motiondaemon.py) and
+the app uses the thin client in motionclient, otherwise the controller runs in the app.
+
+The app is made by create_app(), gunicorn runs 'app:create_app()'. Importing this module or creating the app does not
+touch the hardware: the controller is started by the first request that uses it (or by starthardware()), and
+stophardware() shuts it down once the running move has finished, which the gunicorn worker_exit hook in
+gunicorn.conf.py calls so a reload does not cut a move off part way.
 """
-import subprocess
-from threading import enumerate as enumerate_threads
-from flask import Flask, render_template, jsonify, request
-from steppercontrol import statusmessage, parsecontrol
+import atexit
+from time import monotonic
+from threading import enumerate as enumerate_threads, active_count
+from flask import Flask, Blueprint, render_template, jsonify, request, Response, stream_with_context, \
+    stream_template, g
+from statusstream import StatusBroadcaster
+from logreader import tail
+from metrics import SharedHistogram, LATENCY_BUCKETS, family, register, exposition
+from positionhistory import query as historyquery
+from syslogservice import SyslogService, JournalSource, FileSource, formatentry, levelpriority
 from app_control import VERSION, settings
 from logmanager import logger
 
-app = Flask(__name__)
-logger.info('Starting %s web app version %s', settings['app-name'], VERSION)
-logger.info('Api-Key = %s', settings['api-key'])
+web = Blueprint('web', __name__)
+runtime = {'controller': None, 'broadcaster': None, 'startup': None}
+
+
+def create_app():
+    """Create the Flask app. The stepper controller, or the motion daemon client when the motion-daemon setting is on,
+    is chosen here but not started, see starthardware()."""
+    started = monotonic()
+    if runtime['controller'] is None:
+        # pylint: disable=import-outside-toplevel
+        if settings['motion-daemon']:
+            import motionclient as controller
+        else:
+            import steppercontrol as controller
+        runtime['controller'] = controller
+        runtime['broadcaster'] = StatusBroadcaster(controller.statusmessage,
+                                                   lambda: {'cputemperature': cached_cpu_temperature()},
+                                                   controller.snapshot)
+        atexit.register(stophardware)
+    flaskapp = Flask(__name__)
+    flaskapp.register_blueprint(web)
+    runtime['startup'] = monotonic() - started
+    logger.info('Starting %s web app version %s in %.3fs', settings['app-name'], VERSION, runtime['startup'])
+    logger.info('Api-Key = %s', settings['api-key'])
+    return flaskapp
+
 
+def starthardware():
+    """Start the stepper controller now instead of on the first request, does nothing if it is running"""
+    runtime['controller'].start()
 
-def read_log_from_file(file_path):
-    """Read a log from a file and reverse the order of the lines so newest is at the top"""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-    return list(reversed(lines))
+
+def stophardware():
+    """Shut the stepper controller down once its running motion has finished, does nothing if it is not running"""
+    if runtime['controller'] is not None:
+        runtime['controller'].shutdown()
+
+
+def read_log_from_file(file_path, title):
+    """Stream a log web page showing one page of a log file, newest line at the top. The page is selected with the
+    offset and limit request arguments and filtered with search and level, only the lines on the page are read from
+    the end of the file (and its rotated backups)."""
+    pager = {'offset': max(request.args.get('offset', 0, type=int), 0),
+             'limit': min(max(request.args.get('limit', settings['log-page-size'], type=int), 1), 10000),
+             'search': request.args.get('search', ''),
+             'level': request.args.get('level', '')}
+    rows = tail(file_path, pager['offset'], pager['limit'], pager['search'] or None, pager['level'] or None,
+                settings['log-backups'])
+    return Response(stream_template('logs.html', rows=rows, log=title, pager=pager,
+                                    cputemperature=cached_cpu_temperature(), appname=settings['app-name'],
+                                    version=VERSION))
 
 
 def read_cpu_temperature():
@@ -49,6 +110,50 @@ def read_cpu_temperature():
     return round(float(log) / 1000, 1)
 
 
+def cached_cpu_temperature():
+    """Return the CPU temperature, read from the file at most once every status-stream-slow-interval seconds"""
+    if monotonic() - cputemperature['read'] > settings['status-stream-slow-interval']:
+        cputemperature['value'] = read_cpu_temperature()
+        cputemperature['read'] = monotonic()
+    return cputemperature['value']
+
+
+def syslogquery():
+    """Query the system log service with the filters and page given in the request arguments"""
+    return syslogservice.query(unit=request.args.get('unit') or None,
+                               priority=levelpriority(request.args.get('level')),
+                               since=request.args.get('since', type=float), until=request.args.get('until', type=float),
+                               search=request.args.get('search') or None, after=request.args.get('after'),
+                               offset=max(request.args.get('offset', 0, type=int), 0),
+                               limit=min(max(request.args.get('limit', settings['log-page-size'], type=int), 1),
+                                         settings['syslog-buffer-size']))
+
+
+cputemperature = {'value': None, 'read': -1e9}
+if settings['syslog-source'] == 'file':
+    syslogservice = SyslogService(FileSource(settings['syslog-file']), settings['syslog-buffer-size'])
+else:
+    syslogservice = SyslogService(JournalSource(settings['syslog-buffer-size']), settings['syslog-buffer-size'])
+
+
+def appmetrics():
+    """Metric families of the web app for the /metrics endpoint"""
+    try:
+        temperature = cached_cpu_temperature()
+    except (OSError, ValueError):
+        temperature = None
+    return [family('xy_request_seconds', 'histogram', 'Time to handle a request',
+                   [sample for route, histogram in list(requesttimes.items())
+                    for sample in histogram.samples({'route': route})]),
+            family('xy_cpu_temperature_celsius', 'gauge', 'CPU temperature', [({}, temperature)]),
+            family('xy_threads', 'gauge', 'Active threads', [({}, active_count())]),
+            family('xy_app_startup_seconds', 'gauge', 'Time create_app() took', [({}, runtime['startup'])])]
+
+
+requesttimes = {}
+register(appmetrics)
+
+
 def threadlister():
     """Get a list of all threads running"""
     appthreads = []
@@ -57,31 +162,71 @@ def threadlister():
     return appthreads
 
 
-@app.route('/')
+@web.before_app_request
+def startrequest():
+    """Note the time a request started for the request latency metric"""
+    g.requeststart = monotonic()
+
+
+@web.after_app_request
+def endrequest(response):
+    """Count the time taken by the request in the latency histogram of its route"""
+    if request.url_rule is not None and 'requeststart' in g:
+        histogram = requesttimes.get(request.url_rule.rule)
+        if histogram is None:
+            histogram = requesttimes.setdefault(request.url_rule.rule, SharedHistogram(LATENCY_BUCKETS))
+        histogram.observe(monotonic() - g.requeststart)
+    return response
+
+
+@web.route('/metrics')
+def metrics():
+    """Prometheus metrics in the text exposition format"""
+    return Response(exposition(), mimetype='text/plain; version=0.0.4')
+
+
+@web.route('/')
 def index():
     """Main web status page"""
     return render_template('index.html', version=VERSION, appname=settings['app-name'], threads=threadlister())
 
-@app.route('/statusdata', methods=['GET'])
+@web.route('/statusdata', methods=['GET'])
 def statusdata():
-    """Status data read by javascript on default website so the page shows near live values"""
-    ctrldata = statusmessage()
-    ctrldata['cputemperature'] = read_cpu_temperature()
-    return jsonify(ctrldata), 201
+    """Status data read by javascript on default website so the page shows near live values. The reply has an ETag
+    made from the status snapshot version and no-cache, so browsers and caches revalidate it and get 304 Not Modified
+    (with the ETag) when nothing has changed, and **?since=version** waits for a status newer than that version
+    (long-poll)."""
+    since = request.args.get('since', type=int)
+    ctrldata = runtime['controller'].statusmessage(since, settings['snapshot-longpoll-timeout'])
+    ctrldata['cputemperature'] = cached_cpu_temperature()
+    response = jsonify(ctrldata)
+    response.set_etag('%s-%s' % (ctrldata['version'], ctrldata['cputemperature']))
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
-@app.route('/api', methods=['POST'])
+@web.route('/statusstream')
+def statusstream():
+    """Server-Sent Events stream of the status, sends the full status on connection then only the values that
+    change"""
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(runtime['broadcaster'].stream()), mimetype='text/event-stream',
+                    headers=headers)
+
+
+@web.route('/api', methods=['POST'])
 def api():
     """API Endpoint for programatic access - needs request data to be posted in a json file. Contains a check for a
-    valid API key."""
+    valid API key. A json list of messages is run as one batch and the reply is the list of results."""
     try:
-        logger.debug('API headers: %s', request.headers)
         logger.debug('API request: %s', request.json)
         if 'Api-Key' in request.headers.keys():  # check api key exists
             if request.headers['Api-Key'] == settings['api-key']:  # check for correct API key
+                if isinstance(request.json, list):
+                    return jsonify(runtime['controller'].parsebatch(request.json)), 201
                 item = request.json['item']
                 command = request.json['command']
-                return jsonify(parsecontrol(item, command)), 201
+                return jsonify(runtime['controller'].parsecontrol(item, command, request.json.get('policy'))), 201
             logger.warning('API: access attempt using an invalid token from %s', request.headers[''])
             return 'access token(s) unuthorised', 401
         logger.warning('API: access attempt without a token from  %s', request.headers['X-Forwarded-For'])
@@ -91,45 +236,64 @@ def api():
 
 
 
-@app.route('/pylog')
+@web.route('/pylog')
 def showplogs():
     """Show the Application log web page"""
-    cputemperature = read_cpu_temperature()
-    logs = read_log_from_file(settings['logfilepath'])
-    return render_template('logs.html', rows=logs, log='Application log',
-                           cputemperature=cputemperature, appname=settings['app-name'], version=VERSION)
+    return read_log_from_file(settings['logfilepath'], 'Application log')
+
+
+@web.route('/motionlog')
+def showmotionlogs():
+    """Show the Motion daemon log web page"""
+    return read_log_from_file(settings['motion-logfilepath'], 'Motion Log')
 
 
-@app.route('/guaccesslog')
+@web.route('/guaccesslog')
 def showgalogs():
     """"Show the Gunicorn Access Log web page"""
-    cputemperature = read_cpu_temperature()
-    logs = read_log_from_file(settings['gunicornpath'] + 'gunicorn-access.log')
-    return render_template('logs.html', rows=logs, log='Gunicorn Access Log',
-                           cputemperature=cputemperature, appname=settings['app-name'], version=VERSION)
+    return read_log_from_file(settings['gunicornpath'] + 'gunicorn-access.log', 'Gunicorn Access Log')
 
 
-@app.route('/guerrorlog')
+@web.route('/guerrorlog')
 def showgelogs():
     """"Show the Gunicorn Errors Log web page"""
-    cputemperature = read_cpu_temperature()
-    logs = read_log_from_file(settings['gunicornpath'] + 'gunicorn-error.log')
-    return render_template('logs.html', rows=logs, log='Gunicorn Error Log',
-                           cputemperature=cputemperature, appname=settings['app-name'], version=VERSION)
+    return read_log_from_file(settings['gunicornpath'] + 'gunicorn-error.log', 'Gunicorn Error Log')
 
 
-@app.route('/syslog')
+@web.route('/syslog')
 def showslogs():
-    """Show the last 2000 lines from the system log on a web page"""
-    cputemperature = read_cpu_temperature()
-    log = subprocess.Popen('/bin/journalctl -n 2000', shell=True,
-                           stdout=subprocess.PIPE).stdout.read().decode(encoding='utf-8')
-    logs = log.split('\n')
-    logs.reverse()
-    return render_template('logs.html', rows=logs, log='System Log', cputemperature=cputemperature,
-                           version=VERSION, appname=settings['app-name'])
+    """Show a page of the system log from the system log service's buffer on a web page"""
+    pager = {'offset': max(request.args.get('offset', 0, type=int), 0),
+             'limit': min(max(request.args.get('limit', settings['log-page-size'], type=int), 1),
+                          settings['syslog-buffer-size']),
+             'search': request.args.get('search', ''), 'level': request.args.get('level', ''),
+             'unit': request.args.get('unit', '')}
+    rows = [formatentry(entry) for entry in syslogquery()]
+    return render_template('logs.html', rows=rows, log='System Log', pager=pager,
+                           cputemperature=cached_cpu_temperature(), version=VERSION, appname=settings['app-name'])
+
+
+@web.route('/syslogdata')
+def syslogdata():
+    """System log entries as json, newest first, with the cursor of the newest entry so the next request can ask for
+    only the entries after it. **expired** is true if the cursor asked for has left the buffer, the entries are then
+    all those in the buffer and may include ones the client has already seen."""
+    after = request.args.get('after')
+    entries = syslogquery()
+    return jsonify({'entries': entries, 'cursor': entries[0]['cursor'] if entries else after,
+                    'expired': after is not None and syslogservice.expired(after)})
+
+
+@web.route('/historydata')
+def historydata():
+    """Stage position history as json lists, from **?start** to **?end** (unix times, default all of the history)
+    downsampled to at most **?points** points. Each point has the time of its first sample, the x and y position
+    range and the moving and limit switch bits of its samples, see positionhistory."""
+    points = min(max(request.args.get('points', settings['history-points'], type=int), 1), 10000)
+    return jsonify(historyquery(settings['history-file'], request.args.get('start', type=float),
+                                request.args.get('end', type=float), points))
 
 
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
@@ -21,47 +21,161 @@ Note:
 
 """
 
+import atexit
+import os
 import random
 import json
+import threading
 from datetime import datetime
+from settingsstore import SettingsStore
 
-VERSION = '1.0.6'
+VERSION = '1.0.31'
 
 def initialise():
     """Setup the settings dict structure with default values"""
     isettings = {'LastSave': '01/01/2000 00:00:01',
+                 'api-batch-max': 100,
                  'api-key': 'change-me',
                  'app-name': 'Oxide X-Y Stage Controller',
                  'cputemp': '/sys/class/thermal/thermal_zone0/temp',
+                 'gpio-backend': 'rpi',
+                 'gpio-multi-write': True,
                  'gunicornpath': './logs/',
+                 'history-capacity': 864000,
+                 'history-file': './positions.history',
+                 'history-points': 500,
+                 'history-rate': 10.0,
+                 'home-backoff': 10,
+                 'home-repeats': 2,
+                 'log-backups': 10,
+                 'log-format': 'text',
+                 'log-page-size': 500,
+                 'log-queue-policy': 'drop-new',
+                 'log-queue-size': 10000,
                  'logappname': 'XY-Control-Py',
                  'logfilepath': './logs/xycontrol.log',
                  'loglevel': 'INFO',
+                 'motion-client-timeout': 120,
+                 'motion-cpus': [],
+                 'motion-daemon': False,
+                 'motion-logfilepath': './logs/xymotion.log',
+                 'motion-nice': 0,
+                 'motion-profile': 'trapezoidal',
+                 'motion-queue-depth': 16,
+                 'motion-queue-policy': 'replace',
+                 'motion-realtime-priority': 0,
+                 'motion-socket': '/tmp/xymotion.sock',
+                 'motion-status-name': 'xycontrol-status',
+                 'motion-status-size': 65536,
+                 'position-checkpoint-interval': 3600,
+                 'position-journal': './positions.journal',
+                 'position-journal-interval': 0.5,
+                 'scan-max-points': 10000,
+                 'settings-write-delay': 2.0,
+                 'shutdown-timeout': 25,
+                 'sim-clock-speed': 1.0,
+                 'sim-max-step-rate': 0,
+                 'sim-x-max-switch': 1050,
+                 'sim-x-min-switch': 5,
+                 'sim-x-start': 500,
+                 'sim-x-travel': 1100,
+                 'sim-y-max-switch': 1050,
+                 'sim-y-min-switch': 5,
+                 'sim-y-start': 500,
+                 'sim-y-travel': 1100,
+                 'snapshot-interval': 0.05,
+                 'snapshot-longpoll-timeout': 30,
+                 'startup-time-target': 1.0,
+                 'status-stream-heartbeat': 15,
+                 'status-stream-interval': 0.1,
+                 'status-stream-slow-interval': 5,
+                 'step-engine': 'deadline',
+                 'step-max-lag': 0.002,
+                 'step-spin-margin': 0.0005,
+                 'step-wave-chunk': 0.05,
                  'stepper-pulse-width': 0.02,
+                 'switch-debounce-ms': 5,
+                 'syslog-buffer-size': 5000,
+                 'syslog-file': './logs/syslog.json',
+                 'syslog-source': 'journal',
+                 'trace-capacity': 100000,
+                 'trace-path': './traces/',
                  'x-a-gpio-pin': 6,
                  'x-aa-gpio-pin': 12,
+                 'x-acceleration': 400,
                  'x-b-gpio-pin': 13,
                  'x-bb-gpio-pin': 16,
+                 'x-home-approach-speed': 20,
+                 'x-home-seek-speed': 200,
+                 'x-jerk': 4000,
                  'x-max': 1000,
                  'x-max-gpio-pin': 17,
+                 'x-max-speed': 200,
                  'x-min': 10,
                  'x-min-gpio-pin': 27,
                  'x-moving-gpio-pin': 24,
+                 'x-step-mode': 'half',
                  'xposition': 500,
                  'y-a-gpio-pin': 19,
                  'y-aa-gpio-pin': 20,
+                 'y-acceleration': 400,
                  'y-b-gpio-pin': 26,
                  'y-bb-gpio-pin': 21,
+                 'y-home-approach-speed': 20,
+                 'y-home-seek-speed': 200,
+                 'y-jerk': 4000,
                  'y-max': 1000,
                  'y-max-gpio-pin': 23,
+                 'y-max-speed': 200,
                  'y-min': 10,
                  'y-min-gpio-pin': 18,
                  'y-moving-gpio-pin': 25,
+                 'y-step-mode': 'half',
                  'yposition': 500
                  }
     return isettings
 
 
+AXISNUMBERS = {'%s-%s' % (axis, name): rules for axis in ('x', 'y') for name, rules in (
+    ('acceleration', {'type': float, 'min': 0}), ('jerk', {'type': float, 'min': 0}),
+    ('max-speed', {'type': float, 'min': 1}), ('home-seek-speed', {'type': float, 'min': 1}),
+    ('home-approach-speed', {'type': float, 'min': 1}), ('max', {'min': 0}), ('min', {'min': 0}),
+    ('step-mode', {'choices': ('half', 'full', 'wave')}))}
+
+SCHEMA = dict(AXISNUMBERS, **{
+    'api-batch-max': {'min': 1},
+    'gpio-backend': {'choices': ('rpi', 'simulator')},
+    'history-capacity': {'min': 1},
+    'history-points': {'min': 1},
+    'history-rate': {'min': 0, 'max': 1000},
+    'home-backoff': {'min': 1},
+    'home-repeats': {'min': 1},
+    'log-format': {'choices': ('text', 'json')},
+    'log-queue-policy': {'choices': ('drop-new', 'drop-old')},
+    'log-queue-size': {'min': 1},
+    'loglevel': {'choices': ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'), 'normalise': str.upper},
+    'motion-profile': {'choices': ('constant', 'trapezoidal', 'scurve')},
+    'motion-queue-depth': {'min': 1},
+    'motion-queue-policy': {'choices': ('append', 'replace', 'merge')},
+    'settings-write-delay': {'min': 0},
+    'shutdown-timeout': {'min': 0},
+    'sim-clock-speed': {'min': 0.001},
+    'snapshot-interval': {'min': 0},
+    'startup-time-target': {'min': 0},
+    'step-engine': {'choices': ('deadline', 'waveform')},
+    'stepper-pulse-width': {'min': 0.0005},
+    'switch-debounce-ms': {'min': 0},
+    'syslog-source': {'choices': ('journal', 'file')}})
+
+
+def axislimits(candidate):
+    """Check the minimum position of each axis is below its maximum"""
+    for axis in ('x', 'y'):
+        if candidate['%s-min' % axis] >= candidate['%s-max' % axis]:
+            return '%s-min must be less than %s-max' % (axis, axis)
+    return None
+
+
 def generate_api_key(key_len):
     """generate a new random api-key"""
     allowed_characters = "ABCDEFGHJKLMNPQRSTUVWXYZ-+~abcdefghijkmnopqrstuvwxyz123456789"
@@ -69,10 +183,15 @@ def generate_api_key(key_len):
 
 
 def writesettings():
-    """Write settings to a json file"""
-    settings['LastSave'] = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-    with open('settings.json', 'w', encoding='utf-8') as outfile:
-        json.dump(settings, outfile, indent=4, sort_keys=True)
+    """Write settings to a json file, the file is written to a temporary file and then replaces the old one so a
+    power cut cannot leave a half written settings file"""
+    with settingslock:
+        settings['LastSave'] = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+        with open('settings.json.tmp', 'w', encoding='utf-8') as outfile:
+            json.dump(settings, outfile, indent=4, sort_keys=True)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace('settings.json.tmp', 'settings.json')
 
 def readsettings():
     """Read the json file"""
@@ -87,22 +206,33 @@ def readsettings():
 def loadsettings():
     """Replace the default settings with those from the json files, if a setting is not in the json file (e.g. it is a
      new feature setting) then retain the default value and write that to the json file. If the api-key is the default
-    value then generate a new key and save it."""
+    value then generate a new key and save it. The file is written by the debounced settings writer (or when the
+    program exits) rather than while the module is being imported."""
     global settings
     settingschanged = False
     fsettings = readsettings()
     for item in settings.keys():
         try:
-            settings[item] = fsettings[item]
+            error = settings.check(item, fsettings[item])
         except KeyError:
             print('settings[%s] Not found in json file using default' % item)
             settingschanged = True
+            continue
+        if error:
+            print('settings[%s] in json file is not valid (%s) using default' % (item, error))
+            settingschanged = True
+        else:
+            settings[item] = settings.normalise(item, fsettings[item])
     if settings['api-key'] == 'change-me':  # the default value
         settings['api-key'] = generate_api_key(128)
         settingschanged = True
     if settingschanged:
-        writesettings()
+        settings.save()
 
 
-settings = initialise()
+settingslock = threading.Lock()
+settings = SettingsStore(initialise(), SCHEMA, [axislimits], writesettings)
 loadsettings()
+settings.delay = settings['settings-write-delay']
+settings.subscribe(['settings-write-delay'], lambda name, value: setattr(settings, 'delay', value))
+atexit.register(settings.flush)
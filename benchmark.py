@@ -0,0 +1,285 @@
+"""
+Benchmark suite for the stepper motion code.
+
+Runs move, moveto, moveslow and calibrate on the x stepper against the simulated GPIO backend (the fake GPIO layer
+with a virtual stage, at real time speed) and records the time of every step written to the coils. The step engine
+is timed by the production monotonic clock (sleep then spin), --clock virtual uses the simulator's virtual clock
+instead. With the waveform engine the pulse trains are timed by the simulator whatever the clock. For each case it
+reports:
+    steps/s: achieved step rate over the time spent stepping
+    jitter: p50, p99 and max of the difference between each inter-step gap and the gap in the move's schedule (us)
+    CPU per step: CPU time of the thread running the move divided by the steps taken (us)
+Two more cases measure how quickly a move is halted:
+    limit: time from the max limit switch tripping to the coils being de-energised
+    stop: time from a stop() call during a move to the coils being left de-energised, and the steps taken after it
+
+The results are saved as JSON with the version, git commit, python version and platform, so runs can be compared
+across commits and between a development computer and a Raspberry Pi. The benchmark runs in a temporary directory
+with the default settings (and a short virtual stage) so the live settings and position journal are not touched.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --engine waveform --load 2 --output pi4.json
+    python benchmark.py --clock virtual
+    python benchmark.py --compare pi4.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BENCH_SETTINGS = {'sim-clock-speed': 1.0, 'sim-max-step-rate': 0, 'sim-x-travel': 300, 'sim-x-start': 150,
+                  'sim-x-min-switch': 5, 'sim-x-max-switch': 250, 'x-min': 10, 'x-max': 240, 'xposition': 150}
+
+CASEMETRICS = ('steps', 'stepspersecond', 'jitterp50', 'jitterp99', 'jittermax', 'cpuperstep', 'latency',
+               'stepsafterstop')
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of **values**, None if there are none"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def microseconds(value):
+    """Seconds to microseconds rounded to 0.1us, None stays None"""
+    return None if value is None else round(value * 1e6, 1)
+
+
+class Recorder:
+    """Wraps an axis' step engine and keeps, for every run, the schedule offsets of the steps taken and the times
+    they were written to the fake GPIO layer"""
+    def __init__(self, gpio, engine):
+        self.gpio = gpio
+        self.engine = engine
+        self.enginerun = engine.run
+        self.runs = []
+        engine.run = self.run
+
+    def run(self, axis, schedule, keepgoing, **options):
+        """Run the schedule through the engine and record the step times"""
+        start = len(self.gpio.events)
+        offsets = []
+
+        def recorded():
+            for item in schedule:
+                offsets.append(item[0])
+                yield item
+        steps = self.enginerun(axis, recorded(), keepgoing, **options)
+        times = self.gpio.steptimes(axis.coilpins(), start=start)[:steps]
+        self.runs.append((offsets[:steps], times))
+        return steps
+
+    def measure(self, action):
+        """Run **action** and return the step rate, jitter and CPU per step of the runs it made"""
+        self.runs = []
+        cpustart = time.thread_time()
+        wallstart = time.monotonic()
+        action()
+        cpu = time.thread_time() - cpustart
+        elapsed = time.monotonic() - wallstart
+        steps = 0
+        stepping = 0.0
+        gaps = 0
+        jitter = []
+        for offsets, times in self.runs:
+            steps += len(times)
+            if len(times) < 2:
+                continue
+            stepping += times[-1] - times[0]
+            gaps += len(times) - 1
+            for index in range(1, len(times)):
+                jitter.append(abs((times[index] - times[index - 1]) - (offsets[index] - offsets[index - 1])))
+        return {'steps': steps, 'elapsed': round(elapsed, 3),
+                'stepspersecond': round(gaps / stepping, 2) if stepping else None,
+                'jitterp50': microseconds(percentile(jitter, 0.5)), 'jitterp99': microseconds(percentile(jitter, 0.99)),
+                'jittermax': microseconds(max(jitter) if jitter else None),
+                'cpuperstep': microseconds(cpu / steps) if steps else None}
+
+
+def deenergised(gpio, pins, after):
+    """Time of the first write at or after **after** that leaves all of **pins** at 0, None if they never are"""
+    state = {pin: gpio.pins.get(pin, 0) for pin in pins}
+    for timestamp, pin, value in gpio.events:
+        if pin in state:
+            state[pin] = value
+            if timestamp >= after and not any(state.values()):
+                return timestamp
+    return None
+
+
+def stepsafter(gpio, pins, after, window=0.0002):
+    """Number of steps written to **pins** after **after**, grouped as the fake GPIO layer's steptimes() does. A
+    write that leaves all of the coils off (the de-energise of a stop) is not a step."""
+    state = {}
+    steps = []
+    for timestamp, pin, value in gpio.events:
+        if pin in pins and state.get(pin) != value:
+            state[pin] = value
+            energised = any(state.get(coil, 0) for coil in pins)
+            if not steps or timestamp - steps[-1][0] > window:
+                steps.append((timestamp, energised))
+            else:
+                steps[-1] = (steps[-1][0], energised)
+    return len([timestamp for timestamp, energised in steps if timestamp > after and energised])
+
+
+def busy(running):
+    """CPU load for the --load option"""
+    while running.is_set():
+        pass
+
+
+def gitcommit():
+    """Short hash of the checked out commit, None if it cannot be read"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True, text=True,
+                              check=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def limitcase(gpio, stepper, recorder, edges):
+    """Drive **stepper** onto its maximum switch and return the measurement with the time from the switch closing to
+    the coils being switched off, **edges** collects the switch edges driven by the simulator"""
+    upperlimit = stepper.upperlimit
+    stepper.upperlimit = 10 ** 6
+    result = recorder.measure(lambda: stepper.move(1000))
+    stepper.upperlimit = upperlimit
+    trips = [edge for edge, channel, value in edges if channel == stepper.channelupperlimit and value == 0]
+    if trips:
+        offtime = deenergised(gpio, stepper.coilpins(), trips[0])
+        result['latency'] = microseconds(offtime - trips[0]) if offtime else None
+    else:
+        result['latency'] = None
+    return result
+
+
+def stopcase(gpio, stepper, recorder, steps):
+    """Stop a move of **steps** steps of **stepper** part way and return the measurement with the time to switch the
+    coils off and the number of steps taken after the stop"""
+    measured = {}
+    mover = threading.Thread(target=lambda: measured.update(recorder.measure(lambda: stepper.move(steps))))
+    mover.start()
+    time.sleep(0.5)
+    stopped = time.monotonic()
+    stepper.stop()
+    mover.join()
+    settled = max((timestamp for timestamp, pin, _ in gpio.events if pin in stepper.coilpins()), default=None)
+    if settled is not None and not any(gpio.pins.get(pin, 0) for pin in stepper.coilpins()):
+        measured['latency'] = microseconds(max(settled - stopped, 0))
+    else:
+        measured['latency'] = None
+    measured['stepsafterstop'] = stepsafter(gpio, stepper.coilpins(), stopped)
+    return measured
+
+
+def runcases(engine, steps, clock='monotonic'):
+    """Run the benchmark cases and return their results. Imports the controller, so it must be called once the
+    working directory and the GPIO backend have been set. **clock** is 'monotonic' to time the steps with the
+    production MonotonicClock or 'virtual' for the simulator's clock."""
+    # pylint: disable=import-outside-toplevel
+    from app_control import settings
+    settings.update(BENCH_SETTINGS)
+    settings['step-engine'] = engine
+    import fakegpio
+    fakegpio.MAX_EVENTS = 10000000
+    edges = []
+    drive = fakegpio.drive
+
+    def recordeddrive(channel, value):
+        edge = drive(channel, value)
+        edges.append((edge, channel, value))
+        return edge
+    fakegpio.drive = recordeddrive
+    import steppercontrol
+    from stepengine import make_engine, MonotonicClock
+    steppercontrol.start()
+    stepper = steppercontrol.stepperx
+    if clock == 'monotonic':
+        stepper.engine = make_engine(steppercontrol.GPIO, MonotonicClock(settings['step-spin-margin']),
+                                     stepper.coilpins())
+    recorder = Recorder(fakegpio, stepper.engine)
+    results = {}
+
+    fakegpio.reset()
+    results['move'] = recorder.measure(lambda: stepper.move(steps))
+    fakegpio.reset()
+    results['moveto'] = recorder.measure(lambda: stepper.moveto(stepper.lowerlimit + 50))
+    fakegpio.reset()
+    results['moveslow'] = recorder.measure(lambda: stepper.moveslow(3))
+    fakegpio.reset()
+    results['calibrate'] = recorder.measure(stepper.calibrate)
+
+    fakegpio.reset()
+    edges.clear()
+    results['limit'] = limitcase(fakegpio, stepper, recorder, edges)
+    stepper.moveto(stepper.lowerlimit + 20)
+
+    fakegpio.reset()
+    results['stop'] = stopcase(fakegpio, stepper, recorder, steps * 10)
+    return results
+
+
+def compare(old, new):
+    """Print the metrics of two result files side by side"""
+    print('%-10s %-15s %14s %14s' % ('case', 'metric', old.get('commit') or 'old', new.get('commit') or 'new'))
+    for case, metrics in new['results'].items():
+        for metric in CASEMETRICS:
+            if metric in metrics:
+                print('%-10s %-15s %14s %14s' % (case, metric, old['results'].get(case, {}).get(metric),
+                                                 metrics[metric]))
+
+
+def main():
+    """Run the benchmark and save the results"""
+    parser = argparse.ArgumentParser(description='Benchmark the stepper motion code against the simulated GPIO')
+    parser.add_argument('--engine', choices=('deadline', 'waveform'), default='deadline', help='step engine backend')
+    parser.add_argument('--clock', choices=('monotonic', 'virtual'), default='monotonic',
+                        help='clock timing the step engine')
+    parser.add_argument('--steps', type=int, default=80, help='steps in the move case')
+    parser.add_argument('--load', type=int, default=0, help='number of busy threads to run alongside the moves')
+    parser.add_argument('--output', help='results file, default benchmark-<version>-<time>.json')
+    parser.add_argument('--compare', help='results file to compare this run with')
+    args = parser.parse_args()
+    startdir = os.getcwd()
+    sys.path.insert(0, HERE)
+    os.environ['XY_GPIO_BACKEND'] = 'simulator'
+    os.chdir(tempfile.mkdtemp(prefix='xy-benchmark-'))
+    running = threading.Event()
+    running.set()
+    for _ in range(args.load):
+        threading.Thread(target=busy, args=(running,), daemon=True).start()
+    try:
+        results = runcases(args.engine, args.steps, args.clock)
+    finally:
+        running.clear()
+        os.chdir(startdir)
+    from app_control import VERSION  # pylint: disable=import-outside-toplevel
+    report = {'version': VERSION, 'commit': gitcommit(), 'time': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(),
+              'engine': args.engine, 'clock': args.clock, 'load': args.load, 'results': results}
+    output = args.output or 'benchmark-%s-%s.json' % (VERSION, datetime.now().strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w', encoding='utf-8') as outfile:
+        json.dump(report, outfile, indent=4)
+    for case, metrics in results.items():
+        print('%-10s %s' % (case, ', '.join('%s %s' % (metric, metrics[metric]) for metric in CASEMETRICS
+                                             if metric in metrics)))
+    print('results saved to %s' % output)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as infile:
+            compare(json.load(infile), report)
+
+
+if __name__ == '__main__':
+    main()
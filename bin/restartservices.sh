@@ -6,6 +6,7 @@ echo "
 **** stoping gunicorn and python app ****
 "
 sudo systemctl stop gunicorn.service
+sudo systemctl stop xymotion.service
 
 echo "
 **** stopping nginx ****
@@ -17,6 +18,11 @@ echo "
 "
 sudo systemctl start nginx
 
+echo "
+**** starting motion daemon ****
+"
+sudo systemctl start xymotion.service
+
 echo "
 **** starting gunicorn and python app ****
 "
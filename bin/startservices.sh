@@ -5,6 +5,9 @@
 echo "starting nginx"
 sudo systemctl start nginx
 
+echo "starting motion daemon"
+sudo systemctl start xymotion.service
+
 echo "starting gunicorn and python app"
 sudo systemctl start gunicorn.service
 
@@ -7,6 +7,7 @@ echo "
 "
 sudo systemctl status nginx > status.txt
 sudo systemctl status gunicorn.service >> status.txt
+sudo systemctl status xymotion.service >> status.txt
 cat status.txt
 echo "
 **********"
@@ -7,6 +7,11 @@ echo "
 "
 sudo systemctl stop gunicorn.service
 
+echo "
+**** stopping motion daemon ****
+"
+sudo systemctl stop xymotion.service
+
 echo "
 **** stopping nginx ****
 "
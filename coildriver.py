@@ -0,0 +1,106 @@
+"""
+Coil driver for the stepper motors.
+
+The driver sits between a StepperClass and the GPIO library. The pins and values that change between every pair of
+coil patterns in the phase table are worked out once when the driver is created, so each step only writes the coils
+that actually change. Where the GPIO library accepts a list of pins the changes are written in a single call. The
+driver keeps a shadow copy of the coil values it has written so status pages can read the coils without touching
+the hardware.
+
+Usage:
+    driver = CoilDriver(GPIO, [a, aa, b, bb], seq)
+    driver.write(seq[1])
+    print(driver.state)
+
+Running this module compares the GPIO calls and time per step of the driver against writing each coil separately,
+using the fake GPIO layer.
+"""
+import time
+from app_control import settings
+
+
+class CoilDriver:
+    """Change-only writer for the four coils of one stepper"""
+    def __init__(self, gpio, pins, seq, multiwrite=None):
+        self.gpio = gpio
+        self.pins = list(pins)
+        self.multiwrite = settings['gpio-multi-write'] if multiwrite is None else multiwrite
+        self.state = (0, 0, 0, 0)
+        self.calls = 0
+        self.transitions = {}
+        patterns = [tuple(phase) for phase in seq] + [(0, 0, 0, 0)]
+        for old in patterns:
+            for new in patterns:
+                self.transitions[(old, new)] = self.changes(old, new)
+
+    def changes(self, old, new):
+        """Return the pins and values that differ between coil patterns **old** and **new**"""
+        changed = [index for index in range(4) if old[index] != new[index]]
+        return [self.pins[index] for index in changed], [new[index] for index in changed]
+
+    def write(self, channels):
+        """Set the coils to **channels**, only the pins that change are written"""
+        channels = tuple(channels)
+        try:
+            pins, values = self.transitions[(self.state, channels)]
+        except KeyError:
+            pins, values = self.changes(self.state, channels)
+        if pins:
+            if len(pins) == 1:
+                self.gpio.output(pins[0], values[0])
+                self.calls += 1
+            elif self.multiwrite:
+                self.gpio.output(pins, values)
+                self.calls += 1
+            else:
+                for pin, value in zip(pins, values):
+                    self.gpio.output(pin, value)
+                self.calls += len(pins)
+        self.state = channels
+
+    def sync(self, channels):
+        """Record coil values written to the pins by something other than write(), e.g. a waveform"""
+        self.state = tuple(channels)
+
+    def value(self, pin):
+        """Return the last value written to **pin**"""
+        return self.state[self.pins.index(pin)]
+
+
+class CountingGpio:  # pylint: disable=too-few-public-methods
+    """Wraps a GPIO module and counts the calls to output()"""
+    def __init__(self, gpio):
+        self.gpio = gpio
+        self.calls = 0
+
+    def output(self, channels, values):
+        """Count and pass on the write"""
+        self.calls += 1
+        self.gpio.output(channels, values)
+
+
+if __name__ == '__main__':
+    import fakegpio
+    benchpins = [6, 12, 13, 16]
+    benchseq = [[1, 0, 1, 0], [1, 0, 0, 0], [1, 0, 0, 1], [0, 0, 0, 1],
+                [0, 1, 0, 1], [0, 1, 0, 0], [0, 1, 1, 0], [0, 0, 1, 0]]
+    BENCHSTEPS = 100000
+    fakegpio.setup(benchpins, fakegpio.OUT)
+    fakegpio.MAX_EVENTS = 10
+    counting = CountingGpio(fakegpio)
+    start = time.perf_counter()
+    for benchstep in range(BENCHSTEPS):
+        for benchpin, benchvalue in zip(benchpins, benchseq[benchstep % 8]):
+            counting.output(benchpin, benchvalue)
+    elapsed = time.perf_counter() - start
+    print('per coil writes: %.2f GPIO calls/step, %.2fus/step' % (counting.calls / BENCHSTEPS,
+                                                                  elapsed / BENCHSTEPS * 1e6))
+    for benchmulti in (False, True):
+        counting = CountingGpio(fakegpio)
+        driver = CoilDriver(counting, benchpins, benchseq, benchmulti)
+        start = time.perf_counter()
+        for benchstep in range(BENCHSTEPS):
+            driver.write(benchseq[benchstep % 8])
+        elapsed = time.perf_counter() - start
+        print('coil driver (multi-pin write %s): %.2f GPIO calls/step, %.2fus/step' %
+              (benchmulti, counting.calls / BENCHSTEPS, elapsed / BENCHSTEPS * 1e6))
@@ -0,0 +1,204 @@
+"""
+Fake GPIO layer that mimics the parts of the RPi.GPIO interface used by the stepper controller.
+
+The module records every pin write with a monotonic timestamp so the achieved step rate and the step timing jitter
+can be measured on a normal Linux computer without a Raspberry Pi. It can be passed anywhere the RPi.GPIO module is
+used, e.g. to the step engine or the benchmark tools.
+
+Usage:
+    import fakegpio as GPIO
+
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setup([6, 12, 13, 16], GPIO.OUT)
+    GPIO.output(6, 1)
+    print(GPIO.steptimes([6, 12, 13, 16]))
+"""
+import time
+import threading
+
+BCM = 11
+BOARD = 10
+OUT = 0
+IN = 1
+HIGH = 1
+LOW = 0
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+MAX_EVENTS = 1000000
+
+pins = {}
+events = []
+detectors = {}
+_lock = threading.Lock()
+
+
+def setwarnings(flag):
+    """Included for compatibility with RPi.GPIO, does nothing"""
+    return flag
+
+
+def setmode(mode):
+    """Included for compatibility with RPi.GPIO, does nothing"""
+    return mode
+
+
+def setup(channels, direction, pull_up_down=PUD_OFF, initial=LOW):
+    """Configure one or more pins, inputs with a pull-up resistor read as 1 until they are driven low"""
+    if not isinstance(channels, (list, tuple)):
+        channels = [channels]
+    for channel in channels:
+        if direction == IN:
+            pins[channel] = 1 if pull_up_down == PUD_UP else 0
+        else:
+            pins[channel] = initial
+
+
+def output(channels, values):
+    """Set one or more output pins, the write is recorded with a monotonic timestamp"""
+    now = time.monotonic()
+    if not isinstance(channels, (list, tuple)):
+        channels = [channels]
+        values = [values]
+    elif not isinstance(values, (list, tuple)):
+        values = [values] * len(channels)
+    with _lock:
+        for channel, value in zip(channels, values):
+            pins[channel] = int(value)
+            _record(now, channel, int(value))
+
+
+def output_wave(channels, pulses):
+    """Play a pre-built pulse train on a group of pins. Each pulse is a tuple of (values, delay in seconds), the
+    values are set and then held for the delay. The timestamps are recorded as hardware would produce them (exactly
+    on time) and the call blocks for the length of the train, as the real waveform transmitter would. Each pulse is
+    held for its delay before the next one is taken, so a train built by a generator is built as it is played."""
+    start = time.monotonic()
+    offset = 0.0
+    for values, delay in pulses:
+        with _lock:
+            for channel, value in zip(channels, values):
+                pins[channel] = int(value)
+                _record(start + offset, channel, int(value))
+        offset += delay
+        remaining = start + offset - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+def input(channel):  # pylint: disable=redefined-builtin
+    """Read the current value of a pin"""
+    return pins.get(channel, 0)
+
+
+def add_event_detect(channel, edge, callback=None, bouncetime=0):
+    """Call **callback(channel)** when **edge** is seen on **channel**, edges within **bouncetime** ms of the last
+    one passed to the callback are ignored as RPi.GPIO does"""
+    detectors[channel] = {'edge': edge, 'callback': callback, 'bouncetime': bouncetime / 1000, 'last': None}
+
+
+def remove_event_detect(channel):
+    """Stop watching **channel** for edges"""
+    detectors.pop(channel, None)
+
+
+def drive(channel, value):
+    """Drive an input pin from the test side, e.g. to close a limit switch. If the value changes and an edge detector
+    is set on the pin the callback is run in the calling thread. Returns the monotonic time of the edge so the
+    latency of the response can be measured."""
+    now = time.monotonic()
+    value = int(value)
+    old = pins.get(channel, 0)
+    pins[channel] = value
+    detector = detectors.get(channel)
+    if detector and value != old:
+        edge = RISING if value else FALLING
+        if detector['edge'] in (edge, BOTH):
+            if detector['last'] is None or now - detector['last'] >= detector['bouncetime']:
+                detector['last'] = now
+                if detector['callback']:
+                    detector['callback'](channel)
+    return now
+
+
+def bounce(channel, value, bounces=3, period=0.0005):
+    """Drive an input pin to **value** with contact bounce: the pin toggles **bounces** times **period** seconds apart
+    before settling. Returns the time of the first edge."""
+    first = drive(channel, value)
+    for _ in range(bounces):
+        time.sleep(period)
+        drive(channel, 1 - int(value))
+        time.sleep(period)
+        drive(channel, value)
+    return first
+
+
+def cleanup():
+    """Forget all pin states, edge detectors and recorded events"""
+    pins.clear()
+    detectors.clear()
+    reset()
+
+
+def _record(timestamp, channel, value):
+    """Store a write event, the oldest events are discarded once MAX_EVENTS is reached"""
+    if len(events) >= MAX_EVENTS:
+        del events[:MAX_EVENTS // 10]
+    events.append((timestamp, channel, value))
+
+
+def reset():
+    """Clear the recorded events"""
+    with _lock:
+        events.clear()
+
+
+def steptimes(channels, window=0.0002, start=0, end=None):
+    """Return the timestamps of each step written to a stepper on **channels**. A step is any change to the coil
+    pattern, writes to the separate coils that arrive within **window** seconds of each other are one step. Only the
+    events from index **start** to **end** are looked at."""
+    state = {}
+    times = []
+    for timestamp, pin, value in events[start:end]:
+        if pin in channels and state.get(pin) != value:
+            state[pin] = value
+            if not times or timestamp - times[-1] > window:
+                times.append(timestamp)
+    return times
+
+
+def timingreport(timestamps, interval):
+    """Return the achieved step rate and the jitter (in seconds) of **timestamps** against the expected
+    **interval**"""
+    if len(timestamps) < 2:
+        return {'steps': len(timestamps), 'stepspersecond': 0, 'meanjitter': 0, 'maxjitter': 0}
+    gaps = [b - a for a, b in zip(timestamps, timestamps[1:])]
+    errors = [abs(gap - interval) for gap in gaps]
+    return {'steps': len(timestamps),
+            'stepspersecond': round(len(gaps) / (timestamps[-1] - timestamps[0]), 2),
+            'meanjitter': sum(errors) / len(errors),
+            'maxjitter': max(errors)}
+
+
+class PWM:  # pylint: disable=invalid-name
+    """Stand-in for RPi.GPIO.PWM, records the duty cycle so the moving LED state can be checked"""
+    def __init__(self, channel, frequency):
+        self.channel = channel
+        self.frequency = frequency
+        self.dutycycle = 0
+
+    def start(self, dutycycle):
+        """Start the LED flashing"""
+        self.dutycycle = dutycycle
+
+    def stop(self):
+        """Stop the LED flashing"""
+        self.dutycycle = 0
+
+    def ChangeDutyCycle(self, dutycycle):  # pylint: disable=invalid-name
+        """Change the duty cycle, named to match RPi.GPIO"""
+        self.dutycycle = dutycycle
@@ -0,0 +1,18 @@
+"""
+Gunicorn settings read from the working directory, the command line options in gunicorn.service still apply.
+
+The web app is made by app:create_app() and starts the stepper controller on the first request. When a worker exits,
+on a stop or on the old workers of a HUP reload, its controller is shut down once the running move has finished (up
+to the shutdown-timeout setting) so the stage is not left with a move cut off part way. The graceful timeout gives the
+worker that long to finish. A new worker's controller waits for the old one to release the position journal (see
+positionstore) before it touches the GPIO pins, so only one worker drives the stage at a time.
+"""
+from app_control import settings
+
+graceful_timeout = settings['shutdown-timeout'] + 5
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """Shut the worker's stepper controller down"""
+    import app  # pylint: disable=import-outside-toplevel
+    app.stophardware()
@@ -10,6 +10,9 @@ Features:
     - File-based logging with rotation
     - Log level management
     - Thread-safe logging operations
+    - Queued logging: a log call only puts the record on a bounded queue, one listener thread writes the file, so
+      file writes, rollovers and slow SD card writes never hold up the motion threads
+    - Optional json lines format (log-format 'json') with the axis and event fields given in extra
 
 Exports:
     logger: Configured logger instance for use across the application
@@ -20,26 +23,114 @@ Usage:
     logger.info('Operation completed successfully')
     logger.warning('Resource threshold reached')
     logger.error('Failed to complete operation')
+    logger.info('Stopped', extra={'axis': 'x', 'event': 'stop'})
 
 Log Format:
     Timestamps, log levels, and contextual information are automatically included
     in each log entry for effective debugging and monitoring.
 
+Log Queue:
+    The queue holds **log-queue-size** records. If the listener falls that far behind, the **log-queue-policy**
+    'drop-new' drops the new record and 'drop-old' drops the oldest queued one, a log call never waits. The number of
+    records dropped is written to the log once the listener catches up. The queue is drained when the program exits.
+
 Log Files:
     Logs are stored with automatic rotation to prevent excessive disk usage
     while maintaining historical records.
 """
+import atexit
+import copy
+import json
 import os
+import queue
 import sys
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from app_control import settings
 
+# The motion daemon sets XY_LOG_FILE so it does not share (and rotate) the web app's log file
+LOG_FILE = os.environ.get('XY_LOG_FILE', settings['logfilepath'])
+
 # Ensure log directory exists
-log_dir = os.path.dirname(settings['logfilepath'])
+log_dir = os.path.dirname(LOG_FILE)
 if not os.path.exists(log_dir):
     os.makedirs(log_dir)
 
+
+class BoundedQueueHandler(QueueHandler):
+    """Puts records on a bounded queue without ever waiting, a record that does not fit is dropped using the
+    **policy** ('drop-new' or 'drop-old') and counted in **dropped**"""
+    def __init__(self, recordqueue, policy='drop-new'):
+        super().__init__(recordqueue)
+        self.policy = policy
+        self.dropped = 0
+
+    def enqueue(self, record):
+        """Queue **record**, dropping a record if the queue is full"""
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        if self.policy == 'drop-old':
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(record)
+            except (queue.Empty, queue.Full):
+                pass
+        self.dropped += 1
+
+    def prepare(self, record):
+        """Merge the arguments into the message but keep the exception, the record stays in this process so the
+        file's formatter can still format it"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class LogListener(QueueListener):
+    """Writes the queued records to the handlers, with a warning first if records have been dropped"""
+    def __init__(self, recordqueue, source, *handlers):
+        super().__init__(recordqueue, *handlers, respect_handler_level=True)
+        self.source = source
+        self.reported = 0
+
+    def handle(self, record):
+        """Write **record**, reporting any records dropped since the last report"""
+        dropped = self.source.dropped
+        if dropped != self.reported:
+            warning = logging.makeLogRecord({'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                             'msg': '%s log records dropped, the log queue was full' %
+                                                    (dropped - self.reported), 'event': 'logdrop'})
+            self.reported = dropped
+            super().handle(warning)
+        super().handle(record)
+
+    def stop(self):
+        """Write out the queued records and stop the listener thread, does nothing if it is not running"""
+        if self._thread is not None:
+            super().stop()
+
+    def enqueue_sentinel(self):
+        """Queue the stop marker, waiting for the listener to make room if the queue is full"""
+        self.queue.put(self._sentinel)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a line of json: time, level, thread and message, plus the axis and event given in the
+    extra argument of the log call"""
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'thread': record.threadName,
+                 'message': record.getMessage()}
+        for field in ('axis', 'event'):
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
 logger = logging.getLogger(settings['logappname'])
 """
 Usage:\n
@@ -53,9 +144,16 @@ if settings['loglevel'].upper() == 'DEBUG':
 else:
     logger.setLevel(logging.INFO)
 
-LogFile = RotatingFileHandler(settings['logfilepath'], maxBytes=1048576, backupCount=10)
-formatter = logging.Formatter('[%(asctime)s] - [%(levelname)s] - %(message)s')
+LogFile = RotatingFileHandler(LOG_FILE, maxBytes=1048576, backupCount=settings['log-backups'])
+if settings['log-format'] == 'json':
+    formatter = JsonFormatter()
+else:
+    formatter = logging.Formatter('[%(asctime)s] - [%(levelname)s] - %(message)s')
 LogFile.setFormatter(formatter)
-logger.addHandler(LogFile)
+logqueue = BoundedQueueHandler(queue.Queue(settings['log-queue-size']), settings['log-queue-policy'])
+logger.addHandler(logqueue)
+listener = LogListener(logqueue.queue, logqueue, LogFile)
+listener.start()
+atexit.register(listener.stop)
 logger.info('Runnng Python %s on %s', sys.version, sys.platform)
 logger.info('Logging level set to: %s', settings['loglevel'].upper())
@@ -0,0 +1,102 @@
+"""
+Reverse-seeking, paginated reader for the log files shown on the log web pages.
+
+The reader starts at the end of a log file and reads backwards in blocks, so the newest lines of a large log can be
+shown without reading the whole file into memory. Only the requested page (offset and limit, counted from the newest
+line) is returned, lines can be filtered by a substring or a log level, and when the current file runs out the reader
+carries on into the RotatingFileHandler backups (name.1, name.2, ...).
+
+Usage:
+    for line in tail('./logs/xycontrol.log', offset=0, limit=500, level='ERROR'):
+        print(line)
+"""
+import json
+import os
+import re
+
+BLOCK_SIZE = 65536
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+LEVELFIELD = re.compile(r'\[(%s)\]' % '|'.join(LEVELS))
+
+
+def logfiles(path, backups=10):
+    """Return **path** and its existing rotated backups, newest first"""
+    files = [path]
+    for backup in range(1, backups + 1):
+        backuppath = '%s.%s' % (path, backup)
+        if not os.path.exists(backuppath):
+            break
+        files.append(backuppath)
+    return files
+
+
+def reverselines(path, blocksize=BLOCK_SIZE):
+    """Generate the lines of **path** from the last to the first, reading backwards in blocks of **blocksize**
+    bytes"""
+    try:
+        logfile = open(path, 'rb')  # pylint: disable=consider-using-with
+    except FileNotFoundError:
+        return
+    with logfile:
+        logfile.seek(0, os.SEEK_END)
+        position = logfile.tell()
+        remainder = b''
+        while position > 0:
+            readsize = min(blocksize, position)
+            position -= readsize
+            logfile.seek(position)
+            block = logfile.read(readsize) + remainder
+            lines = block.split(b'\n')
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode('utf-8', errors='replace')
+        if remainder:
+            yield remainder.decode('utf-8', errors='replace')
+
+
+def linelevel(line):
+    """Return the level of **line**: the "level" of a json line, else the first [LEVEL] field (the application and
+    gunicorn formats), None if the line has no level"""
+    if line.startswith('{'):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            entry = None
+        if isinstance(entry, dict):
+            return entry.get('level') if entry.get('level') in LEVELS else None
+    found = LEVELFIELD.search(line)
+    return found.group(1) if found else None
+
+
+def matches(line, search, level):
+    """True if **line** contains **search** and is at or above **level** (lines with no level are kept)"""
+    if search and search not in line:
+        return False
+    if level:
+        found = linelevel(line)
+        if found:
+            return LEVELS.index(found) >= LEVELS.index(level)
+    return True
+
+
+def tail(path, offset=0, limit=500, search=None, level=None, backups=10):
+    """Generate up to **limit** lines of the log at **path**, newest first, skipping the first **offset** lines that
+    match the **search** substring and **level** filters. Follows into the rotated backups of the log."""
+    if level:
+        level = level.upper()
+        if level not in LEVELS:
+            level = None
+    skipped = 0
+    returned = 0
+    for logpath in logfiles(path, backups):
+        for line in reverselines(logpath):
+            if returned >= limit:
+                return
+            if not matches(line, search, level):
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            returned += 1
+            yield line
@@ -0,0 +1,108 @@
+"""
+Prometheus style metrics for the /metrics endpoint.
+
+The motion code and the web app keep their figures in simple counters and fixed bucket histograms, and register
+collectors that turn them into metric families when /metrics is scraped. Nothing is formatted until a scrape.
+
+Histogram.observe() takes no lock so it is cheap enough to call for every step: each histogram updated from the step
+loop belongs to one step engine or one axis, and only the thread running that axis' current move writes to it. A
+scrape may read a histogram part way through an update, which can leave the count one step out for that scrape.
+Counter and SharedHistogram take a lock and are for the figures written from several threads (limit switch
+callbacks, web requests).
+
+Usage:
+    latency = SharedHistogram(LATENCY_BUCKETS)
+    register(lambda: [family('xy_request_seconds', 'histogram', 'Request latency', latency.samples({'route': '/'}))])
+    latency.observe(0.002)
+    text = exposition()
+"""
+import threading
+from bisect import bisect_left
+
+TIMING_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.05)
+DURATION_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30)
+
+collectors = []
+
+
+class Counter:  # pylint: disable=too-few-public-methods
+    """Thread safe counter"""
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Add **amount** to the counter"""
+        with self.lock:
+            self.value += amount
+
+
+class Histogram:
+    """Fixed bucket histogram without a lock, for a single writer such as one axis' step loop"""
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Count **value** in its bucket"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, labels=None):
+        """Return the (suffix, labels, value) samples of the histogram: cumulative buckets, sum and count"""
+        labels = labels or {}
+        counts = list(self.counts)
+        samples = []
+        total = 0
+        for bucket, count in zip(self.buckets + ('+Inf',), counts):
+            total += count
+            samples.append(('_bucket', dict(labels, le=str(bucket)), total))
+        samples.append(('_sum', labels, self.sum))
+        samples.append(('_count', labels, total))
+        return samples
+
+
+class SharedHistogram(Histogram):
+    """Histogram written from several threads"""
+    def __init__(self, buckets):
+        super().__init__(buckets)
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """Count **value** in its bucket"""
+        with self.lock:
+            super().observe(value)
+
+
+def family(name, kind, helptext, samples):
+    """Return a metric family: **kind** is counter, gauge or histogram and **samples** a list of (suffix, labels,
+    value). Counters and gauges may give (labels, value) pairs instead."""
+    return name, kind, helptext, [sample if len(sample) == 3 else ('', sample[0], sample[1]) for sample in samples]
+
+
+def register(collector):
+    """Add a function returning a list of metric families, it is called on every scrape"""
+    collectors.append(collector)
+
+
+def formatlabels(labels):
+    """Format a labels dict as {name="value",...}"""
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels.items())
+
+
+def exposition():
+    """Collect all the registered metrics and return them in the Prometheus text format"""
+    lines = []
+    for collector in collectors:
+        for name, kind, helptext, samples in collector():
+            lines.append('# HELP %s %s' % (name, helptext))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                if value is not None:
+                    lines.append('%s%s%s %s' % (name, suffix, formatlabels(labels), value))
+    return '\n'.join(lines) + '\n'
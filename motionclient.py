@@ -0,0 +1,109 @@
+"""
+Thin client of the motion daemon for the web app.
+
+Provides the parsecontrol(), parsebatch(), statusmessage(), start(), shutdown() and snapshot that app.py otherwise
+takes from steppercontrol, so the web app can run in any number of gunicorn workers without touching the GPIO.
+Commands are sent to the daemon over its Unix socket, each web app thread keeps its own connection open. The status
+is read from the shared memory block the daemon writes, so status requests and the status stream do not talk to the
+daemon at all.
+
+If the daemon cannot be reached the command replies {"error": "motion daemon not available"}, and the status keeps
+its last values (all None before the daemon has started).
+
+Usage:
+    from motionclient import parsecontrol, parsebatch, statusmessage, snapshot
+"""
+import json
+import socket
+import threading
+from app_control import settings
+from logmanager import logger
+from metrics import register
+from sharedstatus import SharedStatusReader
+from statussnapshot import STATUSKEYS, statusfields
+
+
+class MotionClient:
+    """Sends json requests to the motion daemon on **path**, one connection per calling thread"""
+    def __init__(self, path, timeout=120):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        """Return this thread's socket file, connecting if needed"""
+        stream = getattr(self.local, 'stream', None)
+        if stream is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            stream = sock.makefile('rwb')
+            sock.close()
+            self.local.stream = stream
+        return stream
+
+    def close(self):
+        """Close this thread's connection"""
+        stream = getattr(self.local, 'stream', None)
+        self.local.stream = None
+        if stream is not None:
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    def request(self, message):
+        """Send **message** and return the daemon's reply. A connection the daemon has closed (e.g. it was
+        restarted) is reopened once."""
+        for attempt in range(2):
+            reused = getattr(self.local, 'stream', None) is not None
+            try:
+                stream = self.connection()
+                stream.write(json.dumps(message).encode('utf-8') + b'\n')
+                stream.flush()
+                reply = stream.readline()
+                if reply:
+                    return json.loads(reply)
+                raise ConnectionError('connection closed by the motion daemon')
+            except (OSError, ValueError) as err:
+                self.close()
+                if not reused or attempt:
+                    logger.error('Motion client: %s', err)
+                    break
+        return {'error': 'motion daemon not available'}
+
+
+def parsecontrol(item, command, policy=None):
+    """Run an api message in the motion daemon, see steppercontrol.parsecontrol"""
+    return client.request({'item': item, 'command': command, 'policy': policy})
+
+
+def parsebatch(commands, policy=None):
+    """Run a batch of api messages in the motion daemon, see steppercontrol.parsebatch"""
+    return client.request({'batch': commands, 'policy': policy})
+
+
+def statusmessage(since=None, timeout=None):
+    """Return the web page status from the daemon's shared status. If **since** is a snapshot version, wait up to
+    **timeout** seconds for a newer one."""
+    return statusfields(snapshot, STATUSKEYS, since, timeout)
+
+
+def start():
+    """Nothing to start, the motion daemon owns the hardware"""
+
+
+def shutdown(timeout=None):  # pylint: disable=unused-argument
+    """Close this thread's connection to the motion daemon, the daemon and the stage carry on"""
+    client.close()
+
+
+def motionmetrics():
+    """The motion daemon's metric families for the /metrics endpoint"""
+    families = client.request({'metrics': True})
+    return families if isinstance(families, list) else []
+
+
+client = MotionClient(settings['motion-socket'], settings['motion-client-timeout'])
+snapshot = SharedStatusReader(settings['motion-status-name'], settings['snapshot-interval'])
+register(motionmetrics)
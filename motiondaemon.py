@@ -0,0 +1,114 @@
+"""
+Motion daemon: runs the stepper controller in its own process, away from the web server.
+
+The daemon owns the GPIO and runs the step loops, so HTTP requests, template rendering and log pages in the gunicorn
+workers no longer compete with the step timing for the same GIL, and more than one gunicorn worker can be run. The
+web app talks to it through motionclient:
+    commands: newline delimited json over the Unix socket **motion-socket**, one reply line per request line
+        {"item": item, "command": command, "policy": policy} runs parsecontrol
+        {"batch": [messages]} runs parsebatch
+        {"metrics": true} returns the motion metric families for /metrics
+    status: each new status snapshot is written to the shared memory block **motion-status-name**
+
+Before the controller is started the process is pinned to the CPUs in **motion-cpus** (e.g. [3], empty for no
+change) and given the SCHED_FIFO priority **motion-realtime-priority** (0 to leave the normal scheduler, needs root
+or CAP_SYS_NICE) or else the **motion-nice** value, all the controller's threads inherit them. The daemon logs to
+**motion-logfilepath**.
+
+The daemon only runs when the motion-daemon setting is true, otherwise the web app runs the controller itself.
+
+Usage:
+    python motiondaemon.py
+"""
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+from app_control import settings
+
+os.environ.setdefault('XY_LOG_FILE', settings['motion-logfilepath'])
+
+from logmanager import logger  # pylint: disable=wrong-import-position
+from metrics import collectors  # pylint: disable=wrong-import-position
+from sharedstatus import SharedStatusWriter  # pylint: disable=wrong-import-position
+import steppercontrol  # pylint: disable=wrong-import-position
+
+
+def realtime():
+    """Apply the CPU affinity and scheduling priority settings to this process"""
+    try:
+        if settings['motion-cpus']:
+            os.sched_setaffinity(0, settings['motion-cpus'])
+            logger.info('Motion daemon: running on CPUs %s', sorted(os.sched_getaffinity(0)))
+        if settings['motion-realtime-priority']:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(settings['motion-realtime-priority']))
+            logger.info('Motion daemon: SCHED_FIFO priority %s', settings['motion-realtime-priority'])
+        elif settings['motion-nice']:
+            os.nice(settings['motion-nice'])
+            logger.info('Motion daemon: nice %s', settings['motion-nice'])
+    except (OSError, ValueError) as err:
+        logger.warning('Motion daemon: unable to set the CPU affinity or priority: %s', err)
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """Runs the json requests of one client connection in turn"""
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                reply = {'error': 'incorrect json message'}
+            else:
+                reply = dispatch(message)
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+def dispatch(message):
+    """Run one request from a client and return the reply"""
+    if not isinstance(message, dict):
+        return {'error': 'incorrect json message'}
+    if 'batch' in message:
+        return steppercontrol.parsebatch(message['batch'], message.get('policy'))
+    if message.get('metrics'):
+        return [family for collector in collectors for family in collector()]
+    return steppercontrol.parsecontrol(message.get('item'), message.get('command'), message.get('policy'))
+
+
+def publisher(writer):
+    """Copy each new version of the status snapshot into shared memory"""
+    version = None
+    while True:
+        version, data = steppercontrol.snapshot.wait(version, settings['snapshot-longpoll-timeout'])
+        writer.write(version, data)
+
+
+class MotionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server with a thread per client connection"""
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    if not settings['motion-daemon']:
+        logger.info('Motion daemon: the motion-daemon setting is off, the web app runs the controller')
+        sys.exit(0)
+    realtime()
+    steppercontrol.start()
+    statuswriter = SharedStatusWriter(settings['motion-status-name'], settings['motion-status-size'])
+    steppercontrol.snapshot.rebase(statuswriter.version)
+    threading.Thread(target=publisher, args=(statuswriter,), name='shared status publisher', daemon=True).start()
+    if os.path.exists(settings['motion-socket']):
+        os.unlink(settings['motion-socket'])
+    server = MotionServer(settings['motion-socket'], CommandHandler)
+    os.chmod(settings['motion-socket'], 0o660)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logger.info('Motion daemon: listening on %s', settings['motion-socket'])
+    try:
+        server.serve_forever()
+    finally:
+        steppercontrol.shutdown()
+        statuswriter.close()
+        server.server_close()
+        os.unlink(settings['motion-socket'])
+        logger.info('Motion daemon: stopped')
@@ -0,0 +1,196 @@
+"""
+Motion command queue and scheduler for the stepper axes.
+
+Each axis has one long-lived worker thread that takes motion commands from a bounded queue and runs them one at a
+time, so two requests for the same axis can never drive its coils at once and commands run in the order they were
+accepted. A command that uses both axes (e.g. xymoveto) is queued on both axes and runs once it has reached the front
+of both queues.
+
+Queue policies:
+    append: add the command to the end of the queue
+    replace: cancel the queued commands for the axes, stop the running one and then add the command (preempt)
+    merge: add the steps of a relative move to a relative move already waiting at the end of the queue, otherwise
+        append
+
+submit() returns a command ID that can be passed to status() to poll the command or to wait() to block until it has
+finished.
+
+Usage:
+    scheduler = MotionScheduler(16)
+    scheduler.addaxis('x', stepperx.stop)
+    commandid = scheduler.submit('xmove', stepperx.move, ['x'], [100], policy='merge', relative=True)
+    scheduler.wait(commandid, 30)
+"""
+import threading
+from collections import deque, OrderedDict
+from logmanager import logger
+
+POLICIES = ('append', 'replace', 'merge')
+HISTORY = 1000
+
+
+class MotionCommand:  # pylint: disable=too-few-public-methods
+    """A motion command waiting in, or taken from, the axis queues. **oncancel** is called if the command is
+    cancelled before it runs, **onpreempt** if it is preempted while running."""
+    def __init__(self, commandid, item, action, axes, args, relative, oncancel=None, onpreempt=None):
+        self.commandid = commandid
+        self.item = item
+        self.action = action
+        self.axes = list(axes)
+        self.args = list(args)
+        self.relative = relative
+        self.state = 'queued'
+        self.error = None
+        self.arrived = 0
+        self.finished = False
+        self.oncancel = oncancel
+        self.onpreempt = onpreempt
+
+    def status(self):
+        """Return the command state as a dict for the api"""
+        status = {'id': self.commandid, 'item': self.item, 'state': self.state}
+        if self.error:
+            status['error'] = self.error
+        return status
+
+
+class MotionScheduler:
+    """Per-axis command queues with one worker thread per axis"""
+    def __init__(self, maxdepth=16):
+        self.maxdepth = maxdepth
+        self.queues = {}
+        self.running = {}
+        self.stoppers = {}
+        self.commands = OrderedDict()
+        self.condition = threading.Condition()
+        self.nextid = 1
+        self.closed = False
+
+    def addaxis(self, axis, stopper):
+        """Create the queue and start the worker thread for **axis**, **stopper** is called to stop the axis when a
+        running command is preempted"""
+        self.queues[axis] = deque()
+        self.running[axis] = None
+        self.stoppers[axis] = stopper
+        worker = threading.Thread(target=self.__worker, args=(axis,), name='%s motion worker' % axis, daemon=True)
+        worker.start()
+
+    def submit(self, item, action, axes, args=(), policy='append', relative=False, oncancel=None, onpreempt=None):
+        """Queue **action(*args)** on **axes** using **policy** and return the command ID, or None if a queue is
+        full. **relative** marks a relative move whose first argument is a step count that may be merged,
+        **oncancel()** is called (with the scheduler's condition held) if the command is cancelled before it runs and
+        **onpreempt()** (also with the condition held) if it is preempted while running, so a command that can block
+        without moving an axis (e.g. a paused scan) is made to return."""
+        if policy not in POLICIES:
+            raise ValueError('unknown queue policy %s' % policy)
+        with self.condition:
+            if self.closed:
+                logger.warning('Motion queue: %s rejected, the scheduler is closed', item)
+                return None
+            if policy == 'replace':
+                for axis in axes:
+                    self.__clear(axis)
+            elif policy == 'merge' and relative and len(axes) == 1 and self.queues[axes[0]]:
+                last = self.queues[axes[0]][-1]
+                if last.relative and last.item == item and last.args[1:] == list(args[1:]):
+                    last.args[0] += args[0]
+                    logger.info('Motion queue: merged %s %s into command %s', item, args[0], last.commandid)
+                    return last.commandid
+            if any(len(self.queues[axis]) >= self.maxdepth for axis in axes):
+                logger.warning('Motion queue: %s rejected, queue full', item)
+                return None
+            command = MotionCommand(self.nextid, item, action, axes, args, relative, oncancel, onpreempt)
+            self.nextid += 1
+            self.commands[command.commandid] = command
+            while len(self.commands) > HISTORY:
+                self.commands.popitem(last=False)
+            for axis in axes:
+                self.queues[axis].append(command)
+            self.condition.notify_all()
+            return command.commandid
+
+    def status(self, commandid):
+        """Return the state of command **commandid**"""
+        command = self.commands.get(commandid)
+        if command is None:
+            return {'id': commandid, 'state': 'unknown'}
+        return command.status()
+
+    def wait(self, commandid, timeout=None):
+        """Block until command **commandid** has finished or **timeout** seconds have passed, returns its state"""
+        command = self.commands.get(commandid)
+        if command is None:
+            return {'id': commandid, 'state': 'unknown'}
+        with self.condition:
+            self.condition.wait_for(lambda: command.finished, timeout)
+        return command.status()
+
+    def depth(self, axis):
+        """Number of commands waiting or running on **axis**"""
+        return len(self.queues[axis]) + (1 if self.running[axis] else 0)
+
+    def idle(self):
+        """True if no command is waiting or running on any axis"""
+        return not any(self.depth(axis) for axis in self.queues)
+
+    def close(self):
+        """Cancel the queued commands and end the worker threads once their running commands have finished"""
+        with self.condition:
+            self.closed = True
+            for axis, queue in self.queues.items():
+                for command in list(queue):
+                    if command is not self.running[axis]:
+                        self.__finish(command, 'cancelled')
+            self.condition.notify_all()
+
+    def __clear(self, axis):
+        """Cancel the queued commands on **axis** and stop the running one, called with the condition held"""
+        for command in list(self.queues[axis]):
+            self.__finish(command, 'cancelled')
+        running = self.running[axis]
+        if running is not None:
+            if running.state == 'queued':
+                self.__finish(running, 'cancelled')
+            else:
+                if running.onpreempt is not None:
+                    running.onpreempt()
+                for runaxis in running.axes:
+                    self.stoppers[runaxis]()
+
+    def __finish(self, command, state):
+        """Mark **command** finished and take it off every queue, called with the condition held"""
+        command.state = state
+        command.finished = True
+        for axis in command.axes:
+            if command in self.queues[axis]:
+                self.queues[axis].remove(command)
+        if state == 'cancelled' and command.oncancel is not None:
+            command.oncancel()
+        self.condition.notify_all()
+
+    def __worker(self, axis):
+        """Worker thread for one axis. A command for more than one axis is run by the last worker to reach it, the
+        other workers wait for it to finish so their axes stay reserved."""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queues[axis] or self.closed)
+                if not self.queues[axis]:
+                    return
+                command = self.queues[axis].popleft()
+                self.running[axis] = command
+                command.arrived += 1
+                if command.arrived < len(command.axes):
+                    self.condition.wait_for(lambda: command.finished)
+                    self.running[axis] = None
+                    continue
+                command.state = 'running'
+            try:
+                command.action(*command.args)
+                state = 'done'
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                logger.exception('Motion queue: command %s %s failed', command.commandid, command.item)
+                command.error = str(err)
+                state = 'failed'
+            with self.condition:
+                self.__finish(command, state)
+                self.running[axis] = None
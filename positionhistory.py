@@ -0,0 +1,209 @@
+"""
+Position history of the stage, recorded into a fixed-size memory-mapped ring file.
+
+A recorder thread samples both axes **history-rate** times a second (0 pauses the recording) and writes each sample
+as one fixed-width record, so a day of history at 10 samples a second is about 15 MB and the file never grows. When
+the ring is full the oldest samples are overwritten. Each record holds:
+    time (float64 wall clock seconds, to line up with instrument data), xpos (int32), ypos (int32),
+    moving (uint8, bit 0 x moving, bit 1 y moving),
+    switches (uint8, bit 0 x min switch closed, bit 1 x max, bit 2 y min, bit 3 y max)
+
+The header holds the number of samples ever written, which the recorder updates after each record, so query() can be
+run on the file from any process (the web app reads the motion daemon's history) without a lock. The file is left to
+the operating system to write back, the history is not needed to recover the stage after a power cut.
+
+query() returns the samples of a time range downsampled to at most **points** buckets of equal sample count. Each
+bucket gives the time of its first sample, the lowest and highest x and y positions in it, and the moving and switch
+bits set by any of its samples, so a short move or a switch touch is never lost between two points.
+
+Usage:
+    history = PositionHistory('positions.history', 864000)
+    history.start(lambda: (stepperx.position, steppery.position, moving, switches))
+    history.stop()
+
+    data = query('positions.history', time.time() - 3600, time.time(), 500)
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from app_control import settings
+from logmanager import logger
+
+HEADER = struct.Struct('<4sHIQ')
+RECORD = struct.Struct('<diiBB')
+MAGIC = b'XYPH'
+FORMAT_VERSION = 1
+DATA_OFFSET = 32
+COUNT_OFFSET = 10
+COUNT = struct.Struct('<Q')
+CHUNK = 65536
+FIELDS = ('time', 'xmin', 'xmax', 'ymin', 'ymax', 'moving', 'switches')
+
+
+class PositionHistory:
+    """Memory-mapped ring file of the last **capacity** position samples"""
+    def __init__(self, path, capacity=864000):
+        self.path = path
+        self.capacity = capacity
+        self.count = 0
+        self.running = False
+        self.thread = None
+        self.file = None
+        self.map = None
+        self.open()
+
+    def open(self):
+        """Open the history file, creating or re-creating it if it is missing or has a different capacity"""
+        size = DATA_OFFSET + self.capacity * RECORD.size
+        valid = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            with open(self.path, 'rb') as history:
+                magic, version, capacity, _ = HEADER.unpack(history.read(HEADER.size))
+            valid = magic == MAGIC and version == FORMAT_VERSION and capacity == self.capacity
+        if not valid:
+            logger.info('Position history: creating %s with room for %s samples', self.path, self.capacity)
+            temppath = self.path + '.tmp'
+            with open(temppath, 'wb') as history:
+                history.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.capacity, 0).ljust(DATA_OFFSET, b'\0'))
+                history.truncate(size)
+            os.replace(temppath, self.path)
+        self.file = open(self.path, 'r+b')  # pylint: disable=consider-using-with
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.count = COUNT.unpack_from(self.map, COUNT_OFFSET)[0]
+
+    def record(self, xpos, ypos, moving, switches, timestamp=None):
+        """Write one sample, overwriting the oldest once the ring is full"""
+        offset = DATA_OFFSET + (self.count % self.capacity) * RECORD.size
+        RECORD.pack_into(self.map, offset, time.time() if timestamp is None else timestamp, xpos, ypos, moving,
+                         switches)
+        self.count += 1
+        COUNT.pack_into(self.map, COUNT_OFFSET, self.count)
+
+    def start(self, sampler):
+        """Start the recorder thread, **sampler()** returns the (xpos, ypos, moving, switches) of a sample"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.__recorder, args=(sampler,), name='position history',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the recorder thread and close the file"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.map.close()
+        self.file.close()
+
+    def __recorder(self, sampler):
+        """Recorder thread: take a sample every 1 / history-rate seconds on a fixed schedule"""
+        due = time.monotonic()
+        while self.running:
+            rate = settings['history-rate']
+            if not rate:
+                time.sleep(0.5)
+                due = time.monotonic()
+                continue
+            self.record(*sampler())
+            due = max(due + 1 / rate, time.monotonic() - 1)
+            time.sleep(max(due - time.monotonic(), 0))
+
+
+def readrange(view, capacity, first, last):
+    """Return the records with sample numbers **first** to **last** - 1 as bytes, joining the two ends of the ring
+    if the range wraps"""
+    start = first % capacity
+    length = last - first
+    end = min(start + length, capacity)
+    data = view[DATA_OFFSET + start * RECORD.size:DATA_OFFSET + end * RECORD.size]
+    if start + length > capacity:
+        data += view[DATA_OFFSET:DATA_OFFSET + (start + length - capacity) * RECORD.size]
+    return data
+
+
+def timeat(view, capacity, sample):
+    """Return the time of sample number **sample**"""
+    return struct.unpack_from('<d', view, DATA_OFFSET + (sample % capacity) * RECORD.size)[0]
+
+
+def bisect(view, capacity, low, high, timestamp, right=False):
+    """Return the first sample number from **low** to **high** with a time after **timestamp** (at or after it unless
+    **right**)"""
+    while low < high:
+        middle = (low + high) // 2
+        sampletime = timeat(view, capacity, middle)
+        if sampletime < timestamp or (right and sampletime == timestamp):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def summarise(view, capacity, first, last):
+    """Return the bucket of samples **first** to **last** - 1 as the values of FIELDS, read CHUNK samples at a time
+    so a large bucket does not unpack the whole range at once"""
+    summary = None
+    for chunkstart in range(first, last, CHUNK):
+        data = readrange(view, capacity, chunkstart, min(chunkstart + CHUNK, last))
+        columns = list(zip(*RECORD.iter_unpack(data)))
+        moving = switches = 0
+        for bits in set(columns[3]):
+            moving |= bits
+        for bits in set(columns[4]):
+            switches |= bits
+        chunk = [columns[0][0], min(columns[1]), max(columns[1]), min(columns[2]), max(columns[2]), moving, switches]
+        if summary is None:
+            summary = chunk
+        else:
+            summary = [summary[0], min(summary[1], chunk[1]), max(summary[2], chunk[2]), min(summary[3], chunk[3]),
+                       max(summary[4], chunk[4]), summary[5] | chunk[5], summary[6] | chunk[6]]
+    return summary
+
+
+def buckets(view, start, end, points):
+    """Return the number of samples of the history file mapped in **view** from time **start** to **end** and the
+    summaries of at most **points** buckets of them, None if **view** does not hold a history file"""
+    if len(view) < DATA_OFFSET:
+        return None
+    magic, version, capacity, count = HEADER.unpack_from(view, 0)
+    if magic != MAGIC or version != FORMAT_VERSION or len(view) != DATA_OFFSET + capacity * RECORD.size:
+        return None
+    first = max(count - capacity, 0)
+    if start is not None:
+        first = bisect(view, capacity, first, count, start)
+    last = count if end is None else bisect(view, capacity, first, count, end, right=True)
+    samples = last - first
+    total = min(max(points, 1), samples)
+    bounds = [first + bucket * samples // total for bucket in range(total + 1)] if total else []
+    summaries = [(low, summarise(view, capacity, low, high)) for low, high in zip(bounds, bounds[1:])]
+    # Buckets holding samples the recorder overwrote while the range was being read are left out
+    overwritten = COUNT.unpack_from(view, COUNT_OFFSET)[0] - capacity
+    return samples, [summary for low, summary in summaries if low >= overwritten]
+
+
+def query(path, start=None, end=None, points=500):
+    """Return the samples of **path** from time **start** to **end** (default all of the history) downsampled to at
+    most **points** buckets, as a dict of lists named in FIELDS plus the number of samples in the range"""
+    result = {'samples': 0, **{field: [] for field in FIELDS}}
+    try:
+        history = open(path, 'rb')  # pylint: disable=consider-using-with
+    except FileNotFoundError:
+        return result
+    with history:
+        try:
+            view = mmap.mmap(history.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return result
+        with view:
+            found = buckets(view, start, end, points)
+    if found is None:
+        return result
+    result['samples'], summaries = found
+    for summary in summaries:
+        for field, value in zip(FIELDS, summary):
+            result[field].append(value)
+    return result
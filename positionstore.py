@@ -0,0 +1,195 @@
+"""
+Crash-safe position journal for the stepper axes.
+
+Positions are written as small fixed-size records into a memory-mapped ring file instead of rewriting the whole
+settings.json after every move. Each record holds a sequence number, a timestamp, the axis name, the position and a
+CRC32, so a record torn by a power cut is ignored on recovery and the previous good record is used instead. When
+the ring is full the oldest records are overwritten, which keeps the file at a fixed size with nothing to compact.
+
+A writer thread records the position of each watched axis at the **position-journal-interval** cadence, so a long
+move is journalled while it is running, and checkpoints the positions into settings.json (written atomically) every
+**position-checkpoint-interval** seconds.
+
+The process that opens the journal owns the stage. It takes an exclusive lock on a lock file beside the journal
+before the journal is read, and keeps it until stop() has journalled the final positions. A second process (e.g. the
+new worker of a gunicorn reload while the old worker finishes its move) waits up to the shutdown-timeout setting
+(+ 5 s) for the owner to shut down, so it neither recovers a position from part way through a move nor drives the
+coils of the other process.
+
+Usage:
+    store = PositionStore('positions.journal')
+    position = store.recover('x', settings['xposition'])
+    store.watch('x', lambda: stepperx.position)
+    store.start()
+    store.record('x', 123)
+"""
+import os
+import mmap
+import struct
+import threading
+import time
+import zlib
+from app_control import settings, writesettings
+from logmanager import logger
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+HEADER = struct.Struct('<4sHI')
+RECORD = struct.Struct('<Qd1siI')
+MAGIC = b'XYPJ'
+FORMAT_VERSION = 1
+DATA_OFFSET = 16
+
+
+class JournalBusyError(RuntimeError):
+    """Raised when another process still owns the position journal after the wait"""
+
+
+class PositionStore:
+    """Fixed-record, memory-mapped ring journal of axis positions"""
+    def __init__(self, path, capacity=4096):
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.watched = {}
+        self.journalled = {}
+        self.checkpointed = {}
+        self.sequence = 0
+        self.running = False
+        self.map = None
+        self.file = None
+        self.ownerfile = None
+        self.own()
+        self.open()
+
+    def own(self):
+        """Take the exclusive lock on the journal's lock file, waiting up to shutdown-timeout + 5 seconds for another
+        process to release it. Raises JournalBusyError if it is not released in time. No lock is taken where fcntl
+        is not available."""
+        if fcntl is None:
+            return
+        self.ownerfile = open(self.path + '.lock', 'a+b')  # pylint: disable=consider-using-with
+        deadline = time.monotonic() + settings['shutdown-timeout'] + 5
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(self.ownerfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError as err:
+                if time.monotonic() > deadline:
+                    self.ownerfile.close()
+                    self.ownerfile = None
+                    raise JournalBusyError('%s is owned by another process' % self.path) from err
+                if not waiting:
+                    logger.warning('Position journal: waiting for another process to release %s', self.path)
+                    waiting = True
+                time.sleep(0.1)
+
+    def disown(self):
+        """Release the lock on the journal's lock file"""
+        if self.ownerfile is not None:
+            fcntl.flock(self.ownerfile, fcntl.LOCK_UN)
+            self.ownerfile.close()
+            self.ownerfile = None
+
+    def open(self):
+        """Open the journal file, creating or re-creating it if it is missing or not a valid journal"""
+        size = DATA_OFFSET + self.capacity * RECORD.size
+        valid = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            with open(self.path, 'rb') as journal:
+                magic, version, capacity = HEADER.unpack(journal.read(HEADER.size))
+            valid = magic == MAGIC and version == FORMAT_VERSION and capacity == self.capacity
+        if not valid:
+            logger.info('Position journal: creating %s', self.path)
+            temppath = self.path + '.tmp'
+            with open(temppath, 'wb') as journal:
+                journal.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.capacity).ljust(DATA_OFFSET, b'\0'))
+                journal.write(b'\0' * self.capacity * RECORD.size)
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.replace(temppath, self.path)
+        self.file = open(self.path, 'r+b')  # pylint: disable=consider-using-with
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.sequence = max([record[0] for record in self.records()] + [0])
+
+    def records(self):
+        """Return every record in the journal that passes its CRC check as (sequence, time, axis, position)"""
+        found = []
+        for slot in range(self.capacity):
+            offset = DATA_OFFSET + slot * RECORD.size
+            sequence, timestamp, axis, position, crc = RECORD.unpack_from(self.map, offset)
+            if sequence and crc == zlib.crc32(self.map[offset:offset + RECORD.size - 4]):
+                found.append((sequence, timestamp, axis.decode('ascii'), position))
+        return found
+
+    def recover(self, axis, default):
+        """Return the last journalled position of **axis**, or **default** if the journal has no record of it"""
+        axisrecords = [record for record in self.records() if record[2] == axis]
+        if not axisrecords:
+            return default
+        _, timestamp, _, position = max(axisrecords)
+        logger.info('Position journal: recovered %s position %s saved %s', axis, position,
+                    time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(timestamp)))
+        self.journalled[axis] = position
+        return position
+
+    def record(self, axis, position):
+        """Append a record of **position** for **axis** and flush it to disk"""
+        with self.lock:
+            self.sequence += 1
+            offset = DATA_OFFSET + (self.sequence % self.capacity) * RECORD.size
+            data = RECORD.pack(self.sequence, time.time(), axis.encode('ascii'), int(position), 0)[:-4]
+            self.map[offset:offset + RECORD.size] = data + struct.pack('<I', zlib.crc32(data))
+            pagestart = offset - offset % mmap.ALLOCATIONGRANULARITY
+            self.map.flush(pagestart, min(mmap.ALLOCATIONGRANULARITY * 2, len(self.map) - pagestart))
+            self.journalled[axis] = position
+
+    def watch(self, axis, getter):
+        """Journal the value returned by **getter()** for **axis** whenever it changes"""
+        self.watched[axis] = getter
+
+    def start(self):
+        """Start the writer thread"""
+        if self.running:
+            return
+        self.running = True
+        writer = threading.Thread(target=self.__writer, name='position journal', daemon=True)
+        writer.start()
+
+    def stop(self):
+        """Stop the writer thread, journal the final positions, checkpoint them into the settings file and release
+        the journal to the next owner"""
+        self.running = False
+        self.flush()
+        self.checkpoint()
+        self.disown()
+
+    def flush(self):
+        """Journal the position of every watched axis that has moved since it was last journalled"""
+        for axis, getter in self.watched.items():
+            position = getter()
+            if self.journalled.get(axis) != position:
+                self.record(axis, position)
+
+    def checkpoint(self):
+        """Copy the journalled positions into the settings and write the settings file if any have changed since the
+        last checkpoint"""
+        journalled = dict(self.journalled)
+        for axis, position in journalled.items():
+            settings['%sposition' % axis] = position
+        if journalled != self.checkpointed:
+            writesettings()
+            self.checkpointed = journalled
+
+    def __writer(self):
+        """Writer thread: journal moved axes every interval and checkpoint the settings file now and then"""
+        lastcheckpoint = time.monotonic()
+        while self.running:
+            time.sleep(settings['position-journal-interval'])
+            self.flush()
+            if time.monotonic() - lastcheckpoint > settings['position-checkpoint-interval']:
+                lastcheckpoint = time.monotonic()
+                self.checkpoint()
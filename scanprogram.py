@@ -0,0 +1,208 @@
+"""
+Server-side scan programs for the X-Y stage.
+
+A scan program is uploaded in one api call and run by the controller, so a raster of hundreds of points no longer
+needs an xmoveto/ymoveto pair and a status poll per point. The program is either a list of waypoints or a raster
+grid, each point can have a dwell time. Progress (current point, points done, ETA) is reported in the api status
+and the scan can be paused, resumed or aborted.
+
+Program formats:
+    waypoints: {"points": [[x, y], [x, y, dwell], ...], "dwell": default dwell seconds}
+    raster: {"raster": {"x0": x, "y0": y, "x1": x, "y1": y, "xstep": n, "ystep": n, "serpentine": true},
+             "dwell": seconds}
+
+The positions and steps are whole numbers of half steps and the raster steps must be more than 0.
+
+In a raster the x axis is scanned along each row and y steps between rows, a serpentine raster reverses every other
+row so the stage does not fly back to the start of each row.
+
+Usage:
+    scanner = ScanRunner(xymoveto, stopall, lambda: (stepperx.position, steppery.position), snapshot.publish)
+    points = buildpoints(program, limits)
+    scanner.run(points)
+"""
+import threading
+import time
+from apiargs import wholenumber
+from logmanager import logger
+
+
+class ScanError(ValueError):
+    """Raised when a scan program is badly formed or outside the limits of the stage"""
+
+
+def _whole(value, name):
+    """Return **value** if it is a whole number, raises a ScanError naming the **name** of the value if not"""
+    try:
+        return wholenumber(value)
+    except ValueError as err:
+        raise ScanError('%s must be a whole number, not %r' % (name, value)) from err
+
+
+def _steprange(start, stop, step, axis):
+    """range() from **start** towards **stop** in steps of **step** in either direction, without **stop**. The
+    step must be a whole number more than 0, **axis** names the values in the error."""
+    start = _whole(start, '%s0' % axis)
+    stop = _whole(stop, '%s1' % axis)
+    step = _whole(step, '%sstep' % axis)
+    if step <= 0:
+        raise ScanError('%sstep must be more than 0' % axis)
+    return range(start, stop, step if stop >= start else -step)
+
+
+def _range(start, stop, step, axis):
+    """Inclusive range from **start** to **stop** in steps of **step** in either direction"""
+    values = list(_steprange(start, stop, step, axis))
+    values.append(stop)
+    return values
+
+
+def _waypoints(program, dwell):
+    """(x, y, dwell) points of a waypoint program, **dwell** is the default dwell of a point"""
+    points = []
+    for point in program['points']:
+        if len(point) not in (2, 3):
+            raise ScanError('waypoints must be [x, y] or [x, y, dwell]')
+        points.append((_whole(point[0], 'waypoint x'), _whole(point[1], 'waypoint y'),
+                       float(point[2]) if len(point) == 3 else dwell))
+    return points
+
+
+def _raster(raster, dwell, maxpoints):
+    """(x, y, dwell) points of a raster grid, row by row. The size of the grid is checked against **maxpoints**
+    before any point is built, so a huge grid is refused without using up the memory of the controller."""
+    try:
+        count = ((len(_steprange(raster['x0'], raster['x1'], raster['xstep'], 'x')) + 1) *
+                 (len(_steprange(raster['y0'], raster['y1'], raster['ystep'], 'y')) + 1))
+        if count > maxpoints:
+            raise ScanError('scan program has %s points, the maximum is %s' % (count, maxpoints))
+        columns = _range(raster['x0'], raster['x1'], raster['xstep'], 'x')
+        rows = _range(raster['y0'], raster['y1'], raster['ystep'], 'y')
+    except KeyError as err:
+        raise ScanError('raster is missing %s' % err) from err
+    points = []
+    for rowindex, yposition in enumerate(rows):
+        row = columns
+        if raster.get('serpentine', True) and rowindex % 2:
+            row = list(reversed(columns))
+        points.extend((xposition, yposition, dwell) for xposition in row)
+    return points
+
+
+def buildpoints(program, limits, maxpoints=10000):
+    """Return the list of (x, y, dwell) points of **program**. **limits** is ((xmin, xmax), (ymin, ymax)), a
+    ScanError is raised if the program is badly formed, too long or has a point outside the limits."""
+    if not isinstance(program, dict):
+        raise ScanError('scan program must be a json object')
+    dwell = float(program.get('dwell', 0))
+    if 'points' in program:
+        points = _waypoints(program, dwell)
+    elif 'raster' in program:
+        points = _raster(program['raster'], dwell, maxpoints)
+    else:
+        raise ScanError('scan program needs "points" or "raster"')
+    if not points:
+        raise ScanError('scan program has no points')
+    if len(points) > maxpoints:
+        raise ScanError('scan program has %s points, the maximum is %s' % (len(points), maxpoints))
+    (xmin, xmax), (ymin, ymax) = limits
+    for xposition, yposition, _ in points:
+        if not (xmin <= xposition <= xmax and ymin <= yposition <= ymax):
+            raise ScanError('point %s, %s is outside the limits' % (xposition, yposition))
+    return points
+
+
+class ScanRunner:
+    """Runs one scan program at a time and keeps its progress, **onchange** is called when the progress changes"""
+    def __init__(self, mover, stopper, position, onchange=None):
+        self.mover = mover
+        self.stopper = stopper
+        self.position = position
+        self.onchange = onchange or (lambda: None)
+        self.state = 'idle'
+        self.index = 0
+        self.total = 0
+        self.started = 0.0
+        self.movingtime = 0.0
+        self.resumeevent = threading.Event()
+        self.abortevent = threading.Event()
+
+    def run(self, points):
+        """Run the scan, blocking until it has finished, been aborted or stopped. Run by the motion scheduler so the
+        scan holds both axes for its whole length."""
+        self.index = 0
+        self.total = len(points)
+        self.started = time.time()
+        self.movingtime = 0.0
+        self.abortevent.clear()
+        self.resumeevent.set()
+        self.state = 'running'
+        self.onchange()
+        logger.info('Scan: starting %s points', self.total)
+        for xposition, yposition, dwell in points:
+            self.resumeevent.wait()
+            if self.abortevent.is_set():
+                break
+            pointstart = time.monotonic()
+            self.mover(xposition, yposition)
+            if self.abortevent.is_set():
+                break
+            if self.position() != (xposition, yposition):
+                logger.warning('Scan: stopped at point %s, position %s is not %s, %s', self.index, self.position(),
+                               xposition, yposition)
+                self.state = 'stopped'
+                self.onchange()
+                return
+            if dwell > 0:
+                self.abortevent.wait(dwell)
+            self.movingtime += time.monotonic() - pointstart
+            self.index += 1
+            self.onchange()
+        self.state = 'aborted' if self.abortevent.is_set() else 'complete'
+        self.onchange()
+        logger.info('Scan: %s after %s of %s points', self.state, self.index, self.total)
+
+    def queue(self):
+        """Mark a scan as waiting in the motion queue, so a second scan is refused until it has run"""
+        self.state = 'queued'
+        self.onchange()
+
+    def cancel(self, state='cancelled'):
+        """Take back a queued scan that will not run (cancelled in the motion queue or not accepted by it), its state
+        becomes **state**"""
+        if self.state == 'queued':
+            self.state = state
+            self.onchange()
+
+    def pause(self):
+        """Pause the scan once the current point (and its dwell) is finished"""
+        if self.state == 'running':
+            self.resumeevent.clear()
+            self.state = 'paused'
+            self.onchange()
+
+    def resume(self):
+        """Resume a paused scan"""
+        if self.state == 'paused':
+            self.state = 'running'
+            self.resumeevent.set()
+            self.onchange()
+
+    def abort(self):
+        """Abort the scan, stopping the current move"""
+        if self.state in ('running', 'paused'):
+            self.abortevent.set()
+            self.resumeevent.set()
+            self.stopper()
+
+    def eta(self):
+        """Estimated seconds to the end of the scan from the average time per point so far"""
+        if self.state not in ('running', 'paused') or self.index == 0:
+            return None
+        return round(self.movingtime / self.index * (self.total - self.index), 1)
+
+    def status(self):
+        """Return the scan progress for the api status, **started** is the time the scan started (seconds since the
+        epoch)"""
+        return {'state': self.state, 'index': self.index, 'total': self.total, 'eta': self.eta(),
+                'started': round(self.started, 1)}
@@ -0,0 +1,128 @@
+"""
+Typed settings store with validation, change notifications and debounced saving.
+
+The store is the settings dict itself, so the rest of the code keeps reading settings['name']. Changes that come from
+outside the program (the api) go through change(), which checks every value against the schema before any of them is
+applied, so a bad message changes nothing:
+    type: each value must have the type of the setting's default value, or the schema's {'type': float} for a number
+        setting with a whole number default (an int is accepted for a float setting)
+    schema: optional per setting limits, {'min': n, 'max': n} for numbers and {'choices': (...)} for any value, and
+        {'normalise': function} for a string setting whose values are normalised (e.g. str.upper) before the check
+    checks: functions of the changed settings that return an error message for combinations that do not work, such as
+        a minimum position above the maximum
+
+After a change is applied the subscribers of each changed setting are called with (name, value), so running code such
+as the stepper axes picks up the new value without a restart. save() writes the file **delay** seconds after the first
+unsaved change, so a burst of api changes is written once.
+
+Usage:
+    settings = SettingsStore(defaults, schema, checks, writer, 2.0)
+    settings.subscribe(['x-max-speed'], lambda name, value: print(name, value))
+    settings.change({'x-max-speed': 300})
+    settings.save()
+"""
+import threading
+
+TYPENAMES = {bool: 'true or false', int: 'a whole number', float: 'a number', str: 'a string', list: 'a list',
+             dict: 'a json object'}
+
+
+class SettingsError(ValueError):
+    """A settings change that does not pass the schema"""
+
+
+class SettingsStore(dict):
+    """Settings dict with a schema: **defaults** gives the names and types of the settings, **schema** the limits of
+    some of them and **checks** the functions that check combinations of settings. **writer** writes the file."""
+    def __init__(self, defaults, schema=None, checks=(), writer=None, delay=2.0):
+        super().__init__(defaults)
+        self.schema = schema or {}
+        self.types = {name: self.schema.get(name, {}).get('type', type(value)) for name, value in defaults.items()}
+        self.checks = list(checks)
+        self.writer = writer
+        self.delay = delay
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def normalise(self, name, value):
+        """Return **value** normalised by the schema's normalise function of setting **name**, if it has one and the
+        value is a string"""
+        function = self.schema.get(name, {}).get('normalise')
+        if function is not None and isinstance(value, str):
+            return function(value)
+        return value
+
+    def check(self, name, value):
+        """Return the error message for setting **name** to **value**, None if the value is valid"""
+        if name not in self.types:
+            return 'unknown setting %s' % name
+        value = self.normalise(name, value)
+        expected = self.types[name]
+        if expected is float and isinstance(value, int) and not isinstance(value, bool):
+            value = float(value)
+        if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+            return '%s must be %s' % (name, TYPENAMES.get(expected, expected.__name__))
+        rules = self.schema.get(name, {})
+        if 'choices' in rules and value not in rules['choices']:
+            return '%s must be one of %s' % (name, ', '.join(str(choice) for choice in rules['choices']))
+        if 'min' in rules and value < rules['min']:
+            return '%s must be at least %s' % (name, rules['min'])
+        if 'max' in rules and value > rules['max']:
+            return '%s must be at most %s' % (name, rules['max'])
+        return None
+
+    def change(self, changes):
+        """Validate the **changes** dict and apply it, then call the subscribers of the changed settings. Raises
+        SettingsError without changing anything if any value is invalid."""
+        if not isinstance(changes, dict):
+            raise SettingsError('settings changes must be a json object')
+        changes = {name: self.normalise(name, value) for name, value in changes.items()}
+        errors = [error for error in (self.check(name, value) for name, value in changes.items()) if error]
+        if not errors:
+            candidate = {**self, **changes}
+            errors = [error for error in (check(candidate) for check in self.checks) if error]
+        if errors:
+            raise SettingsError('; '.join(errors))
+        changed = {}
+        with self.lock:
+            for name, value in changes.items():
+                if self.types[name] is float:
+                    value = float(value)
+                if self[name] != value:
+                    self[name] = value
+                    changed[name] = value
+        for name, value in changed.items():
+            for callback in self.subscribers.get(name, []):
+                callback(name, value)
+        return changed
+
+    def subscribe(self, names, callback):
+        """Call **callback(name, value)** when any of the settings **names** is changed by change()"""
+        for name in names:
+            self.subscribers.setdefault(name, []).append(callback)
+
+    def unsubscribe(self, names, callback):
+        """Stop calling **callback** for the settings **names**"""
+        for name in names:
+            if callback in self.subscribers.get(name, []):
+                self.subscribers[name].remove(callback)
+
+    def save(self):
+        """Write the settings file in **delay** seconds, unless a write is already waiting which will include this
+        change"""
+        with self.lock:
+            if self.timer is not None:
+                return
+            self.timer = threading.Timer(self.delay, self.flush)
+            self.timer.name = 'settings writer'
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Write the settings file now if a save is waiting"""
+        with self.lock:
+            timer, self.timer = self.timer, None
+        if timer is not None:
+            timer.cancel()
+            self.writer()
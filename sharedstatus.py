@@ -0,0 +1,124 @@
+"""
+Status snapshot shared between the motion daemon and the web app processes through shared memory.
+
+The motion daemon writes each new version of its status snapshot into a named shared memory block as json, and any
+number of web app workers read it without a round trip to the daemon. The block starts with a sequence number, the
+snapshot version and the length of the json. The writer makes the sequence odd while it is writing and even when it
+has finished, a reader that sees an odd sequence, or a different sequence after copying the json, reads again.
+
+The block is kept when the daemon stops so a restarted daemon writes into the same block, the writer's **version** is
+the last version written so the daemon can carry its versions on from it and a client's ETag or long-poll version is
+never mistaken for a new status.
+
+Readers have no way to be woken by the writer, wait() checks the version every **interval** seconds.
+
+Usage:
+    writer = SharedStatusWriter('xycontrol-status', 65536)
+    writer.write(version, data)
+
+    reader = SharedStatusReader('xycontrol-status', 0.05)
+    version, data = reader.current()
+    version, data = reader.wait(version, 30)
+"""
+import json
+import struct
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from types import MappingProxyType
+from logmanager import logger
+
+SEQUENCE = struct.Struct('<Q')
+HEADER = struct.Struct('<QQI')
+
+
+def attach(name):
+    """Open an existing shared memory block without handing it to the resource tracker, which would otherwise
+    remove the block when this process exits"""
+    try:
+        return SharedMemory(name=name, track=False)  # pylint: disable=unexpected-keyword-arg
+    except TypeError:
+        memory = SharedMemory(name=name)
+        resource_tracker.unregister(memory._name, 'shared_memory')  # pylint: disable=protected-access
+        return memory
+
+
+class SharedStatusWriter:
+    """Writes status snapshots into the shared memory block **name**, used by the motion daemon"""
+    def __init__(self, name, size=65536):
+        try:
+            self.memory = attach(name)
+            if self.memory.size < size:
+                self.memory.close()
+                self.memory.unlink()
+                raise FileNotFoundError(name)
+        except FileNotFoundError:
+            self.memory = SharedMemory(name=name, create=True, size=size)
+            resource_tracker.unregister(self.memory._name, 'shared_memory')  # pylint: disable=protected-access
+        self.sequence, self.version, _ = HEADER.unpack_from(self.memory.buf, 0)
+        self.sequence += self.sequence % 2
+
+    def write(self, version, data):
+        """Store **data** as **version** of the status"""
+        payload = json.dumps(dict(data)).encode('utf-8')
+        if HEADER.size + len(payload) > self.memory.size:
+            logger.error('Shared status: %s bytes of status do not fit in the %s byte block', len(payload),
+                         self.memory.size)
+            return
+        buffer = self.memory.buf
+        self.sequence += 1
+        SEQUENCE.pack_into(buffer, 0, self.sequence)
+        buffer[HEADER.size:HEADER.size + len(payload)] = payload
+        HEADER.pack_into(buffer, 0, self.sequence, version, len(payload))
+        self.version = version
+        self.sequence += 1
+        SEQUENCE.pack_into(buffer, 0, self.sequence)
+
+    def close(self):
+        """Stop using the block, it is left in place for the next daemon"""
+        self.memory.close()
+
+
+class SharedStatusReader:
+    """Reads the status written by a SharedStatusWriter, with the same current() and wait() as StatusSnapshot. The
+    last status read is kept, so a read while the daemon has not started returns the empty version 0."""
+    def __init__(self, name, interval=0.05):
+        self.name = name
+        self.interval = interval
+        self.memory = None
+        self.state = (0, MappingProxyType({}))
+
+    def current(self):
+        """Return the current (version, status)"""
+        if self.memory is None:
+            try:
+                self.memory = attach(self.name)
+            except FileNotFoundError:
+                return self.state
+        buffer = self.memory.buf
+        for _ in range(100):
+            sequence, version, length = HEADER.unpack_from(buffer, 0)
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            if version == self.state[0]:
+                return self.state
+            payload = bytes(buffer[HEADER.size:HEADER.size + length])
+            if SEQUENCE.unpack_from(buffer, 0)[0] != sequence:
+                continue
+            try:
+                self.state = (version, MappingProxyType(json.loads(payload)))
+            except ValueError:
+                continue
+            return self.state
+        return self.state
+
+    def wait(self, since, timeout=None):
+        """Return the current (version, status) once the version is different from **since** or **timeout** seconds
+        have passed"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = self.current()
+            if state[0] != since or (deadline is not None and time.monotonic() >= deadline):
+                return state
+            time.sleep(self.interval)
@@ -0,0 +1,190 @@
+"""
+Simulated GPIO backend with a virtual X-Y stage, so the motion code can run without a Raspberry Pi.
+
+The simulator stands in for the RPi.GPIO module. Pin state, edge detection and the recorded pin writes are handled by
+the fake GPIO layer, on top of that each axis has a virtual stage that follows the coil patterns written to its
+pins: a one phase change in the half step sequence moves the stage one half step, a two phase change (a full step
+or wave drive step) moves it two, anything else (a skipped phase, a pattern that is not in the sequence, or a step
+faster than the motor's maximum step rate) is counted as a missed step and the stage does not move. The stage stops
+against hard end stops at 0 and its travel, and the limit switch inputs are driven from the stage position, so edge
+callbacks fire as they would on the real stage. The rotors start at the first phase of the sequence, where the
+controller's phase index starts.
+
+The step engine runs on the simulator's virtual clock, which runs **sim-clock-speed** times faster than real time,
+so long moves and calibrations can be run on a laptop or CI runner in a fraction of the time. The switch debounce
+time is scaled by the clock speed so the switches settle after the same number of steps as in real time.
+
+The backend is selected with the gpio-backend setting ('rpi' or 'simulator'), the XY_GPIO_BACKEND environment
+variable overrides the setting.
+
+Settings (per axis, x shown):
+    sim-x-travel: steps between the hard end stops
+    sim-x-start: stage position when the simulator starts
+    sim-x-min-switch, sim-x-max-switch: stage positions at and beyond which the limit switches are closed
+    sim-max-step-rate: fastest step rate the motors can follow (steps per second), 0 for no limit
+
+Usage:
+    GPIO = simulator(settings)
+    ...
+    print(GPIO.report())
+"""
+import threading
+import time
+import fakegpio
+from logmanager import logger
+
+HALF_STEPS = ((1, 0, 1, 0), (1, 0, 0, 0), (1, 0, 0, 1), (0, 0, 0, 1),
+              (0, 1, 0, 1), (0, 1, 0, 0), (0, 1, 1, 0), (0, 0, 1, 0))
+
+
+class VirtualClock:
+    """Clock for the step engine that runs **speed** times faster than real time"""
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.origin = time.monotonic()
+
+    def now(self):
+        """Current virtual time in seconds"""
+        return (time.monotonic() - self.origin) * self.speed
+
+    def sleepuntil(self, deadline):
+        """Block until the virtual time reaches **deadline**"""
+        remaining = (deadline - self.now()) / self.speed
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+class VirtualStage:
+    """One axis of the virtual stage, driven by the coil patterns written to its pins"""
+    def __init__(self, name, coilpins, maxpin, minpin, travel, start, minswitch, maxswitch, clock, maxrate=0):
+        self.name = name
+        self.coilpins = list(coilpins)
+        self.maxpin = maxpin
+        self.minpin = minpin
+        self.travel = travel
+        self.position = start
+        self.minswitch = minswitch
+        self.maxswitch = maxswitch
+        self.clock = clock
+        self.mininterval = 1 / maxrate if maxrate else 0
+        self.phase = 0
+        self.laststep = None
+        self.steps = 0
+        self.missed = 0
+        self.stalled = 0
+
+    def coilschanged(self, pins):
+        """Follow the new coil pattern after a write to the coil pins"""
+        pattern = tuple(pins.get(pin, 0) for pin in self.coilpins)
+        if not any(pattern):
+            return
+        if pattern not in HALF_STEPS:
+            self.miss('pattern %s is not in the sequence' % (pattern,))
+            return
+        phase = HALF_STEPS.index(pattern)
+        if phase == self.phase:
+            return
+        change = (phase - self.phase) % 8
+        self.phase = phase
+        if change not in (1, 2, 6, 7):
+            self.miss('skipped %s phases' % (min(change, 8 - change) - 1))
+            return
+        now = self.clock.now()
+        if self.laststep is not None and now - self.laststep < self.mininterval:
+            self.miss('step after %.6fs is faster than the motor can follow' % (now - self.laststep))
+            self.laststep = now
+            return
+        self.laststep = now
+        direction = change if change < 4 else change - 8
+        if not 0 <= self.position + direction <= self.travel:
+            self.stalled += 1
+            return
+        self.position += direction
+        self.steps += 1
+        self.driveswitches()
+
+    def miss(self, reason):
+        """Count a missed step"""
+        self.missed += 1
+        logger.debug('Simulator: %s axis missed a step, %s', self.name, reason)
+
+    def driveswitches(self):
+        """Set the limit switch inputs from the stage position, a closed switch reads 0"""
+        for pin, closed in ((self.minpin, self.position <= self.minswitch),
+                            (self.maxpin, self.position >= self.maxswitch)):
+            value = 0 if closed else 1
+            if fakegpio.input(pin) != value:
+                fakegpio.drive(pin, value)
+
+    def report(self):
+        """Return the stage position and counters"""
+        return {'position': self.position, 'steps': self.steps, 'missed': self.missed, 'stalled': self.stalled,
+                'minswitch': fakegpio.input(self.minpin), 'maxswitch': fakegpio.input(self.maxpin)}
+
+
+class SimulatedGPIO:
+    """Stand-in for the RPi.GPIO module that drives the virtual stages, anything not defined here (the constants,
+    setup, input, edge detection, PWM) is passed to the fake GPIO layer"""
+    def __init__(self, clock):
+        self.clock = clock
+        self.stages = {}
+        self.pinstages = {}
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        return getattr(fakegpio, name)
+
+    def addstage(self, stage):
+        """Attach a virtual stage to its coil pins"""
+        self.stages[stage.name] = stage
+        for pin in stage.coilpins:
+            self.pinstages[pin] = stage
+
+    def setup(self, channels, direction, pull_up_down=fakegpio.PUD_OFF, initial=fakegpio.LOW):
+        """Configure pins as RPi.GPIO does, a limit switch input is set from its stage's position"""
+        fakegpio.setup(channels, direction, pull_up_down, initial)
+        for stage in self.stages.values():
+            stage.driveswitches()
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=0):
+        """Watch **channel** for edges as RPi.GPIO does, **bouncetime** (ms) is on the virtual clock"""
+        fakegpio.add_event_detect(channel, edge, callback, bouncetime / self.clock.speed)
+
+    def output(self, channels, values):
+        """Set one or more output pins and move the stages whose coils were written"""
+        fakegpio.output(channels, values)
+        if not isinstance(channels, (list, tuple)):
+            channels = [channels]
+        with self.lock:
+            for stage in {self.pinstages[pin].name: self.pinstages[pin] for pin in channels
+                          if pin in self.pinstages}.values():
+                stage.coilschanged(fakegpio.pins)
+
+    def output_wave(self, channels, pulses):
+        """Play a pulse train on the virtual clock, each pulse is (values, delay in seconds). The values are set and
+        held for the delay before the next pulse is taken, so a train built by a generator is built as it is
+        played."""
+        deadline = self.clock.now()
+        for values, delay in pulses:
+            self.output(list(channels), list(values))
+            deadline += delay
+            self.clock.sleepuntil(deadline)
+
+    def report(self):
+        """Return the state of each virtual stage"""
+        return {name: stage.report() for name, stage in self.stages.items()}
+
+
+def simulator(settings):
+    """Create the simulated GPIO backend with an x and a y stage set up from **settings**"""
+    clock = VirtualClock(settings['sim-clock-speed'])
+    gpio = SimulatedGPIO(clock)
+    for axis in ('x', 'y'):
+        coilpins = [settings['%s-%s-gpio-pin' % (axis, coil)] for coil in ('a', 'aa', 'b', 'bb')]
+        gpio.addstage(VirtualStage(axis, coilpins,
+                                   settings['%s-max-gpio-pin' % axis], settings['%s-min-gpio-pin' % axis],
+                                   settings['sim-%s-travel' % axis], settings['sim-%s-start' % axis],
+                                   settings['sim-%s-min-switch' % axis], settings['sim-%s-max-switch' % axis], clock,
+                                   settings['sim-max-step-rate']))
+    logger.warning('GPIO: running on the simulator, clock speed x%s', settings['sim-clock-speed'])
+    return gpio
@@ -0,0 +1,92 @@
+"""
+Versioned, immutable status snapshot for the status endpoints.
+
+The motion loops, limit switch callbacks and scan runner publish the stage status into one snapshot when something
+changes, instead of every status request building a new dict from the live attributes. Each new snapshot gets the
+next version number so the web endpoints can answer with an ETag, reply 304 Not Modified to If-None-Match, and offer a
+long-poll that blocks until the version moves past the one the client already has.
+
+Publishing from the step loop is rate limited to one snapshot per **snapshot-interval** seconds, a forced publish
+(the default) is used for events such as a stop or a limit switch.
+
+The web page and api status messages are views of the snapshot with the STATUSKEYS and APIKEYS values, made by
+statusfields(), which works on any object with current() and wait() such as the motion daemon's shared status.
+
+Usage:
+    snapshot = StatusSnapshot()
+    snapshot.start(buildsnapshot)
+    snapshot.publish()
+    version, data = snapshot.current()
+    version, data = snapshot.wait(version, 30)
+    status = statusfields(snapshot, APIKEYS)
+"""
+import threading
+import time
+from types import MappingProxyType
+from app_control import settings
+
+STATUSKEYS = ('xpos', 'ypos', 'xminswitch', 'xmaxswitch', 'yminswitch', 'ymaxswitch', 'stepperxa', 'stepperxaa',
+              'stepperxb', 'stepperxbb', 'stepperya', 'stepperyaa', 'stepperyb', 'stepperybb')
+APIKEYS = ('xpos', 'xmoving', 'xprogress', 'ypos', 'ymoving', 'yprogress', 'xymoving', 'scan', 'homing')
+
+
+def statusfields(snapshot, keys, since=None, timeout=None):
+    """Return the **keys** values of the status in **snapshot** and its version. If **since** is a snapshot version,
+    wait up to **timeout** seconds for a newer one. Keys missing from the status (e.g. before the motion daemon has
+    published one) are None."""
+    if since is None:
+        version, data = snapshot.current()
+    else:
+        version, data = snapshot.wait(since, timeout)
+    statuslist = {key: data.get(key) for key in keys}
+    statuslist['version'] = version
+    return statuslist
+
+
+class StatusSnapshot:
+    """Holds the latest (version, read-only status) pair and wakes waiters when it changes"""
+    def __init__(self):
+        self.builder = None
+        self.condition = threading.Condition()
+        self.state = (0, MappingProxyType({}))
+        self.lastpublish = 0.0
+
+    def start(self, builder):
+        """Set the function that builds the status dict and publish the first snapshot. Publishing does nothing
+        until this has been called, so it is safe to publish while the steppers are being created."""
+        self.builder = builder
+        self.publish()
+
+    def publish(self, force=True):
+        """Build the status and, if it differs from the current snapshot, store it as the next version. When
+        **force** is False the publish is skipped if the last one was less than snapshot-interval seconds ago."""
+        if self.builder is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.lastpublish < settings['snapshot-interval']:
+            return
+        self.lastpublish = now
+        data = self.builder()
+        with self.condition:
+            version, current = self.state
+            if data != current:
+                self.state = (version + 1, MappingProxyType(data))
+                self.condition.notify_all()
+
+    def rebase(self, version):
+        """Carry on the version numbers from **version**, used by the motion daemon so its versions follow on from
+        the ones a previous daemon published"""
+        with self.condition:
+            self.state = (self.state[0] + version, self.state[1])
+            self.condition.notify_all()
+
+    def current(self):
+        """Return the current (version, status)"""
+        return self.state
+
+    def wait(self, since, timeout=None):
+        """Block until the version is different from **since** or **timeout** seconds have passed, then return
+        the current (version, status)"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.state[0] != since, timeout)
+            return self.state
@@ -0,0 +1,86 @@
+"""
+Push-based live status for the web pages using Server-Sent Events.
+
+One producer thread waits for a new version of the status snapshot, reads the stage status at most every
+**status-stream-interval** seconds and wakes the connected viewers only when something has changed, so N open
+browser tabs cost one producer instead of N pollers. The slow values (e.g. the CPU temperature) are read every
+**status-stream-slow-interval** seconds. Each viewer is sent the full status when it connects and then only the
+values that have changed, with a comment line every **status-stream-heartbeat** seconds to keep the connection open
+through proxies. The producer only runs while there is at least one viewer.
+
+Usage:
+    broadcaster = StatusBroadcaster(statusmessage, lambda: {'cputemperature': read_cpu_temperature()}, snapshot)
+    return Response(broadcaster.stream(), mimetype='text/event-stream')
+"""
+import json
+import threading
+import time
+from app_control import settings
+from logmanager import logger
+
+
+class StatusBroadcaster:  # pylint: disable=too-few-public-methods
+    """Single producer, many subscriber status stream. If a **snapshot** is given the producer sleeps until its
+    version changes, otherwise it polls **source**."""
+    def __init__(self, source, slowsource=None, snapshot=None):
+        self.source = source
+        self.slowsource = slowsource
+        self.snapshot = snapshot
+        self.condition = threading.Condition()
+        self.status = {}
+        self.version = 0
+        self.subscribers = 0
+        self.running = False
+
+    def __producer(self):
+        """Read the status at the rate limit and notify the subscribers when it changes, exits when the last
+        subscriber has gone"""
+        lastslow = -1e9
+        slow = {}
+        version = None
+        while True:
+            if self.snapshot:
+                version = self.snapshot.wait(version, settings['status-stream-slow-interval'])[0]
+            if self.slowsource and time.monotonic() - lastslow > settings['status-stream-slow-interval']:
+                lastslow = time.monotonic()
+                slow = self.slowsource()
+            status = dict(self.source(), **slow)
+            with self.condition:
+                if self.subscribers == 0:
+                    self.running = False
+                    return
+                if status != self.status:
+                    self.status = status
+                    self.version += 1
+                    self.condition.notify_all()
+            time.sleep(settings['status-stream-interval'])
+
+    def stream(self):
+        """Generator of Server-Sent Events for one viewer: the full status, then the changed values as they happen
+        and a heartbeat comment when nothing has changed"""
+        with self.condition:
+            self.subscribers += 1
+            if not self.running:
+                self.running = True
+                producer = threading.Thread(target=self.__producer, name='status stream producer', daemon=True)
+                producer.start()
+        try:
+            sent = {}
+            version = -1
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.version != version, settings['status-stream-heartbeat'])
+                    status = self.status
+                    changed = self.version != version
+                    version = self.version
+                if not changed:
+                    yield ': heartbeat\n\n'
+                    continue
+                delta = {key: value for key, value in status.items() if sent.get(key) != value}
+                sent = status
+                if delta:
+                    yield 'id: %s\ndata: %s\n\n' % (version, json.dumps(delta))
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+            logger.debug('Status stream viewer disconnected')
@@ -0,0 +1,503 @@
+"""
+Step timing engine for the stepper motors.
+
+A move is turned into a schedule of (time offset, direction) pairs before the first step is taken, the schedule is
+then played by a backend against a monotonic clock. Each step is timed against its own absolute deadline so sleep
+overshoot and thread scheduling jitter are corrected on the next step rather than added up over the move.
+
+Backends:
+    DeadlineBackend: plain Python loop, sleeps until just before each deadline then spins to the deadline
+    WaveformBackend: builds the coil patterns for a block of steps into a pulse train and hands it to the GPIO layer
+        to play, falls back to the deadline loop if the GPIO layer cannot play waveforms
+
+An axis driven by the engine must provide:
+    advance(direction): move the phase and position one step and return the coil values, or None if blocked
+    output(channels): write the coil values to the pins
+    sync(channels): record coil values the GPIO layer has written directly (waveform backend)
+    coilpins(): the list of coil pins [a, aa, b, bb]
+
+Motion profiles:
+    constant: every step at the start speed (the stepper-pulse-width setting)
+    trapezoidal: constant acceleration from the start speed up to the maximum speed and back down again
+    scurve: jerk limited acceleration, the acceleration itself ramps up and down so the motor is not jolted
+
+Usage:
+    engine = make_engine(GPIO)
+    engine.run(stepper, constantschedule(100, 1, 0.02), lambda: stepper.moving)
+    engine.run(stepper, intervalschedule(profileintervals(500, 'trapezoidal', 50, 200, 400, 2000), 1),
+               lambda: stepper.moving)
+
+Running this module on a normal Linux computer measures both backends against the fake GPIO layer.
+"""
+import heapq
+import time
+from itertools import count
+from app_control import settings
+from logmanager import logger
+from metrics import Histogram, TIMING_BUCKETS
+try:
+    import lgpio
+except ImportError:
+    lgpio = None
+
+lgpiochip = {'handle': None}
+
+
+class MonotonicClock:
+    """Wall clock used by the engine, sleeps until just before a deadline and then spins to it. **speed** is the rate
+    of the clock against real time, as for the simulator's virtual clock."""
+    speed = 1.0
+
+    def __init__(self, spin=0.0005):
+        self.spin = spin
+
+    @staticmethod
+    def now():
+        """Current monotonic time in seconds"""
+        return time.monotonic()
+
+    def sleepuntil(self, deadline):
+        """Block until **deadline** (a value of now())"""
+        remaining = deadline - time.monotonic()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while time.monotonic() < deadline:
+            pass
+
+
+def constantschedule(steps, direction, interval):
+    """Return a schedule of **steps** steps in **direction** (+1 or -1) spaced **interval** seconds apart. If steps
+    is None the schedule is an endless generator, used for seeking a limit switch."""
+    if steps is None:
+        return ((n * interval, direction) for n in count())
+    return [(n * interval, direction) for n in range(steps)]
+
+
+def intervalschedule(intervals, direction):
+    """Return a schedule from a list of per-step **intervals**, each interval is the time from the step to the
+    next one"""
+    schedule = []
+    offset = 0.0
+    for interval in intervals:
+        schedule.append((offset, direction))
+        offset += interval
+    return schedule
+
+
+def rampspeeds(profile, startspeed, maxspeed, accel, jerk):
+    """Return the speed (steps/s) of each step while accelerating from **startspeed** to **maxspeed**, the list
+    ends at the first step that reaches the maximum speed. **accel** is in steps/s² and **jerk** in steps/s³ (only
+    used by the scurve profile)."""
+    if profile == 'constant' or maxspeed <= startspeed or accel <= 0:
+        return []
+    speeds = []
+    if profile == 'scurve' and jerk > 0:
+        deltav = maxspeed - startspeed
+        peak = min(accel, (deltav * jerk) ** 0.5)
+        jerktime = peak / jerk
+        constanttime = max(0.0, deltav / peak - jerktime)
+        dt = min(0.0005, 0.1 / maxspeed)
+        elapsed = distance = 0.0
+        speed = startspeed
+        while speed < maxspeed:
+            if elapsed < jerktime:
+                acceleration = jerk * elapsed
+            elif elapsed < jerktime + constanttime:
+                acceleration = peak
+            else:
+                acceleration = max(peak - jerk * (elapsed - jerktime - constanttime), 0.0)
+            if acceleration <= 0 and elapsed > jerktime:
+                break
+            while distance >= len(speeds):
+                speeds.append(speed)
+            speed = min(maxspeed, speed + acceleration * dt)
+            distance += speed * dt
+            elapsed += dt
+        return speeds
+    speed = startspeed
+    while speed < maxspeed:
+        speeds.append(speed)
+        speed = (startspeed ** 2 + 2 * accel * len(speeds)) ** 0.5
+    return speeds
+
+
+def profileintervals(steps, profile, startspeed, maxspeed, accel, jerk=0):
+    """Return the interval after each of **steps** steps for a move that starts and ends at **startspeed** and
+    cruises at up to **maxspeed** using the acceleration **profile** ('constant', 'trapezoidal' or 'scurve'). If the
+    move is too short to reach the maximum speed the trapezoidal profile turns into a triangle and the scurve peak
+    speed is lowered so the acceleration is back to zero at the peak."""
+    if profile == 'constant' or maxspeed <= startspeed:
+        return [1 / startspeed] * steps
+    ramp = rampspeeds(profile, startspeed, maxspeed, accel, jerk)
+    if profile == 'scurve' and 2 * len(ramp) > steps:
+        low, high = startspeed, maxspeed
+        for _ in range(12):
+            middle = (low + high) / 2
+            if 2 * len(rampspeeds(profile, startspeed, middle, accel, jerk)) > steps:
+                high = middle
+            else:
+                low = middle
+        maxspeed = low
+        ramp = rampspeeds(profile, startspeed, maxspeed, accel, jerk)
+    intervals = []
+    for step in range(steps):
+        up = ramp[step] if step < len(ramp) else maxspeed
+        down = ramp[steps - 1 - step] if steps - 1 - step < len(ramp) else maxspeed
+        intervals.append(1 / max(min(up, down, maxspeed), startspeed))
+    return intervals
+
+
+def rampschedule(direction, profile, startspeed, maxspeed, accel, jerk=0):
+    """Return an endless schedule that accelerates to **maxspeed** and then runs at that speed, used to seek a limit
+    switch where the number of steps is not known"""
+    offset = 0.0
+    for speed in rampspeeds(profile, startspeed, maxspeed, accel, jerk):
+        yield offset, direction
+        offset += 1 / speed
+    interval = 1 / max(maxspeed, startspeed)
+    while True:
+        yield offset, direction
+        offset += interval
+
+
+class LinearPath:
+    """Drive two axes together along a straight line. The path is an axis for the engine: each scheduled step moves
+    the **major** axis (the one with more steps to go) and a Bresenham error term decides when the **minor** axis
+    steps as well, so both arrive at the same time. Both axes must also provide current(), the coil values of the
+    present phase, so the minor axis holds its phase between its steps, and blocked(direction), true if advance()
+    would not step, so neither axis is stepped when the other one cannot be."""
+    def __init__(self, major, minor, majordelta, minordelta):
+        self.major = major
+        self.minor = minor
+        self.majorsteps = abs(majordelta)
+        self.minorsteps = abs(minordelta)
+        self.majordirection = 1 if majordelta > 0 else -1
+        self.minordirection = 1 if minordelta > 0 else -1
+        self.error = 0
+        self.minorchannels = minor.current()
+
+    def advance(self, direction):  # pylint: disable=unused-argument
+        """Step the major axis and, when due, the minor axis. Returns the coil values of both axes or None without
+        stepping either axis if either one is blocked by a limit."""
+        minordue = 2 * (self.error + self.minorsteps) >= self.majorsteps
+        if minordue and self.minor.blocked(self.minordirection):
+            return None
+        majorchannels = self.major.advance(self.majordirection)
+        if majorchannels is None:
+            return None
+        self.error += self.minorsteps
+        if minordue:
+            self.error -= self.majorsteps
+            # A switch closing since the check holds the minor axis, the major step has been taken and is returned
+            self.minorchannels = self.minor.advance(self.minordirection) or self.minorchannels
+        return list(majorchannels) + list(self.minorchannels)
+
+    def output(self, channels):
+        """Write the coils of both axes"""
+        self.major.output(channels[:4])
+        self.minor.output(channels[4:])
+
+    def sync(self, channels):
+        """Record the coils of both axes written by a waveform"""
+        self.major.sync(channels[:4])
+        self.minor.sync(channels[4:])
+
+    def coilpins(self):
+        """Coil pins of the major axis followed by the minor axis"""
+        return self.major.coilpins() + self.minor.coilpins()
+
+
+class ParallelPath:
+    """Drive several axes at once, each from its own schedule. merge() combines the axes' schedules in time order
+    into one schedule whose direction is (axis index, direction), so one engine loop steps all the axes. Each axis
+    holds its phase between its own steps, so the axes must also provide current()."""
+    def __init__(self, axes):
+        self.axes = list(axes)
+        self.channels = [list(axis.current()) for axis in self.axes]
+
+    @staticmethod
+    def tagged(schedule, index):
+        """The steps of **schedule** with the direction replaced by (index, direction)"""
+        for offset, direction in schedule:
+            yield offset, (index, direction)
+
+    def merge(self, schedules):
+        """Return one schedule made from **schedules**, one per axis. The schedules may be generators, each one is
+        only read one step ahead."""
+        return heapq.merge(*[self.tagged(schedule, index) for index, schedule in enumerate(schedules)],
+                           key=lambda step: step[0])
+
+    def advance(self, step):
+        """Step the axis given by the (index, direction) **step**. Returns the coil values of all the axes or None
+        if the axis is blocked."""
+        index, direction = step
+        channels = self.axes[index].advance(direction)
+        if channels is None:
+            return None
+        self.channels[index] = list(channels)
+        return [value for channels in self.channels for value in channels]
+
+    def output(self, channels):
+        """Write the coils of all the axes"""
+        for index, axis in enumerate(self.axes):
+            axis.output(channels[4 * index:4 * index + 4])
+
+    def sync(self, channels):
+        """Record the coils of all the axes written by a waveform"""
+        for index, axis in enumerate(self.axes):
+            axis.sync(channels[4 * index:4 * index + 4])
+
+    def coilpins(self):
+        """Coil pins of all the axes in order"""
+        return [pin for axis in self.axes for pin in axis.coilpins()]
+
+
+class DeadlineBackend:  # pylint: disable=too-few-public-methods
+    """Play a schedule by waiting for each step's absolute deadline. If a step is late by more than **maxlag**
+    seconds (e.g. the thread was descheduled) the remaining schedule is shifted rather than bursting steps to catch up,
+    as a burst would stall the motor. The lateness of every step is counted in the **timing** histogram."""
+    name = 'deadline'
+
+    def __init__(self, clock, maxlag=0.002):
+        self.clock = clock
+        self.maxlag = maxlag
+        self.timing = Histogram(TIMING_BUCKETS)
+
+    def run(self, axis, schedule, keepgoing):
+        """Play **schedule** on **axis** while keepgoing() is true, returns the number of steps and the lateness
+        figures"""
+        steps = 0
+        maxlate = 0.0
+        totallate = 0.0
+        origin = self.clock.now()
+        observe = self.timing.observe
+        for offset, direction in schedule:
+            if not keepgoing():
+                break
+            deadline = origin + offset
+            self.clock.sleepuntil(deadline)
+            # A stop during the wait has already switched the coils off, the step must not power them again
+            if not keepgoing():
+                break
+            channels = axis.advance(direction)
+            if channels is None:
+                break
+            axis.output(channels)
+            late = self.clock.now() - deadline
+            observe(late)
+            if late > self.maxlag:
+                origin += late
+            maxlate = max(maxlate, late)
+            totallate += late
+            steps += 1
+        return {'steps': steps, 'maxlate': maxlate, 'meanlate': totallate / steps if steps else 0.0}
+
+
+class WaveformBackend:  # pylint: disable=too-few-public-methods
+    """Play a schedule by handing pulse trains to the GPIO layer. The schedule is cut into blocks of **chunk**
+    seconds, each block is passed as a generator that checks keepgoing() and advances the axis just before each pulse
+    is played, so a stop request or a limit switch ends the train within one step. The timing histogram is the
+    fallback's, as the steps played by the GPIO layer are on time. If the GPIO layer can only play waveforms on a
+    claimed group of **pins** (lgpio), an axis or path on other pins (e.g. a coordinated path over both axes) is
+    played by the fallback. A GPIO layer that queues the pulses and returns before they have been played (lgpio)
+    provides drain(pins), which is called at the end of the run."""
+    name = 'waveform'
+
+    def __init__(self, gpio, clock, chunk=0.05, fallback=None, pins=None):
+        self.gpio = gpio
+        self.clock = clock
+        self.chunk = chunk
+        self.fallback = fallback
+        self.pins = list(pins) if pins else None
+        self.timing = fallback.timing if fallback else Histogram(TIMING_BUCKETS)
+
+    @staticmethod
+    def pulses(axis, block, following, keepgoing, played):
+        """Yield the (values, delay) pulses of **block**, the step after the block is **following** (None at the end
+        of the schedule). The train ends early if keepgoing() is false or the axis is blocked, the coil values of
+        the pulses yielded are appended to **played**."""
+        for index, (offset, direction) in enumerate(block):
+            if not keepgoing():
+                return
+            channels = axis.advance(direction)
+            if channels is None:
+                return
+            step = block[index + 1] if index + 1 < len(block) else following
+            played.append(channels)
+            yield channels, step[0] - offset if step else settings['stepper-pulse-width']
+
+    def run(self, axis, schedule, keepgoing):
+        """Play **schedule** on **axis** while keepgoing() is true, returns the number of steps and the lateness
+        figures (always zero as the timing is done by the GPIO layer)"""
+        pins = axis.coilpins()
+        if not hasattr(self.gpio, 'output_wave') or (self.pins is not None and pins != self.pins):
+            return self.fallback.run(axis, schedule, keepgoing)
+        steps = 0
+        schedule = iter(schedule)
+        pending = next(schedule, None)
+        while pending is not None and keepgoing():
+            block = [pending]
+            pending = next(schedule, None)
+            while pending is not None and pending[0] - block[0][0] < self.chunk:
+                block.append(pending)
+                pending = next(schedule, None)
+            played = []
+            self.gpio.output_wave(pins, self.pulses(axis, block, pending, keepgoing, played))
+            if played:
+                axis.sync(played[-1])
+                steps += len(played)
+            if len(played) < len(block):
+                break
+        if hasattr(self.gpio, 'drain'):
+            self.gpio.drain(pins)
+        return {'steps': steps, 'maxlate': 0.0, 'meanlate': 0.0}
+
+
+class LgpioWave:
+    """Waveform output for the Raspberry Pi using the lgpio transmit queue on the gpiochip **handle**, the coil pins
+    of each axis are claimed as a group by claim() and each pulse train is queued with tx_wave. A pulse train only
+    drives the group of its first pin, so it must be played on exactly the pins of one claimed group.
+
+    Each step is queued as a wave of its own **lead** seconds before the waves already queued have been played, so the
+    transmitter chains the steps with no gap and times them itself, while the next step is only built (and the stop
+    request and limit switches checked) about one step before it is played. **playsuntil** keeps the monotonic time
+    each group's queued waves will have been played by, so the steps stay chained from one pulse train to the next."""
+    def __init__(self, handle, lead=0.002):
+        self.handle = handle
+        self.lead = lead
+        self.playsuntil = {}
+
+    def claim(self, pins):
+        """Claim **pins** as an output group. The pins have already been set up one at a time by the GPIO layer on
+        the same handle, so they are freed and claimed again as a group. Raises lgpio.error if the pins are held by
+        another handle."""
+        try:
+            lgpio.group_claim_output(self.handle, list(pins))
+        except lgpio.error:
+            for pin in pins:
+                lgpio.gpio_free(self.handle, pin)
+            lgpio.group_claim_output(self.handle, list(pins))
+
+    def output_wave(self, channels, pulses):
+        """Queue **pulses** (values, delay in seconds, a list or a generator) on **channels**, returns once the last
+        pulse has been queued. If the queue runs dry (e.g. the thread was descheduled) the next step starts as soon as
+        it is queued and the steps after it are timed from it."""
+        mask = (1 << len(channels)) - 1
+        playsuntil = self.playsuntil.get(channels[0], 0.0)
+        for values, delay in pulses:
+            bits = sum(int(value) << bit for bit, value in enumerate(values))
+            lgpio.tx_wave(self.handle, channels[0], [lgpio.pulse(bits, mask, int(delay * 1000000))])
+            playsuntil = max(playsuntil, time.monotonic()) + delay
+            self.playsuntil[channels[0]] = playsuntil
+            remaining = playsuntil - self.lead - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def drain(self, channels):
+        """Wait until the waves queued on **channels** have been played"""
+        while lgpio.tx_busy(self.handle, channels[0], lgpio.TX_WAVE):
+            time.sleep(0.0005)
+
+
+class StepEngine:  # pylint: disable=too-few-public-methods
+    """Run step schedules on an axis through the selected backend and keep the timing figures of the last run"""
+    def __init__(self, backend):
+        self.backend = backend
+        self.laststats = {}
+
+    def run(self, axis, schedule, keepgoing, deadline=False):
+        """Play **schedule** on **axis** while keepgoing() is true, returns the number of steps taken. If
+        **deadline** is true the schedule is played by the deadline loop whatever the backend, for schedules that
+        read the axis state (e.g. the limit switches) as each step is scheduled."""
+        backend = self.backend
+        if deadline:
+            backend = getattr(backend, 'fallback', None) or backend
+        start = backend.clock.now()
+        stats = backend.run(axis, schedule, keepgoing)
+        stats['elapsed'] = backend.clock.now() - start
+        stats['backend'] = backend.name
+        self.laststats = stats
+        return stats['steps']
+
+
+def lgpiohandle(gpio):
+    """Return the gpiochip handle of the GPIO layer (rpi-lgpio keeps it in _chip) so the waveforms use the pins the
+    GPIO layer has claimed, or else one handle of this module's own shared by all the axes"""
+    handle = getattr(gpio, '_chip', None)
+    if handle is None:
+        if lgpiochip['handle'] is None:
+            lgpiochip['handle'] = lgpio.gpiochip_open(0)
+        handle = lgpiochip['handle']
+    return handle
+
+
+def make_engine(gpio, clock=None, pins=None):
+    """Create the step engine selected by the **step-engine** setting ('deadline' or 'waveform'). If no **clock** is
+    given the GPIO layer's own clock is used (the simulator's virtual clock), otherwise the monotonic clock. For the
+    waveform backend on a Raspberry Pi the coil **pins** (already set up as outputs) are claimed for lgpio
+    waveforms, if they cannot be the deadline backend is used. A path over the pins of more than one axis cannot be
+    played as one lgpio waveform, so on a Raspberry Pi coordinated moves are played by the deadline backend."""
+    if clock is None:
+        clock = getattr(gpio, 'clock', None)
+    if clock is None:
+        clock = MonotonicClock(settings['step-spin-margin'])
+    deadline = DeadlineBackend(clock, settings['step-max-lag'])
+    if settings['step-engine'] == 'waveform':
+        group = None
+        if not hasattr(gpio, 'output_wave') and lgpio is not None and pins:
+            try:
+                wave = LgpioWave(lgpiohandle(gpio))
+                wave.claim(pins)
+                gpio = wave
+                group = pins
+            except lgpio.error as err:
+                logger.warning('Step engine: unable to claim pins %s for lgpio waveforms: %s', pins, err)
+        if not hasattr(gpio, 'output_wave'):
+            logger.warning('Step engine: GPIO layer cannot play waveforms, using the deadline backend')
+            return StepEngine(deadline)
+        return StepEngine(WaveformBackend(gpio, clock, settings['step-wave-chunk'], deadline, group))
+    return StepEngine(deadline)
+
+
+class BenchAxis:
+    """Minimal axis used to measure the engine, cycles the half step sequence on four pins"""
+    seq = [[1, 0, 1, 0], [1, 0, 0, 0], [1, 0, 0, 1], [0, 0, 0, 1],
+           [0, 1, 0, 1], [0, 1, 0, 0], [0, 1, 1, 0], [0, 0, 1, 0]]
+
+    def __init__(self, gpio, pins):
+        self.gpio = gpio
+        self.pins = pins
+        self.index = 0
+
+    def advance(self, direction):
+        """Next phase of the sequence"""
+        self.index = (self.index + direction) % 8
+        return self.seq[self.index]
+
+    def output(self, channels):
+        """Write the coils one pin at a time as StepperClass does"""
+        for pin, value in zip(self.pins, channels):
+            self.gpio.output(pin, value)
+
+    def sync(self, channels):
+        """Nothing to record"""
+
+    def coilpins(self):
+        """Coil pins of the axis"""
+        return self.pins
+
+
+if __name__ == '__main__':
+    import fakegpio
+    benchpins = [6, 12, 13, 16]
+    fakegpio.setup(benchpins, fakegpio.OUT)
+    for backendname in ('deadline', 'waveform'):
+        for benchinterval in (0.02, 0.005, 0.001):
+            settings['step-engine'] = backendname
+            fakegpio.reset()
+            make_engine(fakegpio).run(BenchAxis(fakegpio, benchpins),
+                                      constantschedule(int(1 / benchinterval), 1, benchinterval), lambda: True)
+            report = fakegpio.timingreport(fakegpio.steptimes(benchpins), benchinterval)
+            print('%-8s interval %.3fs: %8.2f steps/s, mean jitter %.1fus, max jitter %.1fus' %
+                  (backendname, benchinterval, report['stepspersecond'], report['meanjitter'] * 1e6,
+                   report['maxjitter'] * 1e6))
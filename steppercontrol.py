@@ -7,10 +7,10 @@ motor control operations.
 
 Functions:
     statusmessage() -> dict:
-        Returns the current status of all stepper motors in the system.
+        Returns the current status of all stepper motors in the system from the published status snapshot.
         The status includes position, state, and other relevant motor parameters.
         Returns:
-            dict: Current status of the stepper motors
+            dict: Current status of the stepper motors and the snapshot version
 
     parsecontrol(item: str, command: str) -> dict:
         Parses and executes control commands for specified stepper motor.
@@ -22,19 +22,57 @@ Functions:
         Returns:
             dict: Result of the control operation including status and any error messages
 
+    parsebatch(commands: list) -> list:
+        Runs a list of {item, command} messages in order, with optional barriers that wait for the queued motion
+        commands, and returns the list of results. Settings are written once per batch.
+
+    start() / shutdown(timeout):
+        Start the controller (GPIO, axes, position journal, position history and motion workers) or shut it down
+        once the running motion has finished. Importing the module does not touch the hardware, the functions above
+        start the controller on first use and both calls do nothing if the controller is already in that state.
+
 Note:
     This module interfaces directly with hardware components and should be used
     with appropriate driver board to prevent mechanical issues.
 
 
 """
-import threading
-from time import sleep
 import os
-from threading import Timer
-from RPi import GPIO
+import time
+from threading import Timer, RLock
 from logmanager import logger
 from app_control import settings, writesettings
+from settingsstore import SettingsError
+from apiargs import wholenumber, seconds
+from positionstore import PositionStore
+from positionhistory import PositionHistory
+from motionqueue import MotionScheduler
+from scanprogram import ScanRunner, ScanError, buildpoints
+from statussnapshot import StatusSnapshot, STATUSKEYS, APIKEYS, statusfields
+from coildriver import CoilDriver
+from metrics import Counter, Histogram, DURATION_BUCKETS, family, register
+from steptrace import tracecommand
+from stepengine import make_engine, constantschedule, intervalschedule, profileintervals, rampschedule, LinearPath, \
+    ParallelPath
+
+# Phase index parity of each step mode in the half step table, half step mode uses every phase. Full step (two coils
+# on) uses the even phases and wave drive (one coil on) the odd ones, both move two half steps per step.
+STEPMODES = {'half': None, 'full': 0, 'wave': 1}
+
+snapshot = StatusSnapshot()
+xymovetimes = Histogram(DURATION_BUCKETS)
+startlock = RLock()
+startuptime = {'seconds': None}
+# The hardware and the motion workers, None until start() has been called
+GPIO = None
+# pylint: disable=invalid-name
+positionjournal = None
+positionhistory = None
+stepperx = None
+steppery = None
+scheduler = None
+scanner = None
+# pylint: enable=invalid-name
 
 
 class StepperClass:
@@ -42,167 +80,298 @@ class StepperClass:
     Class to manage and control a stepper motor using GPIO and threading.
 
     This class provides methods to move, stop, calibrate, and manage the position
-    of a stepper motor. It uses GPIO pins for hardware interaction and threading
-    for continuous monitoring of limit switches and movement control. The class
+    of a stepper motor. It uses GPIO pins for hardware interaction, edge detection
+    callbacks for the limit switches and threading for movement control. The class
     ensures safe operation by respecting hardware-defined movement limits and includes
     calibration capabilities to define the valid range of motion. The settings
     configuration is used for storing and updating operational parameters.
 
+    Positions are always counted in half steps. In full step and wave drive modes each step moves two half steps, a
+    half step is taken first if the phase does not suit the mode and at the end of an odd length move.
+
     """
+    seq = [[1, 0, 1, 0],
+           [1, 0, 0, 0],
+           [1, 0, 0, 1],
+           [0, 0, 0, 1],
+           [0, 1, 0, 1],
+           [0, 1, 0, 0],
+           [0, 1, 1, 0],
+           [0, 0, 1, 0]
+           ]
+
     def __init__(self, direction, a, aa, b, bb, limmax, limmin, moveled):
         self.axis = direction
-        self.seq = [[1, 0, 1, 0],
-                    [1, 0, 0, 0],
-                    [1, 0, 0, 1],
-                    [0, 0, 0, 1],
-                    [0, 1, 0, 1],
-                    [0, 1, 0, 0],
-                    [0, 1, 1, 0],
-                    [0, 0, 1, 0]
-                    ]
-        self.channela = a
-        self.channelaa = aa
-        self.channelb = b
-        self.channelbb = bb
+        self.coilchannels = [a, aa, b, bb]
         self.sequenceindex = 0
         self.channelupperlimit = limmax
         self.channellowerlimit = limmin
-        self.channelmoveled = moveled
-        self.positionsetting = '%sposition' % direction
-        self.upperlimitsetting = '%s-max' % direction
-        self.lowerlimitsetting = '%s-min' % direction
-        self.position = settings[self.positionsetting]
-        self.upperlimit = settings[self.upperlimitsetting]
-        self.lowerlimit = settings[self.lowerlimitsetting]
-        self.maxswitch = 0
-        self.minswitch = 0
+        self.position = positionjournal.recover(direction, settings['%sposition' % direction])
+        self.upperlimit = settings['%s-max' % direction]
+        self.lowerlimit = settings['%s-min' % direction]
+        self.maxswitch = 1
+        self.minswitch = 1
         self.sequence = 0
         self.pulsewidth = settings['stepper-pulse-width']
-        self.moving = False
+        self.maxspeed = settings['%s-max-speed' % direction]
+        self.acceleration = settings['%s-acceleration' % direction]
+        self.jerk = settings['%s-jerk' % direction]
+        self._moving = False
         self.calibrating = False
+        self.coordinated = False
+        self.tunables = {'stepper-pulse-width': 'pulsewidth', '%s-max-speed' % direction: 'maxspeed',
+                         '%s-acceleration' % direction: 'acceleration', '%s-jerk' % direction: 'jerk',
+                         '%s-max' % direction: 'upperlimit', '%s-min' % direction: 'lowerlimit'}
+        settings.subscribe(self.tunables, self.__retune)
+        self.stepsissued = 0
+        self.metrics = {'trips': {'min': Counter(), 'max': Counter()}, 'movetimes': Histogram(DURATION_BUCKETS),
+                        'calibratetimes': Histogram(DURATION_BUCKETS)}
+        self.trace = None
+        self.homing = {}
+        self.plan = None
+        self.stepmode = 'half'
+        self.remaining = None
         GPIO.setup([a, aa, b, bb, moveled], GPIO.OUT)
+        self.engine = make_engine(GPIO, pins=self.coilpins())
+        self.coils = CoilDriver(GPIO, self.coilpins(), self.seq)
         self.moveled_pwm = GPIO.PWM(moveled, 1)
         GPIO.setup(limmax, GPIO.IN, pull_up_down=GPIO.PUD_UP)  # Max limit switch
         GPIO.setup(limmin, GPIO.IN, pull_up_down=GPIO.PUD_UP)  # Min Limit Switch
-        readerthread = threading.Timer(1, self.__read_switches)
-        readerthread.name = '%s limit switches reader' %direction
-        readerthread.start()
+        self.__read_switches()
+        GPIO.add_event_detect(limmax, GPIO.BOTH, callback=self.__switch_event,
+                              bouncetime=settings['switch-debounce-ms'])
+        GPIO.add_event_detect(limmin, GPIO.BOTH, callback=self.__switch_event,
+                              bouncetime=settings['switch-debounce-ms'])
+
+    def close(self):
+        """Release the limit switch inputs and the moving LED and stop following the settings, used when the
+        controller shuts down"""
+        for channel in (self.channelupperlimit, self.channellowerlimit):
+            GPIO.remove_event_detect(channel)
+        self.moveled_pwm.stop()
+        settings.unsubscribe(self.tunables, self.__retune)
+
+    def __retune(self, name, value):
+        """Settings subscriber: take a changed speed, acceleration or limit setting of the axis into use. A limit
+        applies from the next step. A speed, acceleration or pulse width only applies from the next move, the running
+        move keeps the schedule it was planned with so its speed does not jump part way through the profile."""
+        setattr(self, self.tunables[name], value)
+        logger.info('%s axis %s set to %s', self.axis, self.tunables[name], value,
+                    extra={'axis': self.axis, 'event': 'setting'})
+        snapshot.publish()
+
+    @property
+    def moving(self):
+        """True while the stepper is moving, setting it starts or stops the moving LED flashing"""
+        return self._moving
+
+    @moving.setter
+    def moving(self, value):
+        if value != self._moving:
+            self._moving = value
+            if value:
+                self.moveled_pwm.start(10)
+            else:
+                self.moveled_pwm.stop()
+            snapshot.publish()
+
 
+    def __switch_event(self, channel):  # pylint: disable=unused-argument
+        """
+        Called by the GPIO library when either limit switch changes state. The switches are read straight away and
+        read again once the debounce period has passed, in case the final edge of a bouncing contact was filtered
+        out by the GPIO library. The debounce period is on the step engine's clock (the simulator's virtual clock).
+        """
+        self.__read_switches()
+        recheck = Timer(settings['switch-debounce-ms'] / 1000 / self.engine.backend.clock.speed, self.__read_switches)
+        recheck.name = '%s limit switch debounce' % self.axis
+        recheck.start()
 
     def __read_switches(self):
         """
-        Continuously monitors the state of the minimum and maximum limit switches and updates
-        the corresponding attributes. Reacts to changes in the limit switch states by logging
-        events and optionally stopping movement. Also manages the LED indicating movement
-        activity.
+        Reads the minimum and maximum limit switches and updates the corresponding attributes. When a switch closes
+        (reads 0) the moving flag is cleared, unless calibrating, so the move loop stops before its next step and
+        de-energises the coils. The step loops also refuse to step towards a closed switch.
 
-        :raises RuntimeError: If the GPIO library encounters an error while reading input values
-            or controlling PWM components.
+        :raises RuntimeError: If the GPIO library encounters an error while reading input values.
         """
-        minswich = 1
-        maxswitch = 1
-        moving = 0
-        while True:
-            self.maxswitch = GPIO.input(self.channelupperlimit)
-            self.minswitch = GPIO.input(self.channellowerlimit)
-            if minswich != self.minswitch:
-                minswich = self.minswitch
-                if minswich == 0:
-                    logger.info('Min limit switch %s reached', self.axis)
-                    if not self.calibrating:
-                        self.stop()
-            if maxswitch != self.maxswitch:
-                maxswitch = self.maxswitch
-                if maxswitch == 0:
-                    logger.info('Max limit switch %s reached', self.axis)
-                    if not self.calibrating:
-                        self.stop()
-            if moving != self.moving:
-                moving = self.moving
-                if self.moving:
-                    self.moveled_pwm.start(10)
-                else:
-                    self.moveled_pwm.stop()
-            sleep(0.5)
+        maxswitch = GPIO.input(self.channelupperlimit)
+        minswitch = GPIO.input(self.channellowerlimit)
+        minchanged = minswitch != self.minswitch
+        maxchanged = maxswitch != self.maxswitch
+        self.maxswitch = maxswitch
+        self.minswitch = minswitch
+        if (minchanged and minswitch == 0) or (maxchanged and maxswitch == 0):
+            if not self.calibrating:
+                self.moving = False
+                self.sequence = self.sequence + 1
+        if minchanged and minswitch == 0:
+            self.metrics['trips']['min'].inc()
+            logger.info('Min limit switch %s reached', self.axis, extra={'axis': self.axis, 'event': 'limit'})
+        if maxchanged and maxswitch == 0:
+            self.metrics['trips']['max'].inc()
+            logger.info('Max limit switch %s reached', self.axis, extra={'axis': self.axis, 'event': 'limit'})
+        if minchanged or maxchanged:
+            snapshot.publish()
 
 
     def current(self):
         """Return current sequence, only used for debugging"""
         return self.seq[self.sequenceindex]
 
+    def coilpins(self):
+        """Return the coil pins in the order used by the sequence table"""
+        return list(self.coilchannels)
+
+    def advance(self, direction):
+        """Advance the sequence and position by one step of the step mode in **direction** (+1 towards the maximum,
+        -1 towards the minimum) and return the coil values for the step. Returns None without moving if a limit has
+        been reached or the move has covered its distance, the limits are ignored while calibrating. Called by the
+        step engine for each step of a schedule."""
+        if self.blocked(direction):
+            return None
+        stride = 1
+        if (self.stepmode != 'half' and self.sequenceindex % 2 == STEPMODES[self.stepmode] and
+                (self.remaining is None or self.remaining >= 2)):
+            stride = 2
+        if not self.calibrating:
+            if not self.lowerlimit <= self.position + direction * stride <= self.upperlimit:
+                stride = 1
+        self.sequenceindex = (self.sequenceindex + direction * stride) % 8
+        self.position += direction * stride
+        if self.remaining is not None:
+            self.remaining -= stride
+        self.stepsissued += 1
+        if self.trace is not None:
+            self.trace.record(time.monotonic(), self.sequenceindex, self.position, self.minswitch, self.maxswitch)
+        return self.seq[self.sequenceindex]
+
+    def blocked(self, direction):
+        """True if advance() would not step in **direction**: a limit has been reached or the move has covered its
+        distance"""
+        if self.remaining is not None and self.remaining <= 0:
+            return True
+        if self.calibrating:
+            return False
+        if direction > 0:
+            return self.position >= self.upperlimit or self.maxswitch == 0
+        return self.position <= self.lowerlimit or self.minswitch == 0
+
+    def startmove(self, distance, mode=None, target=None, duration=0.0):
+        """Set the step mode (default the axis' step-mode setting) for a move of **distance** half steps, None for a
+        move that runs until it is stopped. The **target** and planned **duration** of the move, if given, are kept
+        for the progress in the status. Returns the number of steps the move takes in that mode."""
+        self.stepmode = mode or settings['%s-step-mode' % self.axis]
+        self.remaining = distance
+        if target is not None:
+            self.plan = (target, abs(target - self.position), duration, self.engine.backend.clock.now())
+        return self.__stepcount(distance, self.stepmode)
+
+    def __stepcount(self, distance, mode=None):
+        """Return the number of steps a move of **distance** half steps takes in the step **mode** from the present
+        phase"""
+        mode = mode or settings['%s-step-mode' % self.axis]
+        if distance is None or mode == 'half':
+            return distance
+        align = 0 if self.sequenceindex % 2 == STEPMODES[mode] or distance == 0 else 1
+        return align + (distance - align + 1) // 2
+
+    def moveplan(self, distance, mode=None, speed=None):
+        """Return the number of steps and the planned seconds a move of **distance** half steps takes in the step
+        **mode** at up to **speed** steps per second, from the same motion profile the move uses"""
+        steps = self.__stepcount(distance, mode)
+        schedule = self.__profile(steps, 1, speed)
+        return steps, schedule[-1][0] if schedule else 0.0
+
+    def progress(self):
+        """Return the target, half steps remaining, percent complete and estimated seconds to go of the move in
+        progress, None when no move is running"""
+        if self.plan is None:
+            return None
+        target, distance, duration, started = self.plan
+        remaining = abs(target - self.position)
+        return {'target': target, 'remaining': remaining,
+                'percent': round(100 * (distance - remaining) / distance, 1) if distance else 100.0,
+                'eta': round(max(duration - (self.engine.backend.clock.now() - started), 0.0), 2)}
+
+    def __profile(self, steps, direction, speed=None):
+        """Return the schedule for a move of **steps** steps using the motion-profile setting, the move starts and
+        ends at the speed set by the pulse width and cruises at up to **speed** (default the maximum speed of the
+        axis)"""
+        return intervalschedule(profileintervals(steps, settings['motion-profile'], 1 / self.pulsewidth,
+                                                 speed or self.maxspeed, self.acceleration, self.jerk), direction)
+
     def movenext(self):
         """Move +1 step towards the maximum, if the maximum value has been reached it will not move further"""
-        stepincrement = 1
-        if (self.position < self.upperlimit) or self.calibrating:
-            if self.maxswitch == 1 or self.calibrating:
-                self.sequenceindex += stepincrement
-                if self.sequenceindex > 7:
-                    self.sequenceindex = 0
-                self.output(self.seq[self.sequenceindex])
-                self.position += stepincrement
-                sleep(self.pulsewidth)
+        self.startmove(1, 'half')
+        channels = self.advance(1)
+        if channels is not None:
+            self.output(channels)
 
     def moveprevious(self):
         """Move -1 step towards the minimum, if the minimum value has been reached it will not move further."""
-        stepincrement = -1
-        if (self.position > self.lowerlimit) or self.calibrating:
-            if self.minswitch == 1 or self.calibrating:
-                self.sequenceindex += stepincrement
-                if self.sequenceindex < 0:
-                    self.sequenceindex = 7
-                self.output(self.seq[self.sequenceindex])
-                self.position += stepincrement
-                sleep(self.pulsewidth)
+        self.startmove(1, 'half')
+        channels = self.advance(-1)
+        if channels is not None:
+            self.output(channels)
 
 
     def updateposition(self):
-        """write the stepper position to the settings file"""
-        settings[self.positionsetting] = self.position
-        writesettings()
+        """Record the stepper position in the position journal, the settings file is updated by the journal's
+        checkpoint"""
+        settings['%sposition' % self.axis] = self.position
+        positionjournal.record(self.axis, self.position)
 
     def stop(self):
         """Stop the stepper motor and set the coils to 0, also update the position of the stepper and write to
         the settings file"""
         self.moving = False
         self.sequence = self.sequence + 1
-        logger.info('%s stepper stopped, position = %s', self.axis, self.position)
+        self.plan = None
+        logger.info('%s stepper stopped, position = %s', self.axis, self.position,
+                    extra={'axis': self.axis, 'event': 'stop'})
         self.output([0, 0, 0, 0])
+        snapshot.publish()
 
-    def move(self, steps):
-        """Move **n steps** at full speed"""
+    def move(self, steps, mode=None, speed=None):
+        """Move **n** half steps at full speed (or **speed** steps per second) in the step **mode**, accelerating and
+        decelerating using the motion profile"""
+        started = time.monotonic()
         self.sequence = self.sequence + 1
+        seq = self.sequence
         self.moving = True
         if steps == 0:
             self.stop()
-        while steps != 0 and self.moving:
-            if steps > 0:
-                steps -= 1
-                self.movenext()
-            else:
-                steps += 1
-                self.moveprevious()
+            return
+        direction = 1 if steps > 0 else -1
+        schedule = self.__profile(self.__stepcount(abs(steps), mode), direction, speed)
+        self.startmove(abs(steps), mode, min(max(self.position + steps, self.lowerlimit), self.upperlimit),
+                       schedule[-1][0] if schedule else 0.0)
+        self.engine.run(self, schedule, lambda: self.moving and seq == self.sequence)
         self.updateposition()
         self.stop()
+        self.metrics['movetimes'].observe(time.monotonic() - started)
 
 
-    def moveslow(self, steps):
-        """Move **steps** slowly"""
+    def moveslow(self, steps, mode=None):
+        """Move **steps** half steps slowly in the step **mode**"""
+        started = time.monotonic()
         self.sequence = self.sequence + 1
+        seq = self.sequence
         self.moving = True
-        while steps != 0 and self.moving:
-            if steps > 0:
-                steps -= 1
-                self.movenext()
-            else:
-                steps += 1
-                self.moveprevious()
-            sleep(1)
+        direction = 1 if steps > 0 else -1
+        self.engine.run(self, constantschedule(self.startmove(abs(steps), mode), direction, self.pulsewidth + 1),
+                        lambda: self.moving and seq == self.sequence)
         self.stop()
         self.moving = False
+        self.metrics['movetimes'].observe(time.monotonic() - started)
 
-    def moveto(self, target):
+    def moveto(self, target, mode=None, speed=None):
         """
-        Moves the axis to the specified target position within its limits.
+        Moves the axis to the specified target position within its limits, in the step **mode** and at up to
+        **speed** steps per second if they are given.
+
+        The move follows the motion profile so it decelerates onto the target.
 
         This method initiates the movement process for the axis motor to reach the
         desired target position. The movement continues as long as the motor is in
@@ -215,159 +384,591 @@ class StepperClass:
         :type target: int or float
         :return: None
         """
+        started = time.monotonic()
         self.moving = True
         self.sequence = self.sequence + 1
         seq = self.sequence
         if self.lowerlimit <= target <= self.upperlimit:
-            stepcounter = 0
             delta = target - self.position
-            # print('delta = %s' % delta)
-            while self.position != target and seq == self.sequence and self.moving:
-                stepcounter += 1
-                if delta > 0:
-                    self.movenext()
-                else:
-                    self.moveprevious()
-                difference = abs(target - self.position)
-                if difference < 10:
-                    sleep(self.pulsewidth * 10)
-        logger.info('%s Move to %s complete, position = %s', self.axis, target, self.position)
+            schedule = self.__profile(self.__stepcount(abs(delta), mode), 1 if delta > 0 else -1, speed)
+            self.startmove(abs(delta), mode, target, schedule[-1][0] if schedule else 0.0)
+            self.engine.run(self, schedule, lambda: seq == self.sequence and self.moving)
+        logger.info('%s Move to %s complete, position = %s', self.axis, target, self.position,
+                    extra={'axis': self.axis, 'event': 'move'})
+        self.updateposition()
         self.stop()
         self.moving = False
+        self.metrics['movetimes'].observe(time.monotonic() - started)
 
     def output(self, channels):
-        """Output the value to the coils on the stepper"""
-        GPIO.output(self.channela, channels[0])
-        GPIO.output(self.channelaa, channels[1])
-        GPIO.output(self.channelb, channels[2])
-        GPIO.output(self.channelbb, channels[3])
+        """Output the value to the coils on the stepper, only the coils that change are written. The status snapshot
+        is published at the snapshot-interval rate while moving."""
+        self.coils.write(channels)
+        snapshot.publish(False)
+
+    def sync(self, channels):
+        """Record coil values written directly by the step engine's waveform backend"""
+        self.coils.sync(channels)
+        snapshot.publish(False)
+
+    def homingschedule(self):
+        """
+        Return the homing schedule of the axis as a generator, the switches are read before each step is scheduled
+        so the schedule ends when the axis has found both limit switches.
+
+        Each switch is found with a fast seek that ramps up to the home-seek-speed setting of the axis, then the
+        axis backs off the switch by home-backoff half steps and makes home-repeats slow approaches at the
+        home-approach-speed. Each approach runs onto the switch and creeps back off it, the position where the
+        switch releases is recorded and the spread of these positions is the repeatability. The last min switch
+        release is set as zero and the last max switch release (- 10 steps) as the maximum. Progress is kept in
+        **homing** for the status.
+        """
+        startspeed = 1 / self.pulsewidth
+        seekspeed = settings['%s-home-seek-speed' % self.axis]
+        approachinterval = 1 / settings['%s-home-approach-speed' % self.axis]
+        repeats = max(settings['home-repeats'], 1)
+        offset = -1 / startspeed
+
+        def phase(name, schedule, done):
+            """Play **schedule** until done() is true, after a pause of one step at the start speed"""
+            nonlocal offset
+            self.homing['phase'] = name
+            snapshot.publish()
+            base = offset + 1 / startspeed
+            for step, direction in schedule:
+                if done():
+                    return
+                offset = base + step
+                yield offset, direction
+
+        def findswitch(switch, direction):
+            """Seek the **switch** and approach it home-repeats times, returns the release positions"""
+            closed = (lambda: self.minswitch == 0) if switch == 'min' else (lambda: self.maxswitch == 0)
+            released = []
+            yield from phase('seek %s' % switch, rampschedule(direction, settings['motion-profile'], startspeed,
+                                                              seekspeed, self.acceleration, self.jerk), closed)
+            for approach in range(repeats):
+                self.homing['approach'] = approach + 1
+                yield from phase('backoff %s' % switch, constantschedule(None, -direction, 1 / startspeed),
+                                 lambda: not closed())
+                yield from phase('backoff %s' % switch,
+                                 constantschedule(settings['home-backoff'], -direction, 1 / startspeed), lambda: False)
+                yield from phase('approach %s' % switch, constantschedule(None, direction, approachinterval), closed)
+                yield from phase('approach %s' % switch, constantschedule(None, -direction, approachinterval),
+                                 lambda: not closed())
+                released.append(self.position)
+            self.homing['repeatability'][switch] = max(released) - min(released)
+            return released
+
+        for switch, direction in (('min', -1), ('max', 1)):
+            released = yield from findswitch(switch, direction)
+            if switch == 'min':
+                logger.info('%s min limit reset, setting zero, repeatability %s steps', self.axis,
+                            self.homing['repeatability']['min'], extra={'axis': self.axis, 'event': 'calibrate'})
+                self.position -= released[-1]
+            else:
+                self.upperlimit = released[-1] - 10
+                logger.info('%s max limit set to %s, repeatability %s steps', self.axis, self.upperlimit,
+                            self.homing['repeatability']['max'], extra={'axis': self.axis, 'event': 'calibrate'})
+        self.homing['phase'] = 'complete'
 
     def calibrate(self):
-        """Run a calibration routine to find the man and max limit switches and reset the position of the stage. The
-        routine will move the stepper backward as far as the minimum switch is triggered, it will then slowly move the
-        stepper forward until the switch is just released. This position is then recorded as zero. The stepper will
-        then be moved forward unti the maximum limit is triggeed, then move backward until the switch is released,
-        this position (- 10 steps) is stored as the maximum value. The routine then calculates the centre position and
-        moves the stepper to that position. When calibrating the read() method will not stop the motor when a limit
-        switch is triggered"""
-        self.calibrating = True
-        logger.info('Starting Calibrating %s', self.axis)
-        self.moving = True
-        while self.minswitch == 1:
-            self.moveprevious()
-        while self.minswitch == 0:
-            self.movenext()
-            sleep(self.pulsewidth * 5)
-        logger.info('Min limit reset, setting zero')
-        self.position = 0
-        while self.maxswitch == 1:
-            self.movenext()
-        while self.maxswitch == 0:
-            self.moveprevious()
-            sleep(self.pulsewidth * 5)
-        logger.info('Max limit set to %s', self.position -10)
-        self.upperlimit = self.position - 10
-        settings[self.upperlimitsetting] = self.upperlimit
-        self.updateposition()
-        self.calibrating = False
-        centre = int((self.upperlimit - self.lowerlimit) / 2)
-        logger.info('Calibrating %s complete moving to centre', self.axis)
-        self.moveto(centre)
-        self.stop()
-        self.updateposition()
-        logger.info('Calibrating %s complete, position = %s', self.axis, self.position)
-
-def statusmessage():
-    """Return the psotion and stepper status in a format that can be read by the web page"""
-    statuslist = ({'xpos': stepperx.position, 'ypos': steppery.position, 'xminswitch': stepperx.minswitch,
-                   'xmaxswitch': stepperx.maxswitch, 'yminswitch': steppery.minswitch,
-                   'ymaxswitch': steppery.maxswitch, 'stepperxa': GPIO.input(stepperx.channela),
-                   'stepperxaa': GPIO.input(stepperx.channelaa), 'stepperxb': GPIO.input(stepperx.channelb),
-                   'stepperxbb': GPIO.input(stepperx.channelbb), 'stepperya': GPIO.input(steppery.channela),
-                   'stepperyaa': GPIO.input(steppery.channelaa), 'stepperyb': GPIO.input(steppery.channelb),
-                   'stepperybb': GPIO.input(steppery.channelbb)})
-    return statuslist
-
-def apistatus():
-    """Return the status as a json message for the api"""
-    statuslist = ({'xpos': stepperx.position, 'xmoving': stepperx.moving, 'ypos': steppery.position,
-                   'ymoving': steppery.moving })
-    return statuslist
-
-
-def updatesetting(newsetting): # must be a dict object
-    """Update the settings variable and file with the new values from an api call"""
-    if isinstance(newsetting, dict):
-        for item in newsetting.keys():
-            settings[item] = newsetting[item]
-        writesettings()
-
-
-def parsecontrol(item, command):
+        """Run the homing routine on this axis to find the min and max limit switches and reset the position of the
+        stage, then move to the centre, see home()"""
+        home([self])
+
+def home(steppers):
+    """
+    Home the **steppers** together from one motion loop, each axis follows its own homing schedule (see
+    StepperClass.homingschedule) so both axes seek, back off and approach their switches at the same time.
+
+    The limit switches do not stop the motors while homing. The homing schedules read the switches before each step
+    so they are played by the deadline loop even when the step engine is the waveform backend. A stop on any of the
+    axes ends the homing and leaves the limits unchanged. When homing is complete the new maximum limits are written
+    to the settings file and the axes move to their centre positions.
+
+    :param steppers: The list of StepperClass axes to home.
+    :return: None
+    """
+    started = time.monotonic()
+    for stepper in steppers:
+        stepper.sequence = stepper.sequence + 1
+        stepper.homing = {'phase': 'starting', 'approach': 0, 'approaches': max(settings['home-repeats'], 1),
+                          'repeatability': {'min': None, 'max': None}, 'started': round(time.time(), 1)}
+        stepper.calibrating = True
+        stepper.moving = True
+        stepper.startmove(None, 'half')
+        logger.info('Starting Calibrating %s', stepper.axis, extra={'axis': stepper.axis, 'event': 'calibrate'})
+    sequences = [stepper.sequence for stepper in steppers]
+    path = ParallelPath(steppers)
+    steppers[0].engine.run(path, path.merge([stepper.homingschedule() for stepper in steppers]),
+                           lambda: all(stepper.moving and stepper.sequence == sequence
+                                       for stepper, sequence in zip(steppers, sequences)), deadline=True)
+    complete = all(stepper.homing['phase'] == 'complete' for stepper in steppers)
+    for stepper in steppers:
+        stepper.calibrating = False
+        if stepper.homing['phase'] != 'complete':
+            stepper.homing['phase'] = 'stopped'
+            logger.warning('Calibrating %s stopped before it was complete', stepper.axis,
+                           extra={'axis': stepper.axis, 'event': 'calibrate'})
+        else:
+            settings['%s-max' % stepper.axis] = stepper.upperlimit
+        stepper.updateposition()
+        stepper.stop()
+    if not complete:
+        return
+    writesettings()
+    centres = [int((stepper.upperlimit - stepper.lowerlimit) / 2) for stepper in steppers]
+    logger.info('Calibrating %s complete moving to centre', ', '.join(stepper.axis for stepper in steppers))
+    if len(steppers) == 2:
+        xymoveto(*centres)
+    else:
+        steppers[0].moveto(centres[0])
+    for stepper in steppers:
+        logger.info('Calibrating %s complete, position = %s, repeatability %s', stepper.axis, stepper.position,
+                    stepper.homing['repeatability'])
+        stepper.metrics['calibratetimes'].observe(time.monotonic() - started)
+
+
+def xymoveto(xtarget, ytarget):
+    """
+    Moves both axes to (**xtarget**, **ytarget**) together along a straight line.
+
+    Both steppers are driven from one motion loop, the axis with the larger distance to travel sets the pace using
+    the motion profile and the other axis is stepped in between by linear interpolation so both axes arrive at the
+    same time. The slower of the two axes' speed settings is used. A move or stop on either axis ends the coordinated
+    move.
+
+    :param xtarget: Desired position of the x axis.
+    :param ytarget: Desired position of the y axis.
+    :return: None
+    """
+    if not (stepperx.lowerlimit <= xtarget <= stepperx.upperlimit and
+            steppery.lowerlimit <= ytarget <= steppery.upperlimit):
+        logger.warning('XY Move to %s, %s is outside the limits', xtarget, ytarget)
+        return
+    started = time.monotonic()
+    for stepper in (stepperx, steppery):
+        stepper.sequence = stepper.sequence + 1
+        stepper.moving = True
+        stepper.coordinated = True
+    xseq = stepperx.sequence
+    yseq = steppery.sequence
+    xdelta = xtarget - stepperx.position
+    ydelta = ytarget - steppery.position
+    if abs(xdelta) >= abs(ydelta):
+        path = LinearPath(stepperx, steppery, xdelta, ydelta)
+    else:
+        path = LinearPath(steppery, stepperx, ydelta, xdelta)
+    intervals = xyintervals(path.majorsteps)
+    stepperx.startmove(None, 'half', xtarget, sum(intervals[:-1]))
+    steppery.startmove(None, 'half', ytarget, sum(intervals[:-1]))
+    stepperx.engine.run(path, intervalschedule(intervals, 1),
+                        lambda: stepperx.moving and steppery.moving and
+                        xseq == stepperx.sequence and yseq == steppery.sequence)
+    logger.info('XY Move to %s, %s complete, position = %s, %s', xtarget, ytarget, stepperx.position, steppery.position)
+    for stepper in (stepperx, steppery):
+        stepper.coordinated = False
+        stepper.updateposition()
+        stepper.stop()
+    xymovetimes.observe(time.monotonic() - started)
+
+
+def xyintervals(steps):
+    """Return the step intervals of a coordinated move of **steps** steps of the major axis, using the slower of
+    the two axes' speed settings"""
+    return profileintervals(steps, settings['motion-profile'], 1 / max(stepperx.pulsewidth, steppery.pulsewidth),
+                            min(stepperx.maxspeed, steppery.maxspeed),
+                            min(stepperx.acceleration, steppery.acceleration), min(stepperx.jerk, steppery.jerk))
+
+
+def estimate(item, command):
+    """Return the planned duration in seconds, the targets and the steps of the motion command **item** with
+    **command** as if it was started now from the present positions, without moving. Moves are planned from the
+    motion profile and speed settings, queued commands and the time lost to late steps are not included."""
+    if item in ('xmove', 'ymove', 'xmoveto', 'ymoveto'):
+        stepper = stepperx if item[0] == 'x' else steppery
+        if item.endswith('moveto'):
+            target, mode, speed = motionargs(command, 'position')
+            if not stepper.lowerlimit <= target <= stepper.upperlimit:
+                return {'error': 'position %s is outside the limits' % target}
+        else:
+            steps, mode, speed = motionargs(command, 'steps')
+            target = min(max(stepper.position + steps, stepper.lowerlimit), stepper.upperlimit)
+        steps, duration = stepper.moveplan(abs(target - stepper.position), mode, speed)
+        return {'item': item, 'duration': round(duration, 3), 'targets': {stepper.axis: target},
+                'steps': {stepper.axis: steps}}
+    if item == 'xymoveto':
+        command = xyargs(command)
+        if not (stepperx.lowerlimit <= command[0] <= stepperx.upperlimit and
+                steppery.lowerlimit <= command[1] <= steppery.upperlimit):
+            return {'error': 'position %s, %s is outside the limits' % (command[0], command[1])}
+        xsteps = abs(command[0] - stepperx.position)
+        ysteps = abs(command[1] - steppery.position)
+        return {'item': item, 'duration': round(sum(xyintervals(max(xsteps, ysteps))[:-1]), 3),
+                'targets': {'x': command[0], 'y': command[1]}, 'steps': {'x': xsteps, 'y': ysteps}}
+    return {'error': 'no estimate for %s' % item}
+
+
+def loadgpio():
+    """Return the GPIO backend selected by the gpio-backend setting or the XY_GPIO_BACKEND environment variable"""
+    # pylint: disable=import-outside-toplevel
+    if os.environ.get('XY_GPIO_BACKEND', settings['gpio-backend']) == 'simulator':
+        from simgpio import simulator
+        return simulator(settings)
+    from RPi import GPIO as rpigpio
+    return rpigpio
+
+
+def start():
+    """
+    Start the stepper controller: open the position journal (waiting for another process driving the stage to shut
+    down), the GPIO backend, create both axes from the journalled positions, start the motion workers and publish
+    the first status. Nothing touches the hardware until this is called, the api and status call it on first use.
+
+    Calling it again while the controller is running does nothing, so it is safe from any thread. The time taken is
+    kept for the xy_startup_seconds metric and a warning is logged if it is over the startup-time-target setting.
+    """
+    # pylint: disable-next=global-statement
+    global GPIO, positionjournal, positionhistory, stepperx, steppery, scheduler, scanner
+    if scheduler is not None and not scheduler.closed:
+        return
+    with startlock:
+        if scheduler is not None and not scheduler.closed:
+            return
+        started = time.monotonic()
+        logger.info("xy controller started")
+        positionjournal = PositionStore(settings['position-journal'])
+        GPIO = loadgpio()
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BCM)
+        stepperx = StepperClass('x', settings['x-a-gpio-pin'], settings['x-aa-gpio-pin'],settings['x-b-gpio-pin'],
+                                settings['x-bb-gpio-pin'], settings['x-max-gpio-pin'], settings['x-min-gpio-pin'],
+                                settings['x-moving-gpio-pin'])
+        steppery = StepperClass('y', settings['y-a-gpio-pin'], settings['y-aa-gpio-pin'],settings['y-b-gpio-pin'],
+                                settings['y-bb-gpio-pin'], settings['y-max-gpio-pin'], settings['y-min-gpio-pin'],
+                                settings['y-moving-gpio-pin'])
+        positionjournal.watch('x', lambda: stepperx.position)
+        positionjournal.watch('y', lambda: steppery.position)
+        positionjournal.start()
+        positionhistory = PositionHistory(settings['history-file'], settings['history-capacity'])
+        positionhistory.start(historysample)
+        scanner = ScanRunner(xymoveto, stopall, lambda: (stepperx.position, steppery.position), snapshot.publish)
+        newscheduler = MotionScheduler(settings['motion-queue-depth'])
+        newscheduler.addaxis('x', stepperx.stop)
+        newscheduler.addaxis('y', steppery.stop)
+        scheduler = newscheduler
+        snapshot.start(buildsnapshot)
+        startuptime['seconds'] = time.monotonic() - started
+        logger.info("xy controller ready in %.3fs", startuptime['seconds'])
+        if startuptime['seconds'] > settings['startup-time-target']:
+            logger.warning('xy controller took %.3fs to start, the target is %ss', startuptime['seconds'],
+                           settings['startup-time-target'])
+
+
+def shutdown(timeout=None):
+    """
+    Shut the stepper controller down: stop taking motion commands, wait up to **timeout** seconds (default the
+    shutdown-timeout setting) for the running and queued commands to finish so a move is not cut off part way, then
+    stop both axes, release the GPIO pins and write the positions to the journal (released last) and settings file.
+
+    Calling it when the controller is not running does nothing, start() can be called again afterwards.
+    """
+    with startlock:
+        if scheduler is None or scheduler.closed:
+            return
+        deadline = time.monotonic() + (settings['shutdown-timeout'] if timeout is None else timeout)
+        while not scheduler.idle() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if not scheduler.idle():
+            logger.warning('xy controller shutdown: stopping the motion still running after the timeout')
+        scheduler.close()
+        stopall()
+        for stepper in (stepperx, steppery):
+            stepper.close()
+        positionhistory.stop()
+        GPIO.cleanup()
+        positionjournal.stop()
+        logger.info('xy controller shut down, position = %s, %s', stepperx.position, steppery.position)
+
+
+def queuedepth(name, value):  # pylint: disable=unused-argument
+    """Settings subscriber: apply a new motion-queue-depth to the motion scheduler"""
+    if scheduler is not None:
+        scheduler.maxdepth = value
+
+
+def stopall():
+    """Stop both steppers"""
+    stepperx.stop()
+    steppery.stop()
+
+
+def historysample():
+    """Return the (xpos, ypos, moving, switches) of a position history sample, see positionhistory"""
+    return (stepperx.position, steppery.position, stepperx.moving | steppery.moving << 1,
+            (not stepperx.minswitch) | (not stepperx.maxswitch) << 1 | (not steppery.minswitch) << 2 |
+            (not steppery.maxswitch) << 3)
+
+
+def buildsnapshot():
+    """Build the status published in the status snapshot, only in-memory values are read: the coil values come
+    from the coil drivers' shadow copies so no hardware is read"""
+    xcoils = stepperx.coils.state
+    ycoils = steppery.coils.state
+    return {'xpos': stepperx.position, 'ypos': steppery.position, 'xminswitch': stepperx.minswitch,
+            'xmaxswitch': stepperx.maxswitch, 'yminswitch': steppery.minswitch,
+            'ymaxswitch': steppery.maxswitch, 'stepperxa': xcoils[0], 'stepperxaa': xcoils[1],
+            'stepperxb': xcoils[2], 'stepperxbb': xcoils[3], 'stepperya': ycoils[0], 'stepperyaa': ycoils[1],
+            'stepperyb': ycoils[2], 'stepperybb': ycoils[3], 'xmoving': stepperx.moving, 'ymoving': steppery.moving,
+            'xymoving': stepperx.coordinated or steppery.coordinated, 'scan': scanner.status(),
+            'xprogress': stepperx.progress(), 'yprogress': steppery.progress(),
+            'homing': {stepper.axis: dict(stepper.homing, repeatability=dict(stepper.homing['repeatability']))
+                       if stepper.homing else None for stepper in (stepperx, steppery)}}
+
+
+def motionmetrics():
+    """Metric families of the steppers and motion queues for the /metrics endpoint, none until the controller has
+    been started"""
+    if stepperx is None:
+        return []
+    steppers = (stepperx, steppery)
+    movetimes = [sample for stepper in steppers
+                 for sample in stepper.metrics['movetimes'].samples({'axis': stepper.axis})]
+    movetimes += xymovetimes.samples({'axis': 'xy'})
+    return [family('xy_steps_total', 'counter', 'Steps issued to the stepper coils',
+                   [({'axis': stepper.axis}, stepper.stepsissued) for stepper in steppers]),
+            family('xy_limit_switch_trips_total', 'counter', 'Limit switch closures',
+                   [({'axis': stepper.axis, 'switch': switch}, counter.value) for stepper in steppers
+                    for switch, counter in stepper.metrics['trips'].items()]),
+            family('xy_move_seconds', 'histogram', 'Duration of move, moveto, moveslow and xymoveto commands',
+                   movetimes),
+            family('xy_calibration_seconds', 'histogram', 'Duration of axis calibrations',
+                   [sample for stepper in steppers
+                    for sample in stepper.metrics['calibratetimes'].samples({'axis': stepper.axis})]),
+            family('xy_step_lateness_seconds', 'histogram', 'Time each step was written after its deadline',
+                   [sample for stepper in steppers
+                    for sample in stepper.engine.backend.timing.samples({'axis': stepper.axis})]),
+            family('xy_motion_queue_depth', 'gauge', 'Motion commands waiting or running',
+                   [({'axis': axis}, scheduler.depth(axis)) for axis in ('x', 'y')]),
+            family('xy_position_steps', 'gauge', 'Axis position',
+                   [({'axis': stepper.axis}, stepper.position) for stepper in steppers]),
+            family('xy_startup_seconds', 'gauge', 'Time the stepper controller took to start',
+                   [({}, startuptime['seconds'])])]
+
+
+def statusmessage(since=None, timeout=None):
+    """Return the psotion and stepper status in a format that can be read by the web page, taken from the status
+    snapshot. If **since** is a snapshot version, wait up to **timeout** seconds for a newer one."""
+    start()
+    return statusfields(snapshot, STATUSKEYS, since, timeout)
+
+def apistatus(since=None, timeout=None):
+    """Return the status as a json message for the api, taken from the status snapshot. If **since** is a snapshot
+    version, wait up to **timeout** seconds for a newer one."""
+    return statusfields(snapshot, APIKEYS, since, timeout)
+
+
+def xyargs(command):
+    """Return the [x, y] arguments of an xymoveto command, raises ValueError unless it is a pair of whole numbers"""
+    if not isinstance(command, (list, tuple)) or len(command) != 2:
+        raise ValueError('xymoveto needs [x, y]')
+    return [wholenumber(command[0]), wholenumber(command[1])]
+
+
+def motionargs(command, key):
+    """Return the [value, step mode, speed] arguments of a motion command, which is either the value or a dict of
+    **key** and an optional "mode" (half, full or wave) and "speed" (steps per second). Raises ValueError if the
+    value is not a whole number."""
+    if not isinstance(command, dict):
+        return [wholenumber(command), None, None]
+    mode = command.get('mode')
+    speed = command.get('speed')
+    if mode is not None and mode not in STEPMODES:
+        raise ValueError('unknown step mode %s' % mode)
+    if speed is not None and not speed > 0:
+        raise ValueError('speed must be more than 0')
+    return [wholenumber(command[key]), mode, speed]
+
+
+def updatesetting(newsetting, save=True): # must be a dict object
+    """Validate the new values from an api call and apply them, limits from the next step and speeds from the next move.
+    The settings file is written shortly afterwards unless **save** is False (a batch saves once at the end). Returns
+    the settings, or the error if any value is not valid, in which case nothing is changed."""
+    try:
+        settings.change(newsetting)
+    except SettingsError as err:
+        logger.error('Settings change refused: %s', err)
+        return {'error': str(err)}
+    if save:
+        settings.save()
+    return settings
+
+
+def queuecommand(item, action, axes, args, policy, relative=False, oncancel=None, onpreempt=None):
+    """Queue a motion command and return the api status with the command ID, or an error if the queue is full.
+    **oncancel()** is called if the command is cancelled before it runs, **onpreempt()** if it is preempted."""
+    commandid = scheduler.submit(item, action, axes, args, policy or settings['motion-queue-policy'], relative,
+                                 oncancel, onpreempt)
+    if commandid is None:
+        return {'error': 'motion queue full'}
+    status = apistatus()
+    status['commandid'] = commandid
+    return status
+
+
+def barrier(commandids, timeout):
+    """Wait up to **timeout** seconds in total for the motion commands **commandids** to finish, returns their
+    states"""
+    deadline = time.monotonic() + timeout
+    states = [scheduler.wait(commandid, max(deadline - time.monotonic(), 0)) for commandid in commandids]
+    return {'barrier': states, 'complete': all(state['state'] not in ('queued', 'running') for state in states)}
+
+
+def parsebatch(commands, policy=None):
+    """Run a list of api messages in order and return the list of their results. A message {"item": "barrier",
+    "command": {"timeout": seconds}} waits for the motion commands queued earlier in the batch to finish before the
+    next message is run, the timeout defaults to 30 seconds. Settings changed by the batch are written to the
+    settings file once, at the end."""
+    start()
+    if not isinstance(commands, list) or len(commands) > settings['api-batch-max']:
+        return [{'error': 'a batch must be a list of at most %s messages' % settings['api-batch-max']}]
+    results = []
+    submitted = []
+    changed = False
+    for message in commands:
+        if not isinstance(message, dict) or 'item' not in message:
+            results.append({'error': 'incorrect json message'})
+            continue
+        item = message['item']
+        command = message.get('command')
+        if item == 'barrier':
+            timeout = command.get('timeout') if isinstance(command, dict) else None
+            try:
+                results.append(barrier(submitted, 30 if timeout is None else seconds(timeout)))
+            except ValueError as err:
+                logger.error('bad barrier timeout: %s', err)
+                results.append({'error': 'barrier timeout must be a number of seconds'})
+                continue
+            submitted = []
+            continue
+        result = parsecontrol(item, command, message.get('policy', policy), False)
+        if 'commandid' in result:
+            submitted.append(result['commandid'])
+        if item == 'updatesetting' and isinstance(command, dict):
+            changed = True
+        results.append(result)
+    if changed:
+        settings.save()
+    return results
+
+
+def motioncontrol(item, command, policy):
+    """Queue the move, moveto or calibrate command **item** on the motion workers using **policy**, see
+    parsecontrol()"""
+    if item in ('xmove', 'ymove'):
+        stepper = stepperx if item == 'xmove' else steppery
+        args = motionargs(command, 'steps')
+        return queuecommand(item, stepper.move, [stepper.axis], args, 'replace' if args[0] == 0 else policy, True)
+    if item in ('xmoveto', 'ymoveto'):
+        stepper = stepperx if item == 'xmoveto' else steppery
+        return queuecommand(item, stepper.moveto, [stepper.axis], motionargs(command, 'position'), policy)
+    if item == 'xymoveto':
+        return queuecommand(item, xymoveto, ['x', 'y'], xyargs(command), policy)
+    if item == 'xcalibrate':
+        return queuecommand(item, stepperx.calibrate, ['x'], [], policy)
+    if item == 'ycalibrate':
+        return queuecommand(item, steppery.calibrate, ['y'], [], policy)
+    if item == 'calibrate-all':
+        logger.info('Calibrating all axis')
+        return queuecommand(item, home, ['x', 'y'], [[stepperx, steppery]], policy)
+    return {'error': 'unknown command'}
+
+
+def scancontrol(item, command, policy):
+    """Queue the scan program **command** using **policy**, or pause, resume or abort the running scan, see
+    parsecontrol()"""
+    if item == 'scan':
+        if scanner.state in ('queued', 'running', 'paused'):
+            return {'error': 'a scan is already running'}
+        points = buildpoints(command, ((stepperx.lowerlimit, stepperx.upperlimit),
+                                       (steppery.lowerlimit, steppery.upperlimit)), settings['scan-max-points'])
+        # Marked queued before it is submitted so a worker starting the scan straight away is not overwritten
+        previous = scanner.state
+        scanner.queue()
+        reply = queuecommand(item, scanner.run, ['x', 'y'], [points], policy, oncancel=scanner.cancel,
+                             onpreempt=scanner.abort)
+        if 'error' in reply:
+            scanner.cancel(previous)
+        return reply
+    if item == 'scanpause':
+        scanner.pause()
+        return apistatus()
+    if item == 'scanresume':
+        scanner.resume()
+        return apistatus()
+    if item == 'scanabort':
+        scanner.abort()
+        return apistatus()
+    return {'error': 'unknown command'}
+
+
+def parsecontrol(item, command, policy=None, save=True):
     """Parser that recieves messages from the API or web page posts and directs messages to the correct function:
     Valid messages are:
-    getxystatus: returns the current position of the steppers
-    (axis)move: moves the stepper axis by the number of steps specified
-    (axix)moveto: moves the stepper axis to the position specified
+    getxystatus: returns the current position of the steppers, {"since": version} waits for a newer status
+    (axis)move: moves the stepper axis by the number of steps specified, or {"steps": n, "mode": mode, "speed": s}
+    (axix)moveto: moves the stepper axis to the position specified, or {"position": n, "mode": mode, "speed": s}
+    xymoveto: moves both axes together in a straight line to the [x, y] position specified
+    estimate: returns the planned duration of the motion command {"item": item, "command": command} without moving
     (axis)calibrate: calibrates the stepper axis
-    calibrate-all: calibrates both axes
+    calibrate-all: calibrates both axes together, progress and repeatability are reported in the status
+    scan: runs the scan program (waypoints or raster) specified, progress is reported in the status
+    scanpause, scanresume, scanabort: pause, resume or abort the running scan
+    commandstatus: returns the state of the motion command with the ID specified
+    waitcommand: waits for the motion command {"id": ID, "timeout": seconds} to finish and returns its state
     output: sets the coils on the stepper to the value specified (used foir testing ta stepper motor
     getsettings: returns the current settings in a json format
-    updatesetting: updates the settings file with the new values specified in a json object
+    updatesetting: validates and applies the new values specified in a json object, limits from the next step and
+        speeds from the next move, the settings file is written shortly afterwards
     restart: restarts the raspberry pi
+    trace: "start" or "stop" the per-step trace, "dump" writes it to a .npy file
+    simulator: returns the virtual stage positions and missed step counts when running on the simulated GPIO
+    Motion commands are queued on the axis motion workers using **policy** (append, replace or merge, default is the
+    motion-queue-policy setting) and the reply includes the command ID. A move of 0 steps always replaces (stops).
+    Settings changes are only written to the settings file if **save** is True.
     """
+    start()
     try:
         if item != 'getxystatus':
-            logger.info('Request recieved {%s : %s}', item, command)
+            logger.info('Request recieved {%s : %s}', item, command, extra={'event': 'api'})
+        elif isinstance(command, dict) and 'since' in command:
+            return apistatus(command['since'], settings['snapshot-longpoll-timeout'])
         else:
             return apistatus()
-        if item == 'xmove':
-            timerthread = Timer(0.1, lambda: stepperx.move(command))
-            timerthread.name = 'xmove thread'
-            timerthread.start()
-            return apistatus()
-        if item == 'ymove':
-            timerthread = Timer(0.1, lambda: steppery.move(command))
-            timerthread.name = 'ymove thread'
-            timerthread.start()
-            return apistatus()
-        if item == 'xmoveto':
-            timerthread = Timer(0.1, lambda: stepperx.moveto(command))
-            timerthread.name = 'xmove to %s thread' % command
-            timerthread.start()
-            return apistatus()
-        if item == 'ymoveto':
-            timerthread = Timer(0.1, lambda: steppery.moveto(command))
-            timerthread.name = 'ymove to %s thread' % command
-            timerthread.start()
-            return apistatus()
-        if item == 'xcalibrate':
-            timerthread = Timer(0.1, stepperx.calibrate)
-            timerthread.name = 'x calibrating thread'
-            timerthread.start()
-            return apistatus()
-        if item == 'ycalibrate':
-            timerthread = Timer(0.1, steppery.calibrate)
-            timerthread.name = 'y calibrating thread'
-            timerthread.start()
-            return apistatus()
-        if item == 'calibrate-all':
-            logger.info('Calibrating all axis')
-            timerthread = Timer(0.1, steppery.calibrate)
-            timerthread.name = 'y calibrating thread'
-            timerthread.start()
-            timerthread = Timer(0.1, steppery.calibrate)
-            timerthread.name = 'y calibrating thread'
-            timerthread.start()
-            return apistatus()
+        if item in ('xmove', 'ymove', 'xmoveto', 'ymoveto', 'xymoveto', 'xcalibrate', 'ycalibrate', 'calibrate-all'):
+            return motioncontrol(item, command, policy)
+        if item in ('scan', 'scanpause', 'scanresume', 'scanabort'):
+            return scancontrol(item, command, policy)
+        if item == 'estimate':
+            return estimate(command['item'], command.get('command'))
+        if item == 'commandstatus':
+            return scheduler.status(command)
+        if item == 'waitcommand':
+            return scheduler.wait(command['id'], command.get('timeout', 30))
+        if item == 'trace':
+            reply = tracecommand(command, (stepperx, steppery), settings['trace-capacity'], settings['trace-path'])
+            logger.info('Step trace: %s', reply)
+            return reply
+        if item == 'simulator':
+            return GPIO.report() if hasattr(GPIO, 'report') else {'error': 'not running on the simulator'}
         if item == 'output':
             stepperx.output(command)
             steppery.output(command)
             return apistatus()
         if item == 'updatesetting':
             logger.warning('parsecontrol Setting changed via api - %s', command)
-            updatesetting(command)
-            return settings
+            return updatesetting(command, save)
         if item == 'getsettings':
             return settings
         if item == 'restart':
@@ -377,10 +978,13 @@ def parsecontrol(item, command):
                 timerthread.start()
             return {'command': 'rebooting'}
         return {'error': 'unknown command'}
-    except ValueError:
-        logger.error('incorrect json message')
+    except ScanError as err:
+        logger.error('bad scan program: %s', err)
+        return {'error': str(err)}
+    except ValueError as err:
+        logger.error('incorrect json message: %s', err)
         return {'error': 'incorrect json message'}
-    except IndexError:
+    except (IndexError, KeyError, TypeError):
         logger.error('bad Item')
         return {'error': 'incorrect json message'}
 
@@ -391,14 +995,5 @@ def reboot():
     os.system('sudo reboot')
 
 
-
-logger.info("xy controller started")
-GPIO.setwarnings(False)
-GPIO.setmode(GPIO.BCM)
-stepperx = StepperClass('x', settings['x-a-gpio-pin'], settings['x-aa-gpio-pin'],settings['x-b-gpio-pin'],
-                        settings['x-bb-gpio-pin'], settings['x-max-gpio-pin'], settings['x-min-gpio-pin'],
-                        settings['x-moving-gpio-pin'])
-steppery = StepperClass('y', settings['y-a-gpio-pin'], settings['y-aa-gpio-pin'],settings['y-b-gpio-pin'],
-                        settings['y-bb-gpio-pin'], settings['y-max-gpio-pin'], settings['y-min-gpio-pin'],
-                        settings['y-moving-gpio-pin'])
-logger.info("xy controller ready")
+settings.subscribe(['motion-queue-depth'], queuedepth)
+register(motionmetrics)
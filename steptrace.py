@@ -0,0 +1,150 @@
+"""
+Per-step trace recorder for finding lost steps and stutters.
+
+While tracing is on each axis records every step it takes (monotonic time, phase index, position and limit switch
+state) into its own preallocated ring buffer of **trace-capacity** steps, so the newest steps are kept and nothing is
+allocated or logged in the step loop. Each buffer is only written by the thread running its axis' move, so no lock
+is taken. When tracing is off the only cost is one attribute check per step.
+
+A dump merges the axes' buffers in time order into a NumPy .npy file of packed records, which numpy.load() reads as a
+structured array, and which the analysis in this module reads without NumPy:
+    time (float64 seconds), axis (uint8, ord('x') or ord('y')), phase (uint8), position (int32),
+    switches (uint8, bit 0 min switch closed, bit 1 max switch closed)
+
+Running this module on a dump reports each axis' step rate and inter-step gaps, the gaps much longer than the typical
+gap, and the phase anomalies: a phase change that is not one half step or full step, or a step that does not match
+the position change.
+
+Usage:
+    tracecommand('start', (stepperx, steppery), 100000, 'traces')
+    python steptrace.py traces/steptrace-20250101-120000.npy
+"""
+import ast
+import os
+import struct
+import sys
+import time
+from array import array
+
+RECORD = struct.Struct('<dBBiB')
+DTYPE = "[('time', '<f8'), ('axis', '|u1'), ('phase', '|u1'), ('position', '<i4'), ('switches', '|u1')]"
+MAGIC = b'\x93NUMPY\x01\x00'
+
+# The buffers of the last trace started, kept after the trace is stopped so it can be dumped
+lasttrace = {'x': None, 'y': None}
+
+
+class StepTrace:
+    """Ring buffer of the last **capacity** steps of one axis"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.phases = array('B', bytes(capacity))
+        self.positions = array('i', bytes(4 * capacity))
+        self.switches = array('B', bytes(capacity))
+        self.count = 0
+
+    def record(self, timestamp, phase, position, minswitch, maxswitch):
+        """Store one step, overwriting the oldest once the buffer is full. The switches are the input values (0 is
+        closed)."""
+        index = self.count % self.capacity
+        self.times[index] = timestamp
+        self.phases[index] = phase
+        self.positions[index] = position
+        self.switches[index] = (not minswitch) | (not maxswitch) << 1
+        self.count += 1
+
+    def records(self, axis):
+        """Return the stored steps, oldest first, as (time, axis, phase, position, switches) tuples"""
+        count = min(self.count, self.capacity)
+        start = self.count - count
+        axiscode = ord(axis)
+        return [(self.times[index], axiscode, self.phases[index], self.positions[index], self.switches[index])
+                for index in (position % self.capacity for position in range(start, start + count))]
+
+
+def dump(path, traces):
+    """Write the steps of **traces** (a dict of axis name to StepTrace) to **path** as a .npy file in time order,
+    returns the number of steps written"""
+    records = sorted(record for axis, trace in traces.items() if trace is not None for record in trace.records(axis))
+    header = "{'descr': %s, 'fortran_order': False, 'shape': (%s,), }" % (DTYPE, len(records))
+    header = header.ljust((len(MAGIC) + 2 + len(header) + 1 + 63) // 64 * 64 - len(MAGIC) - 2 - 1) + '\n'
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'wb') as tracefile:
+        tracefile.write(MAGIC + struct.pack('<H', len(header)) + header.encode('latin1'))
+        for record in records:
+            tracefile.write(RECORD.pack(*record))
+    return len(records)
+
+
+def tracecommand(command, axes, capacity, folder):
+    """Run the trace api **command** on **axes**: "start" gives each axis a new buffer of **capacity** steps, "stop"
+    ends the recording and "dump" writes the last trace to a .npy file in **folder**. Returns the api reply."""
+    if command == 'start':
+        for axis in axes:
+            lasttrace[axis.axis] = axis.trace = StepTrace(capacity)
+        return {'trace': 'started', 'capacity': capacity}
+    if command == 'stop':
+        for axis in axes:
+            axis.trace = None
+        return {'trace': 'stopped'}
+    if command == 'dump':
+        path = os.path.join(folder, 'steptrace-%s.npy' % time.strftime('%Y%m%d-%H%M%S'))
+        return {'trace': 'dumped', 'file': path, 'records': dump(path, lasttrace)}
+    return {'error': 'trace command must be start, stop or dump'}
+
+
+def load(path):
+    """Read a trace written by dump() and return its records"""
+    with open(path, 'rb') as tracefile:
+        if tracefile.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a step trace' % path)
+        headerlength = struct.unpack('<H', tracefile.read(2))[0]
+        header = ast.literal_eval(tracefile.read(headerlength).decode('latin1'))
+        if str(header['descr']) != DTYPE:
+            raise ValueError('%s has the wrong record format' % path)
+        return list(RECORD.iter_unpack(tracefile.read(header['shape'][0] * RECORD.size)))
+
+
+def analyse(records, gapfactor=3.0, limit=20):
+    """Return a report of the step timing and the phase anomalies of each axis. A gap more than **gapfactor** times
+    the median gap is reported, up to **limit** of each kind are listed."""
+    report = {}
+    for axiscode in sorted({record[1] for record in records}):
+        steps = [record for record in records if record[1] == axiscode]
+        gaps = [b[0] - a[0] for a, b in zip(steps, steps[1:])]
+        median = sorted(gaps)[len(gaps) // 2] if gaps else 0.0
+        longgaps = [(steps[index][0], gap) for index, gap in enumerate(gaps) if median and gap > gapfactor * median]
+        anomalies = []
+        for previous, step in zip(steps, steps[1:]):
+            phasechange = (step[2] - previous[2]) % 8
+            if phasechange > 4:
+                phasechange -= 8
+            if phasechange not in (-2, -1, 1, 2) or step[3] - previous[3] != phasechange:
+                anomalies.append({'time': step[0], 'phase': (previous[2], step[2]),
+                                  'position': (previous[3], step[3])})
+        report[chr(axiscode)] = {
+            'steps': len(steps),
+            'duration': steps[-1][0] - steps[0][0] if steps else 0.0,
+            'mediangap': median, 'maxgap': max(gaps) if gaps else 0.0,
+            'longgaps': len(longgaps), 'longgaplist': longgaps[:limit],
+            'anomalies': len(anomalies), 'anomalylist': anomalies[:limit],
+            'switchsteps': len([step for step in steps if step[4]])}
+    return report
+
+
+if __name__ == '__main__':
+    for axisname, axisreport in analyse(load(sys.argv[1])).items():
+        print('%s axis: %s steps in %.3fs, median gap %.6fs, max gap %.6fs, %s steps with a switch closed' %
+              (axisname, axisreport['steps'], axisreport['duration'], axisreport['mediangap'], axisreport['maxgap'],
+               axisreport['switchsteps']))
+        print('  %s long gaps' % axisreport['longgaps'])
+        for gaptime, gaplength in axisreport['longgaplist']:
+            print('    at %.6f: %.6fs' % (gaptime, gaplength))
+        print('  %s phase anomalies' % axisreport['anomalies'])
+        for anomaly in axisreport['anomalylist']:
+            print('    at %.6f: phase %s -> %s, position %s -> %s' % (anomaly['time'], anomaly['phase'][0],
+                                                                     anomaly['phase'][1], anomaly['position'][0],
+                                                                     anomaly['position'][1]))
@@ -0,0 +1,212 @@
+"""
+System log service for the System Log web page.
+
+Instead of running journalctl through a shell on every page load, one follower reads new entries as they are written
+and keeps the most recent **syslog-buffer-size** entries in a ring buffer. Page loads and api queries are answered
+from the buffer with unit, priority, text and time range filters and paging, and a client can ask for only the
+entries after a cursor it has already seen.
+
+Sources:
+    JournalSource: follows the systemd journal with one long-running 'journalctl -o json -f' process, if the process
+        ends it is restarted after the last cursor seen
+    FileSource: follows a file of journal json lines (the format written by 'journalctl -o json'), used to run and
+        test the service on a computer without systemd
+
+The follower thread is started on the first query.
+
+Usage:
+    service = SyslogService(JournalSource(2000), 5000)
+    entries = service.query(unit='gunicorn.service', priority=4, limit=100)
+    newer = service.query(after=entries[0]['cursor'])
+"""
+import json
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from logmanager import logger
+
+PRIORITIES = ('EMERG', 'ALERT', 'CRIT', 'ERROR', 'WARNING', 'NOTICE', 'INFO', 'DEBUG')
+
+
+def levelpriority(level):
+    """Return the journal priority (0 to 7) for a level name such as ERROR or a priority number, None if blank"""
+    if level in (None, ''):
+        return None
+    level = str(level).upper()
+    if level.isdigit():
+        return int(level)
+    if level == 'CRITICAL':
+        level = 'CRIT'
+    return PRIORITIES.index(level) if level in PRIORITIES else None
+
+
+def parseentry(record, fallbackcursor):
+    """Convert a journal json record into a log entry dict"""
+    message = record.get('MESSAGE', '')
+    if isinstance(message, list):
+        message = bytes(message).decode('utf-8', errors='replace')
+    try:
+        timestamp = int(record['__REALTIME_TIMESTAMP']) / 1000000
+    except (KeyError, ValueError):
+        timestamp = time.time()
+    try:
+        priority = int(record.get('PRIORITY', 6))
+    except ValueError:
+        priority = 6
+    return {'cursor': record.get('__CURSOR', fallbackcursor), 'time': timestamp, 'priority': priority,
+            'unit': record.get('_SYSTEMD_UNIT') or record.get('SYSLOG_IDENTIFIER') or '',
+            'host': record.get('_HOSTNAME', ''), 'message': str(message)}
+
+
+def cursortime(cursor):
+    """Return the time (seconds since the epoch) held in **cursor**, None if it has none. A journal cursor holds the
+    realtime timestamp as t=<hex microseconds>, the cursor made for an entry without one holds the time it was
+    added."""
+    try:
+        if cursor.startswith('entry:'):
+            return float(cursor[6:])
+        for field in cursor.split(';'):
+            if field.startswith('t='):
+                return int(field[2:], 16) / 1000000
+    except (AttributeError, ValueError):
+        pass
+    return None
+
+
+def formatentry(entry):
+    """Format an entry as a text line like journalctl's short output, with the priority name"""
+    priority = PRIORITIES[entry['priority']] if 0 <= entry['priority'] < len(PRIORITIES) else entry['priority']
+    return '%s %s [%s] %s: %s' % (time.strftime('%b %d %H:%M:%S', time.localtime(entry['time'])), entry['host'],
+                                  priority, entry['unit'], entry['message'])
+
+
+class JournalSource:  # pylint: disable=too-few-public-methods
+    """Follows the systemd journal through one journalctl process"""
+    def __init__(self, initial=2000, command='/bin/journalctl'):
+        self.initial = initial
+        self.command = command
+
+    def follow(self, callback, cursor=None):
+        """Call **callback(record)** for each journal record, blocks until journalctl exits"""
+        args = [self.command, '-o', 'json', '-f']
+        if cursor:
+            args += ['--after-cursor', cursor]
+        else:
+            args += ['-n', str(self.initial)]
+        with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+            for line in process.stdout:
+                try:
+                    callback(json.loads(line))
+                except ValueError:
+                    continue
+
+
+class FileSource:  # pylint: disable=too-few-public-methods
+    """Follows a file of journal json lines, the stand-in for the journal when there is no systemd"""
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+
+    def follow(self, callback, cursor=None):  # pylint: disable=unused-argument
+        """Call **callback(record)** for each line of the file and for lines appended to it, blocks while the file
+        exists. The cursor of a record without one is 'file:<line number>'."""
+        linenumber = 0
+        with open(self.path, 'r', encoding='utf-8') as logfile:
+            while os.path.exists(self.path):
+                line = logfile.readline()
+                if not line:
+                    if os.path.getsize(self.path) < logfile.tell():
+                        logfile.seek(0)
+                        linenumber = 0
+                    time.sleep(self.interval)
+                    continue
+                linenumber += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                record.setdefault('__CURSOR', 'file:%s' % linenumber)
+                callback(record)
+
+
+class SyslogService:
+    """Ring buffer of recent system log entries filled by a single follower thread"""
+    def __init__(self, source, size=5000):
+        self.source = source
+        self.entries = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.cursor = None
+        self.running = False
+
+    def start(self):
+        """Start the follower thread if it is not running"""
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        follower = threading.Thread(target=self.__follower, name='system log follower', daemon=True)
+        follower.start()
+
+    def add(self, record):
+        """Add a journal record to the buffer"""
+        entry = parseentry(record, 'entry:%s' % time.time())
+        with self.lock:
+            self.entries.append(entry)
+            self.cursor = entry['cursor']
+
+    def expired(self, cursor):
+        """True if **cursor** has left the buffer and holds no time, so query(after=cursor) cannot tell which entries
+        are new and returns the whole buffer"""
+        with self.lock:
+            if any(entry['cursor'] == cursor for entry in self.entries):
+                return False
+        return cursortime(cursor) is None
+
+    def __follower(self):
+        """Run the source, restarting it after the last cursor seen if it stops"""
+        while self.running:
+            try:
+                self.source.follow(self.add, self.cursor)
+            except OSError as err:
+                logger.warning('System log: source failed: %s', err)
+            time.sleep(5)
+
+    def query(self, unit=None, priority=None, since=None, until=None, search=None, after=None, offset=0, limit=500):
+        """Return up to **limit** entries newest first, skipping the first **offset** matches. **priority** keeps
+        entries at that priority or more urgent (0 to 7), **since** and **until** are times in seconds since the
+        epoch. If **after** is a cursor only the entries newer than it are returned, if the cursor has already left
+        the buffer the entries after the time held in the cursor are returned (see expired())."""
+        self.start()
+        with self.lock:
+            entries = list(self.entries)
+        if after is not None:
+            for index in range(len(entries) - 1, -1, -1):
+                if entries[index]['cursor'] == after:
+                    entries = entries[index + 1:]
+                    break
+            else:
+                aftertime = cursortime(after)
+                if aftertime is not None:
+                    entries = [entry for entry in entries if entry['time'] > aftertime]
+        found = []
+        skipped = 0
+        for entry in reversed(entries):
+            if unit and entry['unit'] != unit:
+                continue
+            if priority is not None and entry['priority'] > priority:
+                continue
+            if since is not None and entry['time'] < since:
+                continue
+            if until is not None and entry['time'] > until:
+                continue
+            if search and search not in entry['message']:
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            found.append(entry)
+            if len(found) >= limit:
+                break
+        return found